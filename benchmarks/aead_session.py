@@ -0,0 +1,80 @@
+import os
+import sys
+import time
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.backends import default_backend
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+from session_crypto import AeadSession
+
+# 暗号化・復号のCPU時間を、従来の1チャンクごとのCipher生成とAeadSessionで比較するマイクロベンチマーク
+# 実行例: poetry run python benchmarks/aead_session.py
+
+# 計測するフレームサイズ（従来のstream_rate、ネゴシエーションの下限、既定値、上限）
+FRAME_SIZES = (1400, 64 * 1024, 1024 * 1024, 4 * 1024 * 1024)
+# 1回の計測で処理するデータ量
+BENCHMARK_BYTES = 256 * 1024 * 1024
+GIB = 1024 ** 3
+
+# 変更前のencrypt_chunk・decrypt_chunkと同じ処理
+def legacy_encrypt_chunk(chunk, aes_key):
+    nonce = os.urandom(12)
+    encryptor = Cipher(algorithms.AES(aes_key), modes.GCM(nonce), default_backend()).encryptor()
+    encrypted_chunk = encryptor.update(chunk) + encryptor.finalize()
+
+    return nonce + encrypted_chunk + encryptor.tag
+
+def legacy_decrypt_chunk(encrypted_chunk, aes_key):
+    nonce = encrypted_chunk[:12]
+    auth_tag = encrypted_chunk[-16:]
+    encrypted_data = encrypted_chunk[12:-16]
+    decryptor = Cipher(algorithms.AES(aes_key), modes.GCM(nonce, auth_tag), default_backend()).decryptor()
+
+    return decryptor.update(encrypted_data) + decryptor.finalize()
+
+def measure_cpu_seconds_per_gib(func, frame_size):
+    """funcをBENCHMARK_BYTES分のフレームで繰り返し実行し、1GiBあたりのCPU時間を返す関数"""
+    iterations = max(BENCHMARK_BYTES // frame_size, 1)
+    start = time.process_time()
+    for _ in range(iterations):
+        func()
+    elapsed = time.process_time() - start
+
+    return elapsed * GIB / (iterations * frame_size)
+
+def benchmark_frame_size(frame_size):
+    aes_key = os.urandom(32)
+    data = os.urandom(frame_size)
+
+    # 復号は送信側と受信側のセッションを分け、カウンターのnonceが順番どおりに届く状態で計測する
+    # （暗号化だけの計測で送信側のカウンターが進むため、往復には別の送信側を使う）
+    sender = AeadSession(aes_key, is_server=False)
+    round_trip_sender = AeadSession(aes_key, is_server=False)
+    receiver = AeadSession(aes_key, is_server=True)
+    legacy_frame = legacy_encrypt_chunk(data, aes_key)
+
+    def session_round_trip():
+        receiver.decrypt(round_trip_sender.encrypt(data))
+
+    results = {
+        'legacy_encrypt': measure_cpu_seconds_per_gib(lambda: legacy_encrypt_chunk(data, aes_key), frame_size),
+        'legacy_decrypt': measure_cpu_seconds_per_gib(lambda: legacy_decrypt_chunk(legacy_frame, aes_key), frame_size),
+        'session_encrypt': measure_cpu_seconds_per_gib(lambda: sender.encrypt(data), frame_size),
+    }
+    # AeadSessionの復号だけを計測するため、往復の時間から暗号化の時間を引く
+    results['session_decrypt'] = measure_cpu_seconds_per_gib(session_round_trip, frame_size) - results['session_encrypt']
+
+    return results
+
+def main():
+    print(f"{'frame_size':>12} | {'legacy enc':>10} {'session enc':>11} | {'legacy dec':>10} {'session dec':>11}   (CPU秒/GiB)")
+    for frame_size in FRAME_SIZES:
+        results = benchmark_frame_size(frame_size)
+        print(
+            f"{frame_size:>12} | "
+            f"{results['legacy_encrypt']:>10.2f} {results['session_encrypt']:>11.2f} | "
+            f"{results['legacy_decrypt']:>10.2f} {results['session_decrypt']:>11.2f}"
+        )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import io
+import os
+import sys
+import time
+import shutil
+import tempfile
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+from server import build_clip_command, run_exact_clip, execute_ffmpeg, initialize_ffmpeg_executor
+from media_index import probe_media
+
+# 切り取り（action 5）の処理時間を、切り取る位置ごとに従来の出力側シークと各clip_modeで比較するベンチマーク
+# 実行例: poetry run python benchmarks/clip_latency.py [入力ファイル]
+# 入力ファイルを指定しない場合は、GOPが2秒・長さ10分のH.264/AACの動画を作成して使う
+
+# 切り取る位置（動画の長さに対する割合）と切り取る長さ（秒）
+CLIP_POSITIONS = (0.0, 0.25, 0.5, 0.75, 0.95)
+CLIP_SECONDS = 10
+SAMPLE_SECONDS = 600
+
+def create_sample(sample_path):
+    execute_ffmpeg([
+        'ffmpeg',
+        '-y',
+        '-f', 'lavfi', '-i', f'testsrc2=size=1280x720:rate=25:duration={SAMPLE_SECONDS}',
+        '-f', 'lavfi', '-i', f'sine=frequency=440:duration={SAMPLE_SECONDS}',
+        '-c:v', 'libx264', '-preset', 'veryfast', '-g', '50',
+        '-c:a', 'aac',
+        sample_path
+    ])
+
+def build_legacy_clip_command(input_path, output_path, startseconds, endseconds):
+    # 変更前のbuild_clip_commandと同じく、-ssを-iの後に置く（先頭から開始位置までをデコードする）
+    return ['ffmpeg', '-y', '-i', input_path, '-ss', str(startseconds), '-to', str(endseconds), output_path]
+
+def measure_seconds(func):
+    # execute_ffmpegが出力するコマンドは表示しない
+    with redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        func()
+        return time.perf_counter() - start
+
+def benchmark_position(work_dir, input_filename, media_info, startseconds):
+    input_path = os.path.join(work_dir, input_filename)
+    endseconds = startseconds + CLIP_SECONDS
+    results = {}
+
+    legacy_output_path = os.path.join(work_dir, 'legacy.mp4')
+    results['legacy'] = measure_seconds(
+        lambda: execute_ffmpeg(build_legacy_clip_command(input_path, legacy_output_path, startseconds, endseconds))
+    )
+
+    for clip_mode in ('accurate', 'keyframe', 'exact'):
+        req_data = {'startseconds': startseconds, 'endseconds': endseconds, 'extension': 'mp4', 'clip_mode': clip_mode}
+        if clip_mode == 'exact':
+            results[clip_mode] = measure_seconds(lambda: run_exact_clip(input_filename, work_dir, req_data, media_info))
+        else:
+            _, _, ffmpeg_cmd = build_clip_command(input_filename, work_dir, req_data, media_info=media_info)
+            results[clip_mode] = measure_seconds(lambda: execute_ffmpeg(ffmpeg_cmd))
+
+    return results
+
+def main():
+    with redirect_stdout(io.StringIO()):
+        initialize_ffmpeg_executor({'ffmpeg_workers': 1})
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        input_filename = 'input.mp4'
+        if len(sys.argv) > 1:
+            input_filename = 'input' + os.path.splitext(sys.argv[1])[1]
+            shutil.copyfile(sys.argv[1], os.path.join(work_dir, input_filename))
+        else:
+            print(f"{SAMPLE_SECONDS}秒のサンプル動画を作成しています...")
+            measure_seconds(lambda: create_sample(os.path.join(work_dir, input_filename)))
+
+        media_info = probe_media(os.path.join(work_dir, input_filename))
+        duration = media_info['duration']
+
+        print(f"{'position':>10} | {'legacy':>8} {'accurate':>8} {'keyframe':>8} {'exact':>8}   ({CLIP_SECONDS}秒の切り取りにかかった秒数)")
+        for position in CLIP_POSITIONS:
+            # 開始・終了がキーフレームと重ならないよう、1秒ずらした位置から切り取る
+            startseconds = round(min(duration * position + 1, duration - CLIP_SECONDS - 1), 3)
+            results = benchmark_position(work_dir, input_filename, media_info, startseconds)
+            print(
+                f"{startseconds:>9.1f}s | "
+                f"{results['legacy']:>8.2f} {results['accurate']:>8.2f} {results['keyframe']:>8.2f} {results['exact']:>8.2f}"
+            )
+    finally:
+        shutil.rmtree(work_dir)
+
+if __name__ == '__main__':
+    main()
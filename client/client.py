@@ -2,7 +2,14 @@ import socket
 import sys
 import os
 import json
+import hashlib
+import uuid
+import time
 from datetime import datetime
+from cryptography.hazmat.primitives import serialization, hashes
+from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
 # 共通のコネククション関連の関数はここから実装
 class CheckBeforeSend():
@@ -34,11 +41,193 @@ def connect_to_server(config):
         print(err)
         sys.exit(1)
 
+# 暗号化に関係する関数はここから実装
+def exchange_public_keys(sock):
+    # クライアントのRSA鍵を生成し、公開鍵（鍵の長さ（４バイト）、鍵）を送信してサーバーの公開鍵を受け取る
+    client_private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    client_public_key_pem = client_private_key.public_key().public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    sock.sendall(len(client_public_key_pem).to_bytes(4, 'big') + client_public_key_pem)
+
+    server_public_key_length = int.from_bytes(recv_exact(sock, 4), 'big')
+    server_public_key = serialization.load_pem_public_key(recv_exact(sock, server_public_key_length))
+    print("公開鍵の交換完了")
+
+    return server_public_key
+
+def send_encrypted_aes_key(sock, server_public_key):
+    # AES鍵を生成し、このセッションで使うnonceのモード（カウンター）と合わせてサーバーの公開鍵で暗号化して送信
+    aes_key = os.urandom(32)
+    encrypted_aes_key = server_public_key.encrypt(
+        aes_key + NONCE_MODE_COUNTER,
+        padding.OAEP(
+            mgf=padding.MGF1(algorithm=hashes.SHA256()),
+            algorithm=hashes.SHA256(),
+            label=None
+        )
+    )
+    sock.sendall(len(encrypted_aes_key).to_bytes(4, 'big') + encrypted_aes_key)
+
+    return aes_key
+
+# セッションチケットに関する関数はここから実装
+SESSION_TICKET_PATH = os.path.join(os.path.expanduser('~'), '.video_compressor_ticket.json')
+SESSION_RANDOM_SIZE = 32
+# 再開したセッションのAES鍵を導出する際のinfo（サーバーのsession_ticket.pyと同じ値）
+RESUMED_KEY_INFO = b'videoCompressor session resumption'
+
+def load_session_ticket(config):
+    """保存済みのこのサーバー用のセッションチケットを返す関数（ない場合や期限切れの場合はNone）"""
+    try:
+        with open(SESSION_TICKET_PATH, 'r', encoding='utf-8') as f:
+            tickets = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    ticket = tickets.get(f"{config['server_address']}:{config['server_port']}")
+    if ticket is None or ticket['expires_at'] <= time.time():
+        return None
+    return ticket
+
+def save_session_ticket(config, ticket):
+    try:
+        with open(SESSION_TICKET_PATH, 'r', encoding='utf-8') as f:
+            tickets = json.load(f)
+    except (FileNotFoundError, ValueError):
+        tickets = {}
+
+    server_key = f"{config['server_address']}:{config['server_port']}"
+    if ticket is None:
+        tickets.pop(server_key, None)
+    else:
+        tickets[server_key] = ticket
+
+    with open(SESSION_TICKET_PATH, 'w', encoding='utf-8') as f:
+        json.dump(tickets, f)
+
+def receive_session_ticket(config, sock, session):
+    # 秘密値（３２バイト）、有効期限（８バイト）、チケットを受信して保存する（空の場合はサーバーがチケットに対応していない）
+    ticket_data = receive_encrypted_frame(sock, session)
+    if not ticket_data:
+        return
+
+    save_session_ticket(config, {
+        'secret': ticket_data[:32].hex(),
+        'expires_at': int.from_bytes(ticket_data[32:40], 'big'),
+        'ticket': ticket_data[40:].hex()
+    })
+
+def resume_session(config, sock, ticket):
+    """セッションチケットでAES鍵を導出する関数（サーバーがチケットを受け付けなかった場合はNone）"""
+    ticket_bytes = bytes.fromhex(ticket['ticket'])
+    client_random = os.urandom(SESSION_RANDOM_SIZE)
+    # 公開鍵の長さ０はチケットによる再開の合図（最後の１バイトはこのセッションで使うnonceのモード）
+    sock.sendall((0).to_bytes(4, 'big') + len(ticket_bytes).to_bytes(4, 'big') + ticket_bytes + client_random + NONCE_MODE_COUNTER)
+
+    if recv_exact(sock, 1) != b'\x01':
+        print("セッションチケットが使えないため、公開鍵を交換します")
+        save_session_ticket(config, None)
+        return None
+
+    server_random = recv_exact(sock, SESSION_RANDOM_SIZE)
+    print("セッションチケットでセッションを再開しました")
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=client_random + server_random,
+        info=RESUMED_KEY_INFO
+    ).derive(bytes.fromhex(ticket['secret']))
+
+# nonce（１２バイト）の先頭４バイトで送信方向を区別する（サーバーのsession_crypto.pyと同じ値）
+CLIENT_NONCE_PREFIX = b'\x00\x00\x00\x01'
+SERVER_NONCE_PREFIX = b'\x00\x00\x00\x02'
+# 鍵交換でサーバーに通知する、カウンターのnonceを使うことを表すモード（サーバーのsession_crypto.pyと同じ値）
+NONCE_MODE_COUNTER = b'\x01'
+
+class AeadSession:
+    """1接続につき1つ作成するAES-GCMのセッション
+
+    送信するフレームのnonceは「送信方向（４バイト）＋カウンター（８バイト）」とする
+    鍵交換でカウンターのnonceを使うことをサーバーに通知済みのため、最初のフレームから順番どおりのnonce以外を拒否する
+    """
+    def __init__(self, aes_key) -> None:
+        self.aead = AESGCM(aes_key)
+        self.send_counter = 0
+        self.receive_counter = 0
+
+    def encrypt(self, data):
+        nonce = CLIENT_NONCE_PREFIX + self.send_counter.to_bytes(8, 'big')
+        self.send_counter += 1
+
+        return nonce + self.aead.encrypt(nonce, data, None)
+
+    def decrypt(self, frame):
+        nonce = frame[:12]
+        expected_nonce = SERVER_NONCE_PREFIX + self.receive_counter.to_bytes(8, 'big')
+
+        if nonce != expected_nonce:
+            raise Exception(f'{self.receive_counter}番目のフレームのnonceが一致しません（リプレイまたは順序の入れ替え）')
+
+        plaintext = self.aead.decrypt(nonce, memoryview(frame)[12:], None)
+        self.receive_counter += 1
+        return plaintext
+
+def recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise Exception('サーバーとの接続が切断されました')
+        data += chunk
+    return data
+
+def receive_encrypted_frame(sock, session):
+    # データサイズ（４バイト）と暗号化されたデータを受信して復号する
+    frame_size = int.from_bytes(recv_exact(sock, 4), 'big')
+    return session.decrypt(recv_exact(sock, frame_size))
+
+class FrameReader:
+    """受信用のバッファを使い回し、recv_intoでフレーム（データサイズ（４バイト）と暗号化されたデータ）を受信して復号するクラス"""
+    def __init__(self, sock, session, buffer_size=1024 * 1024) -> None:
+        self.sock = sock
+        self.session = session
+        self.size_view = memoryview(bytearray(4))
+        self.frame_view = memoryview(bytearray(buffer_size))
+
+    def recv_into_exact(self, view):
+        received = 0
+        while received < len(view):
+            received_size = self.sock.recv_into(view[received:])
+            if received_size == 0:
+                raise Exception('サーバーとの接続が切断されました')
+            received += received_size
+
+    def read(self):
+        """1フレームを受信して復号したデータを返す関数（ストリーミングレスポンスの長さ０の区切りの場合はNone）"""
+        self.recv_into_exact(self.size_view)
+        frame_size = int.from_bytes(self.size_view, 'big')
+        if frame_size == 0:
+            return None
+        # バッファより大きなフレームが届いた場合はバッファを広げる
+        if frame_size > len(self.frame_view):
+            self.frame_view = memoryview(bytearray(frame_size))
+
+        frame = self.frame_view[:frame_size]
+        self.recv_into_exact(frame)
+        return self.session.decrypt(frame)
+
 def get_file_input():
-    filepath = input('処理対象の動画ファイルパスを入力してください：')
-    CheckBeforeSend.check_file_exists(filepath)
+    # カンマ区切りで複数のファイルを指定した場合は、1つの接続で同じ処理を順に行う
+    filepaths = [path.strip() for path in input('処理対象の動画ファイルパスを入力してください（複数の場合はカンマ区切り）：').split(',') if path.strip()]
+    if not filepaths:
+        print('ファイルが存在しません')
+        sys.exit(1)
+    for filepath in filepaths:
+        CheckBeforeSend.check_file_exists(filepath)
 
-    return filepath
+    return filepaths
 
 def get_request_parameters():
     menu = show_menu()
@@ -66,7 +255,7 @@ def get_request_parameters():
             #動画をオーディオに変換
             req_params = {'action': action}
         case 5:
-            #時間範囲での GIF と WEBM の作成
+            #時間範囲での GIF と WEBM（と MP4）の作成
             startseconds, endseconds = get_start_end_seconds()
             chosen_extension = get_gif_webm_choice()
             req_params = {
@@ -75,6 +264,21 @@ def get_request_parameters():
                 'endseconds': endseconds,
                 'extension': chosen_extension
             }
+            if chosen_extension in ('webm', 'mp4'):
+                req_params['clip_mode'] = get_clip_mode_choice()
+        case 6:
+            #複数の処理をまとめて実行（アップロードとエンコードは1回のみ）
+            req_params = {
+                'action': action,
+                'operations': get_chain_operations(menu)
+            }
+        case 7:
+            #複数の解像度（とオーディオ）を1回のアップロード・デコードで作成
+            req_params = {
+                'action': action,
+                'resolutions': get_resolution_choices(),
+                'audio': get_audio_choice()
+            }
         case _:
             req_params = {'action': action}
 
@@ -83,7 +287,23 @@ def get_request_parameters():
 def create_request_header(json_size, mediatype_size, payload_size):
     return  json_size.to_bytes(2, 'big') + mediatype_size.to_bytes(1,'big') + payload_size.to_bytes(5,'big')
 
-def send_file_data(config, sock, filepath, req_params):
+def calculate_file_hash(filepath):
+    # 重複排除のため、アップロード前にファイルのSHA-256を計算する
+    sha256 = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            sha256.update(data)
+    return sha256.hexdigest()
+
+# 事前検証のためにサーバーに送るファイルの先頭部分のサイズ（サーバーのPREFLIGHT_HEAD_SIZEと同じ値）
+PREFLIGHT_HEAD_SIZE = 1024 * 1024
+# サーバーがアップロードを再開できない場合に、受信済みの位置の代わりに返す値（アップロードせずにエラーのレスポンスを受信する）
+RESUME_REJECTED_OFFSET = 2 ** 64 - 1
+
+def send_file_data(config, sock, filepath, req_params, session):
     mediatype = filepath.split('.')[-1]
 
     # バイナリモードでファイルを読み込む
@@ -95,85 +315,344 @@ def send_file_data(config, sock, filepath, req_params):
 
         # create_request_header()関数を用いてヘッダ情報を作成し、ヘッダとファイル名をサーバに送信します。
         # JSONサイズ（2バイト）、メディアタイプサイズ（1バイト）、ペイロードサイズ（5バイト）
-        req_params_size = len(json.dumps(req_params))
-        header = create_request_header(req_params_size, len(mediatype), filesize)
-
-        # ヘッダの送信
-        sock.send(header)
-        # req_params(json)および、メディアタイプ(mp3など)の送信
-        sock.send(json.dumps(req_params).encode('utf-8'))
-        sock.send(mediatype.encode('utf-8'))
-
-        # 一度に1400バイトずつ読み出し、送信することにより、ファイルを送信します。Readは読み込んだビットを返します
+        req_params_bytes = json.dumps(req_params).encode('utf-8')
+        mediatype_bytes = mediatype.encode('utf-8')
+        header = create_request_header(len(req_params_bytes), len(mediatype_bytes), filesize)
+
+        # ヘッダ、req_params(json)および、メディアタイプ(mp3など)をそれぞれAES暗号化して送信
+        sock.sendall(session.encrypt(header))
+        sock.sendall(session.encrypt(req_params_bytes))
+        sock.sendall(session.encrypt(mediatype_bytes))
+
+        # 次回の接続用のセッションチケットを求めた場合は、最初に受信する
+        if req_params.get('session_ticket'):
+            receive_session_ticket(config, sock, session)
+
+        # フレームサイズを指定した場合は、サーバーが決めたフレームサイズ（４バイト）でアップロードする
+        frame_size = config['stream_rate']
+        if 'frame_size' in req_params:
+            frame_size = int.from_bytes(receive_encrypted_frame(sock, session), 'big')
+
+        # 事前検証を求めた場合は、サーバーがパラメータを受け付けた場合のみファイルの先頭部分を送り、
+        # 先頭部分も受け付けた場合のみアップロードする（受け付けられない場合は、以降を送らずにエラーのレスポンスを受信する）
+        if req_params.get('preflight'):
+            if receive_encrypted_frame(sock, session) != b'\x01':
+                print("サーバーがジョブを受け付けなかったため、アップロードを省略します")
+                return
+            sock.sendall(session.encrypt(f.read(PREFLIGHT_HEAD_SIZE)))
+            f.seek(0)
+            if receive_encrypted_frame(sock, session) != b'\x01':
+                print("サーバーがジョブを受け付けなかったため、アップロードを省略します")
+                return
+
+        # SHA-256を通知した場合は、サーバーが同じファイルを保存済みならアップロードを省略する
+        if 'sha256' in req_params:
+            upload_reply = receive_encrypted_frame(sock, session)
+            if upload_reply == b'\x01':
+                print("サーバーに同じファイルがあるため、アップロードを省略します")
+                return
+
+        # アップロードIDを指定した場合は、サーバーが受信済みの位置（８バイト）から送信を再開する
+        if 'upload_id' in req_params:
+            resume_offset = int.from_bytes(receive_encrypted_frame(sock, session), 'big')
+            if resume_offset == RESUME_REJECTED_OFFSET:
+                print("サーバーがアップロードを再開できないため、アップロードを省略します")
+                return
+            if resume_offset > 0:
+                print(f"前回の続き（{resume_offset}/{filesize}バイト）からアップロードを再開します")
+            f.seek(resume_offset)
+
+        # frame_sizeバイトずつ読み出し、AES暗号化して送信することにより、ファイルを送信します。
         while True:
-            data = f.read(config['stream_rate'])
+            data = f.read(frame_size)
             if not data:
                 break
-            sock.send(data)
+            sock.sendall(session.encrypt(data))
 
         print("ファイル送信完了")
 
 def upload_file(config, sock):
-    filepath = get_file_input()
+    filepaths = get_file_input()
     action, req_params = get_request_parameters()
+    # 受信しながら保存するため、保存先は送信前に決めておく（拡張子はサーバーの処理結果に合わせる）
+    output_filename = get_output_filename()
 
     try:
-        send_file_data(config, sock, filepath, req_params)
+        # 保存済みのセッションチケットがあれば、RSAの鍵交換を省略してセッションを再開する
+        ticket = load_session_ticket(config) if config['session_ticket'] else None
+        aes_key = resume_session(config, sock, ticket) if ticket is not None else None
+
+        if aes_key is None:
+            server_public_key = exchange_public_keys(sock)
+            aes_key = send_encrypted_aes_key(sock, server_public_key)
+        # 以降の送受信はすべてこのセッションで暗号化・復号する
+        session = AeadSession(aes_key)
+
+        # パイプライン処理では、次のジョブを送信してから前のジョブのレスポンスを受信する
+        pending_job = None
+        for job_index, filepath in enumerate(filepaths):
+            job_params = create_job_params(config, filepath, req_params, job_index, len(filepaths))
+            job_output_filename = output_filename if len(filepaths) == 1 else f'{output_filename}_{job_index + 1}'
+
+            send_file_data(config, sock, filepath, job_params, session)
+
+            if pending_job is not None:
+                if not receive_job_result(sock, session, *pending_job):
+                    return
+                pending_job = None
+
+            if job_params.get('pipeline'):
+                pending_job = (filepath, job_params, job_output_filename)
+            elif not receive_job_result(sock, session, filepath, job_params, job_output_filename):
+                return
+
+        if pending_job is not None:
+            # これ以上ジョブがないことをサーバーに伝えてから、最後のレスポンスを受信する
+            sock.shutdown(socket.SHUT_WR)
+            receive_job_result(sock, session, *pending_job)
 
-        try:
-            status, file_extenstion, response_body = receive_response(sock)
+    except Exception as e:
+        print(f'ファイル送信エラー: {str(e)}')
 
-            if status == 'error':
-                print(f"サーバーエラー：{response_body}")
-            else:
-                print("処理成功！")
-                save_processed_file(file_extenstion, response_body)
+def create_job_params(config, filepath, req_params, job_index, job_count):
+    """ファイルごとのリクエストパラメータを作成する関数"""
+    job_params = dict(req_params)
+
+    if config['upload_dedup']:
+        job_params['sha256'] = calculate_file_hash(filepath)
+    if config['resumable_upload']:
+        job_params['upload_id'] = load_upload_id(filepath)
+    if config['frame_size']:
+        job_params['frame_size'] = config['frame_size']
+    if config['progress']:
+        job_params['progress'] = True
+    if config['preflight']:
+        job_params['preflight'] = True
+    if config['stream_response']:
+        # 処理結果をFFMPEGの出力と同時に受け取る（ファイルサイズは最後のトレーラーで届く）
+        job_params['stream_response'] = True
+    # セッションチケットは接続ごとに1回だけ受け取る
+    if config['session_ticket'] and job_index == 0:
+        job_params['session_ticket'] = True
+
+    if job_count > 1:
+        # 複数のファイルは1つの接続で送り、各レスポンスの前にジョブIDを受け取る
+        job_params['job_id'] = job_index + 1
+        job_params['keep_alive'] = True
+        # ストリーミングレスポンスは処理中に送られてくるため、パイプライン処理しない
+        job_params['pipeline'] = config['pipeline_jobs'] and not job_params.get('stream_response', False)
+
+    return job_params
+
+def receive_job_result(sock, session, filepath, job_params, output_filename):
+    """1つのジョブのレスポンスを受信して結果を表示する関数（以降のジョブを続けられない場合はFalseを返す）"""
+    try:
+        if job_params.get('keep_alive'):
+            job_id = json.loads(receive_encrypted_frame(sock, session).decode('utf-8'))['job_id']
+            if job_id != job_params['job_id']:
+                raise Exception(f"ジョブ{job_params['job_id']}のレスポンスの代わりにジョブ{job_id}のレスポンスを受信しました")
+            print(f"ジョブ{job_id}（{filepath}）の結果:")
 
-        except Exception as recv_error:
-            print(f"レスポンス受信エラー: {str(recv_error)}")
+        status, response_body = receive_response(sock, session, output_filename)
 
-    except Exception as e:
-        print(f'ファイル送信エラー: {str(e)}')
+        if status == 'error':
+            print(f"サーバーエラー：{response_body}")
+        else:
+            print("処理成功！")
+            if 'upload_id' in job_params:
+                forget_upload_id(filepath)
+            print(f"処理後の動画を保存完了！（{response_body}）")
+
+        return True
+
+    except Exception as recv_error:
+        print(f"レスポンス受信エラー: {str(recv_error)}")
+        return False
+
+# 再開可能なアップロードに関する関数はここから実装
+UPLOAD_STATE_PATH = os.path.join(os.path.expanduser('~'), '.video_compressor_uploads.json')
+
+def load_upload_states():
+    try:
+        with open(UPLOAD_STATE_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_upload_states(states):
+    with open(UPLOAD_STATE_PATH, 'w', encoding='utf-8') as f:
+        json.dump(states, f)
+
+def load_upload_id(filepath):
+    """前回途中で終わったアップロードのIDを返す関数（ない場合やファイルが変更された場合は新しく発行する）"""
+    filepath = os.path.abspath(filepath)
+    stat = os.stat(filepath)
+    states = load_upload_states()
+
+    state = states.get(filepath)
+    if state is not None and state['file_size'] == stat.st_size and state['mtime'] == stat.st_mtime:
+        return state['upload_id']
+
+    upload_id = uuid.uuid4().hex
+    states[filepath] = {'upload_id': upload_id, 'file_size': stat.st_size, 'mtime': stat.st_mtime}
+    save_upload_states(states)
+    return upload_id
+
+def forget_upload_id(filepath):
+    states = load_upload_states()
+    if states.pop(os.path.abspath(filepath), None) is not None:
+        save_upload_states(states)
+
+def receive_response(sock, session, output_filename):
+    # レスポンスコード、JSONの順に、それぞれデータサイズ（４バイト）とAES暗号化されたデータを受信する
+    responce_code = receive_encrypted_frame(sock, session)
+
+    # 進捗を求めた場合は、処理中に進捗コード（２）と進捗のJSONが繰り返し届く
+    received_progress = False
+    while responce_code == b'\x02':
+        print_encode_progress(json.loads(receive_encrypted_frame(sock, session).decode('utf-8')))
+        received_progress = True
+        responce_code = receive_encrypted_frame(sock, session)
+    if received_progress:
+        print()
 
-def receive_response(sock):
-    responce_code = sock.recv(1)
     if responce_code == b'\x00':
         # エラーの場合
-        error_size = int.from_bytes(sock.recv(4), 'big')
-
-        error_bytes = sock.recv(error_size)
-        error_text = error_bytes.decode('utf-8')
+        error_text = receive_encrypted_frame(sock, session).decode('utf-8')
 
-        return 'error', None, error_text
+        return 'error', error_text
     else:
-        # 成功の場合
-        success_size = int.from_bytes(sock.recv(4), 'big')
+        # 成功の場合は、受信したチャンクをそのまま保存先のファイルに書き込む
+        success_json = json.loads(receive_encrypted_frame(sock, session).decode('utf-8'))
 
-        success_bytes = sock.recv(success_size)
-        success_json = json.loads(success_bytes.decode('utf-8'))
+        if 'parts' in success_json:
+            # 複数のファイルが返ってきた場合は、partsの順に続けて受信し、ラベルを付けたファイル名で保存する
+            frame_reader = FrameReader(sock, session)
+            output_paths = []
+            for part in success_json['parts']:
+                output_path = f"{output_filename}_{part['rendition']}.{part['file_extension']}"
+                save_processed_file(frame_reader, output_path, part['file_size'])
+                output_paths.append(output_path)
 
-        file_data = b''
-        remaining = success_json['file_size']
-        while remaining > 0:
-            chunk = sock.recv(min(1400, remaining))
-            if not chunk:
-                break
-            file_data += chunk
-            remaining -= len(chunk)
+            return 'success', '、'.join(output_paths)
 
-        return 'success', success_json['file_extension'], file_data
+        output_path = output_filename + '.' + success_json['file_extension']
 
-def save_processed_file(file_extenstion, file_data):
-    output_filename = input('処理後の動画を保存するファイル名を拡張子を含まずに入力してください\n')
-    output_filename = output_filename + '.' + file_extenstion
+        if success_json.get('streaming'):
+            # ストリーミングレスポンスはファイルサイズが未確定のため、区切りまで受信してからトレーラーで検証する
+            trailer = save_streamed_file(FrameReader(sock, session), output_path)
+            if trailer.get('status_code') != 'success':
+                return 'error', json.dumps(trailer, ensure_ascii=False)
+            return 'success', output_path
 
-    if isinstance(file_data, bytes):
-        with open(output_filename, 'wb') as f:
-            f.write(file_data)
+        save_processed_file(FrameReader(sock, session), output_path, success_json['file_size'])
 
-        print("処理後の動画を保存完了！")
-    else:
-        print("保存不可なデータ形式")
+        return 'success', output_path
+
+def get_output_filename():
+    return input('処理後の動画を保存するファイル名を拡張子を含まずに入力してください\n')
+
+def preallocate_file(f, file_size):
+    # 書き込み途中でディスクが不足しないよう、先にファイルサイズ分の領域を確保する
+    try:
+        os.posix_fallocate(f.fileno(), 0, file_size)
+    except (AttributeError, OSError):
+        f.truncate(file_size)
+
+def save_processed_file(frame_reader, output_path, file_size):
+    received = 0
+    started_at = time.monotonic()
+    last_reported_at = 0
+
+    try:
+        with open(output_path, 'wb') as f:
+            if file_size > 0:
+                preallocate_file(f, file_size)
+
+            while received < file_size:
+                chunk = frame_reader.read()
+                if not chunk:
+                    break
+                f.write(chunk)
+                received += len(chunk)
+
+                # 進捗と転送速度は0.5秒ごとに表示する（受信完了時はループの外で表示する）
+                now = time.monotonic()
+                if now - last_reported_at >= 0.5 and received < file_size:
+                    print_download_progress(received, file_size, now - started_at)
+                    last_reported_at = now
+
+            if received != file_size:
+                raise Exception(f'受信したデータ（{received}バイト）がファイルサイズ（{file_size}バイト）と一致しません')
+
+    except BaseException:
+        # 途中までのファイルは残さない
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+
+    print_download_progress(received, file_size, time.monotonic() - started_at)
+    print()
+
+def save_streamed_file(frame_reader, output_path):
+    """長さ０の区切りまでのチャンクを保存し、続くトレーラーJSONを返す関数
+
+    トレーラーがエラーの場合と、ファイルサイズが受信したデータと一致しない場合は、保存したファイルを削除する
+    """
+    received = 0
+    started_at = time.monotonic()
+    last_reported_at = 0
+
+    try:
+        with open(output_path, 'wb') as f:
+            while True:
+                chunk = frame_reader.read()
+                if chunk is None:
+                    break
+                f.write(chunk)
+                received += len(chunk)
+
+                now = time.monotonic()
+                if now - last_reported_at >= 0.5:
+                    print_stream_progress(received, now - started_at)
+                    last_reported_at = now
+
+        trailer = json.loads(frame_reader.read().decode('utf-8'))
+        if trailer.get('status_code') == 'success' and trailer.get('file_size') != received:
+            raise Exception(f"受信したデータ（{received}バイト）がファイルサイズ（{trailer.get('file_size')}バイト）と一致しません")
+
+    except BaseException:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+
+    print_stream_progress(received, time.monotonic() - started_at)
+    print()
+
+    if trailer.get('status_code') != 'success':
+        # 送信の途中でサーバーの処理が失敗した場合は、途中までのファイルを残さない
+        os.remove(output_path)
+    return trailer
+
+def print_stream_progress(received, elapsed_seconds):
+    throughput = received / elapsed_seconds / (1024 * 1024) if elapsed_seconds > 0 else 0
+    print(f"\r受信中: {received / (1024 * 1024):.1f} MB（{throughput:.1f} MB/s）", end='', flush=True)
+
+def print_download_progress(received, file_size, elapsed_seconds):
+    percent = received / file_size * 100 if file_size > 0 else 100
+    throughput = received / elapsed_seconds / (1024 * 1024) if elapsed_seconds > 0 else 0
+    print(f"\r受信中: {percent:5.1f}% （{received / (1024 * 1024):.1f}/{file_size / (1024 * 1024):.1f} MB、{throughput:.1f} MB/s）", end='', flush=True)
+
+def print_encode_progress(progress):
+    # 出力の長さがわからない場合、割合と残り時間は届かない
+    status = f"{progress['out_seconds'] or 0:.1f}秒"
+    if progress['percent'] is not None:
+        status = f"{progress['percent']:5.1f}% （{status}）"
+    if progress['speed'] is not None:
+        status += f"、{progress['speed']:.2f}倍速"
+    if progress['eta_seconds'] is not None:
+        status += f"、残り約{progress['eta_seconds']:.0f}秒"
+    print(f"\rサーバーで処理中: {status}", end='', flush=True)
 
 # メニューに関連した関数はここから実装
 def show_menu():
@@ -182,7 +661,9 @@ def show_menu():
         2: '動画の解像度の変更',
         3: '動画のアスペクト比の変更',
         4: '動画をオーディオに変換',
-        5: '時間範囲での GIF と WEBM の作成'
+        5: '時間範囲での GIF と WEBM の作成',
+        6: '複数の処理をまとめて実行（切り取り・解像度・アスペクト比・圧縮など）',
+        7: '複数の解像度（とオーディオ）を一度に作成'
     }
 
     print('------動画処理メニュー------')
@@ -213,7 +694,15 @@ def load_client_config():
     return {
         'server_address': config['server_address'],
         'server_port': config['server_port'],
-        'stream_rate': config['stream_rate']
+        'stream_rate': config['stream_rate'],
+        'upload_dedup': config.get('upload_dedup', False),
+        'resumable_upload': config.get('resumable_upload', False),
+        'frame_size': config.get('frame_size'),
+        'session_ticket': config.get('session_ticket', False),
+        'pipeline_jobs': config.get('pipeline_jobs', False),
+        'progress': config.get('progress', False),
+        'preflight': config.get('preflight', False),
+        'stream_response': config.get('stream_response', False)
     }
 
 # 機能別の関数はここから実装
@@ -242,6 +731,21 @@ def get_resolution_choice():
         except ValueError:
             print("正しい数字を入力してください")
 
+def get_resolution_choices():
+    # 作成する解像度を複数選択する
+    resolutions = []
+    while not resolutions:
+        resolutions = [get_resolution_choice()]
+        while input('他の解像度も作成しますか？（y/n）: ').strip().lower() == 'y':
+            resolution = get_resolution_choice()
+            if resolution not in resolutions:
+                resolutions.append(resolution)
+
+    return resolutions
+
+def get_audio_choice():
+    return input('オーディオ（MP3）も作成しますか？（y/n）: ').strip().lower() == 'y'
+
 def get_start_end_seconds():
 
      while True:
@@ -266,7 +770,8 @@ def get_gif_webm_choice():
     # GIFとWEBMの選択
     gif_webm_choices = {
         1: "GIF",
-        2: "WEBM"
+        2: "WEBM",
+        3: "MP4"
     }
     print("-------以下の形式から選んで下さい-------")
     for choice, extension in gif_webm_choices.items():
@@ -285,6 +790,60 @@ def get_gif_webm_choice():
         except ValueError:
             print('正しい数字を入力してください')
 
+def get_clip_mode_choice():
+    # 切り取り方の選択（サーバーで使えない場合は1.になる）
+    clip_mode_choices = {
+        1: ("accurate", "指定した時刻で切り取る（全体を再エンコード）"),
+        2: ("keyframe", "直前のキーフレームから切り取る（再エンコードなし、最速）"),
+        3: ("exact", "指定した時刻で切り取る（両端のみ再エンコード）")
+    }
+    print("-------切り取り方を選んで下さい-------")
+    for choice, (clip_mode, description) in clip_mode_choices.items():
+        print(f"{choice}. {description}")
+    print("------------------------")
+
+    while True:
+        try:
+            user_choice = int(input('切り取り方を選んでください: '))
+            if user_choice in clip_mode_choices:
+                return clip_mode_choices[user_choice][0]
+            else:
+                print("正しい選択肢を選んでください")
+
+        except ValueError:
+            print('正しい数字を入力してください')
+
+def get_chain_operations(menu):
+    # まとめて実行できる処理（番号の順に適用する）
+    chain_choices = [choice for choice in menu if choice not in (6, 7)]
+
+    while True:
+        try:
+            choices = [int(choice) for choice in input('実行する処理の番号を順にカンマ区切りで入力してください（例: 5,2,1）: ').split(',')]
+            if choices and all(choice in chain_choices for choice in choices):
+                break
+            print(f'{chain_choices[0]}から{chain_choices[-1]}の数字を入力して下さい')
+
+        except ValueError:
+            print('正しい数字を入力してください')
+
+    operations = []
+    for choice in choices:
+        print(f'--- {menu[choice]} ---')
+        match choice:
+            case 2:
+                operations.append({'action': choice, 'resolution': get_resolution_choice()})
+            case 3:
+                operations.append({'action': choice, 'aspect_ratio': get_aspect_ratio_choice()})
+            case 5:
+                # まとめて実行する場合の切り取りは、形式を変えずに時間範囲だけを指定する
+                startseconds, endseconds = get_start_end_seconds()
+                operations.append({'action': choice, 'startseconds': startseconds, 'endseconds': endseconds})
+            case _:
+                operations.append({'action': choice})
+
+    return operations
+
 def get_aspect_ratio_choice():
     aspect_ratio_choices = {
         # key : (aspect_ratio, description)
@@ -0,0 +1,525 @@
+import asyncio
+import os
+import mmap
+import json
+import uuid
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import server
+from session_crypto import AeadSession, parse_key_message, parse_nonce_mode
+from session_ticket import MAX_TICKET_SIZE, SESSION_RANDOM_SIZE, derive_resumed_key
+from storage_manager import StorageManager
+from server import (
+    ErrorInfo,
+    SuccessInfo,
+    MultipartSuccessInfo,
+    ACTION_ERROR_INFO,
+    create_action_error,
+    prepare_action,
+    build_ladder_command,
+    build_duration_probe_command,
+    check_video_duration,
+    get_requested_endseconds,
+    delete_tmp_files,
+    load_server_config,
+    negotiate_frame_size,
+    validate_action_params,
+    validate_upload_head,
+    PREFLIGHT_HEAD_SIZE,
+    MEDIATYPE_PATTERN,
+)
+
+# asyncioベースのサーバー
+# 1クライアントにつき1コルーチンで処理するため、低速なアップロードが大量にあってもスレッドを消費しない
+# FFMPEGの同時実行数はffmpeg_workersのセマフォで制限する
+
+# コネクション関連の関数はここから実装
+async def establish_aes_key(reader, writer):
+    """セッションチケットまたはRSAの鍵交換で、このセッションの（AES鍵, nonceのモードがカウンターか）を決める関数（server.pyのestablish_aes_keyと同じ手順）"""
+    client_public_key_length = int.from_bytes(await reader.readexactly(4), 'big')
+    if client_public_key_length == 0:
+        aes_key = await resume_session(reader, writer)
+        if aes_key is not None:
+            return aes_key
+        client_public_key_length = int.from_bytes(await reader.readexactly(4), 'big')
+
+    await exchange_public_keys(reader, writer, client_public_key_length)
+    return await receive_encrypted_aes_key(reader)
+
+async def resume_session(reader, writer):
+    ticket_length = int.from_bytes(await reader.readexactly(4), 'big')
+    if ticket_length > MAX_TICKET_SIZE:
+        raise Exception('セッションチケットが長すぎます')
+    ticket = await reader.readexactly(ticket_length)
+    client_random = await reader.readexactly(SESSION_RANDOM_SIZE)
+    counter_nonces = parse_nonce_mode(await reader.readexactly(1))
+
+    resumption_secret = server.global_ticket_manager.open(ticket) if server.global_ticket_manager is not None else None
+    if resumption_secret is None:
+        print("セッションチケットが無効なため、公開鍵の交換を行います")
+        writer.write(b'\x00')
+        await writer.drain()
+        return None
+
+    server_random = os.urandom(SESSION_RANDOM_SIZE)
+    writer.write(b'\x01' + server_random)
+    await writer.drain()
+    print("セッションチケットでセッションを再開")
+    return derive_resumed_key(resumption_secret, client_random, server_random), counter_nonces
+
+async def exchange_public_keys(reader, writer, client_public_key_length):
+    try:
+        # RSA公開鍵の取得（鍵の長さ（４バイト）、鍵）
+        client_public_key_pem = await reader.readexactly(client_public_key_length)
+        client_public_key = serialization.load_pem_public_key(client_public_key_pem)
+        print("クライアントの公開鍵をロード完了")
+
+        server_public_key_pem = server.global_rsa_manager.generatePublicKeyPem()
+
+        writer.write(len(server_public_key_pem).to_bytes(4, 'big') + server_public_key_pem)
+        await writer.drain()
+        print("サーバーの公開鍵を送信完了")
+
+        if isinstance(client_public_key, rsa.RSAPublicKey):
+            print("公開鍵の交換完了")
+            return client_public_key
+        else:
+            raise TypeError("クライアントの公開鍵はRSAフォーマットではありません")
+
+    except Exception as e:
+        print(f"公開鍵の交換に失敗：{e}")
+        raise
+
+async def receive_encrypted_aes_key(reader):
+    try:
+        encrypted_aes_key_size = int.from_bytes(await reader.readexactly(4), 'big')
+        encrypted_aes_key = await reader.readexactly(encrypted_aes_key_size)
+
+        # AES鍵とnonceのモード（従来のクライアントはAES鍵のみ）
+        return parse_key_message(server.global_rsa_manager.decryptContent(encrypted_aes_key))
+
+    except Exception as e:
+        print(f"暗号化されたAES鍵の受信に失敗：{e}")
+        raise
+
+async def handle_client_request(config, reader, writer, session, ffmpeg_slots):
+    """鍵交換の済んだ接続で、クライアントのジョブを順に処理する関数（keep_alive・pipelineの扱いはserver.pyと同じ）"""
+    pending_task = None
+    pending_job = None
+
+    try:
+        while True:
+            job = await receive_job(config, reader, writer, session)
+            if job is None:
+                break
+
+            # 前のジョブのレスポンスを先に送る
+            if pending_task is not None:
+                pending_job.response_turn.set()
+                await pending_task
+                pending_task = pending_job = None
+
+            if job.pipelined:
+                # FFMPEGの実行中に次のジョブのアップロードを受信する
+                pending_task = asyncio.create_task(execute_job(config, writer, session, job, ffmpeg_slots))
+                pending_job = job
+            else:
+                await execute_job(config, writer, session, job, ffmpeg_slots)
+
+            if not job.keep_alive:
+                break
+
+    finally:
+        if pending_task is not None:
+            pending_job.response_turn.set()
+            await pending_task
+
+class ClientJob:
+    """1つのジョブ（リクエスト、受信時のエラー）を保持するクラス"""
+    def __init__(self, req_data, filename, frame_size) -> None:
+        self.req_data = req_data
+        self.action = req_data.get('action', 0)
+        self.job_id = req_data.get('job_id')
+        self.filename = filename
+        self.frame_size = frame_size
+        self.keep_alive = bool(req_data.get('keep_alive', False))
+        self.pipelined = self.keep_alive and bool(req_data.get('pipeline', False))
+        self.error = None
+
+        # レスポンスを送ってよいか（パイプライン処理では次のジョブの受信が終わるまで待つ）
+        self.response_turn = asyncio.Event()
+        if not self.pipelined:
+            self.response_turn.set()
+        self.response_started = False
+
+    async def begin_response(self, writer, session):
+        """レスポンスを送る直前に呼び出す関数（送信の順番を待ち、keep_aliveの場合はジョブIDのフレームを送る）"""
+        if self.response_started:
+            return
+        await self.response_turn.wait()
+        self.response_started = True
+        if self.keep_alive:
+            write_frame(writer, session, json.dumps({'job_id': self.job_id}).encode('utf-8'))
+
+async def receive_job(config, reader, writer, session):
+    """リクエストヘッダーからアップロードの受信までを行い、ClientJobを返す関数（クライアントが接続を閉じた場合はNone）"""
+    # AESによって暗号化されたヘッダー（３６バイト）、解読されたヘッダー（８バイト）の中にある、JSONサイズ（２バイト）、メディアタイプ（１バイト）、ファイルサイズ（５バイト）
+    try:
+        encrypted_header = await reader.readexactly(8 + 12 + 16)
+    except asyncio.IncompleteReadError as eof:
+        if eof.partial:
+            raise
+        return None
+    decrypted_header = session.decrypt(encrypted_header)
+    json_size = int.from_bytes(decrypted_header[:2], 'big')
+    mediatype_size = int.from_bytes(decrypted_header[2:3], 'big')
+    file_size = int.from_bytes(decrypted_header[3:], 'big')
+
+    # ファイルサイズが0の場合はエラーとして扱う
+    if file_size <= 0:
+        raise Exception('ファイルサイズが無効です')
+
+    decrypted_req_params = session.decrypt(await reader.readexactly(json_size + 12 + 16)).decode('utf-8')
+    decrypted_mediatype = session.decrypt(await reader.readexactly(mediatype_size + 12 + 16)).decode('utf-8')
+
+    # メディアタイプはファイル名の拡張子になるため、英数字以外を含むものは受け付けない
+    if not MEDIATYPE_PATTERN.match(decrypted_mediatype):
+        raise Exception('メディアタイプが無効です')
+
+    filename = f'{uuid.uuid4().hex}.{decrypted_mediatype}'
+
+    req_data = json.loads(decrypted_req_params)
+    action = req_data.get('action', 0)
+
+    print(f"受信したアクション: {action}" + (f"（ジョブID: {req_data['job_id']}）" if 'job_id' in req_data else ''))
+
+    # クライアントが求めた場合は、次回の接続でRSAの鍵交換を省略するためのセッションチケットを送る
+    if req_data.get('session_ticket'):
+        if server.global_ticket_manager is None:
+            encrypted_ticket = session.encrypt(b'')
+        else:
+            resumption_secret, expires_at, ticket = server.global_ticket_manager.issue()
+            encrypted_ticket = session.encrypt(resumption_secret + expires_at.to_bytes(8, 'big') + ticket)
+        writer.write(len(encrypted_ticket).to_bytes(4, 'big') + encrypted_ticket)
+        await writer.drain()
+
+    # クライアントがフレームサイズを指定した場合は、このセッションのアップロードで使うフレームサイズを決めて返す
+    frame_size = config['stream_rate']
+    if 'frame_size' in req_data:
+        frame_size = negotiate_frame_size(config, req_data['frame_size'])
+        encrypted_frame_size = session.encrypt(frame_size.to_bytes(4, 'big'))
+        writer.write(len(encrypted_frame_size).to_bytes(4, 'big') + encrypted_frame_size)
+        await writer.drain()
+
+    # クライアントが事前検証を求めた場合は、ファイルの先頭部分でジョブを検証し、受け付けない場合はアップロードを受信しない
+    if req_data.get('preflight'):
+        preflight_error = await run_preflight(reader, writer, session, req_data, decrypted_mediatype, file_size)
+        if preflight_error is not None:
+            job = ClientJob(req_data, filename, frame_size)
+            job.error = preflight_error
+            return job
+
+    # このサーバーは重複排除に対応していないため、SHA-256が通知された場合は常にアップロードを求める
+    if 'sha256' in req_data:
+        encrypted_reply = session.encrypt(b'\x00')
+        writer.write(len(encrypted_reply).to_bytes(4, 'big') + encrypted_reply)
+        await writer.drain()
+
+    # 再開可能なアップロードにも対応していないため、アップロードIDが指定された場合は常に最初から受信する
+    if 'upload_id' in req_data:
+        encrypted_offset = session.encrypt((0).to_bytes(8, 'big'))
+        writer.write(len(encrypted_offset).to_bytes(4, 'big') + encrypted_offset)
+        await writer.drain()
+
+    job = ClientJob(req_data, filename, frame_size)
+
+    # 事前検証をしていない場合は、パラメータが不正であればアップロードを読み捨ててエラーを返す
+    if not req_data.get('preflight'):
+        job.error = validate_action_params(req_data, file_size)
+        if job.error is not None:
+            await discard_upload(reader, session, file_size, frame_size)
+            return job
+
+    try:
+        job.error = await store_uploaded_file_encrypted(config, reader, filename, file_size, session, frame_size)
+
+        endseconds = get_requested_endseconds(req_data)
+        if job.error is None and endseconds is not None:
+            duration_seconds = await get_video_duration(os.path.join(config['dir_path'], filename))
+            job.error = check_video_duration(duration_seconds, endseconds)
+
+    except BaseException:
+        # 受信中に接続が切れた場合などは、ジョブを実行しないため受信途中のファイルを削除する
+        await asyncio.to_thread(delete_job_files, config, job)
+        raise
+
+    return job
+
+async def run_preflight(reader, writer, session, req_data, mediatype, file_size):
+    """パラメータとファイルの先頭部分でジョブを検証し、それぞれの結果をクライアントに返す関数（server.pyのrun_preflightと同じ手順）"""
+    # パラメータが不正な場合は、クライアントは先頭部分も送らない
+    error = validate_action_params(req_data, file_size)
+    await send_preflight_reply(writer, error is None, session)
+    if error is not None:
+        print(f"事前検証: {error.to_json()}")
+        return error
+
+    head = session.decrypt(await reader.readexactly(min(PREFLIGHT_HEAD_SIZE, file_size) + 12 + 16))
+    # FFPROBEの実行でイベントループを止めないよう、別スレッドで検証する
+    error = await asyncio.to_thread(validate_upload_head, req_data, mediatype, head, file_size)
+
+    print(f"事前検証: {'受け付けます' if error is None else error.to_json()}")
+    await send_preflight_reply(writer, error is None, session)
+    return error
+
+async def send_preflight_reply(writer, accepted, session):
+    encrypted_reply = session.encrypt(b'\x01' if accepted else b'\x00')
+    writer.write(len(encrypted_reply).to_bytes(4, 'big') + encrypted_reply)
+    await writer.drain()
+
+async def execute_job(config, writer, session, job, ffmpeg_slots):
+    """受信済みのジョブを処理し、処理結果またはエラーのレスポンスを送る関数"""
+    error = job.error
+
+    try:
+        if error is None:
+            error = await run_action(config, writer, session, job, ffmpeg_slots)
+
+        if error is not None:
+            print(error.to_json())
+            await job.begin_response(writer, session)
+            await send_encrypted_error_response(writer, error, session)
+
+    finally:
+        # エラーで途中のファイルが残った場合も、ここでジョブのファイルをすべて削除する
+        await asyncio.to_thread(delete_job_files, config, job)
+
+def delete_job_files(config, job):
+    """ジョブの作業用ファイル（入力と、入力のuuidで始まる名前の出力）をすべて削除する関数
+
+    ディレクトリの走査と削除はディスクが遅い場合にイベントループを止めるため、asyncio.to_threadで呼び出す
+    """
+    key = StorageManager.job_key(job.filename)
+    delete_tmp_files([os.path.join(config['dir_path'], filename) for filename in os.listdir(config['dir_path']) if StorageManager.job_key(filename) == key])
+
+async def run_action(config, writer, session, job, ffmpeg_slots):
+    # 入力と出力のファイルは、execute_jobでまとめて削除する
+    action = job.action
+
+    if action == 7:
+        return await run_ladder_action(config, writer, session, job, ffmpeg_slots)
+
+    try:
+        processed_filename, output_path, ffmpeg_cmd = prepare_action(action, job.filename, config['dir_path'], job.req_data)
+        await run_ffmpeg(ffmpeg_cmd, ffmpeg_slots)
+        print(f'{ACTION_ERROR_INFO[action][0]}完了: {processed_filename}')
+
+    except Exception as process_err:
+        return create_action_error(action, process_err)
+
+    await job.begin_response(writer, session)
+    return await send_encrypted_response(writer, output_path, job.frame_size, session)
+
+async def run_ladder_action(config, writer, session, job, ffmpeg_slots):
+    # 1回のFFMPEGで複数の解像度（とオーディオ）を作成し、マルチパートのレスポンスとして送信する
+    try:
+        outputs, ffmpeg_cmd = build_ladder_command(job.filename, config['dir_path'], job.req_data)
+        await run_ffmpeg(ffmpeg_cmd, ffmpeg_slots)
+        print(f"{ACTION_ERROR_INFO[7][0]}完了: {', '.join(output_filename for _, output_filename, _ in outputs)}")
+
+    except Exception as process_err:
+        return create_action_error(7, process_err)
+
+    await job.begin_response(writer, session)
+    return await send_encrypted_multipart_response(writer, [(label, output_path) for label, _, output_path in outputs], job.frame_size, session)
+
+async def store_uploaded_file_encrypted(config, reader, filename, original_file_size, session, frame_size):
+    total_received = 0
+    try:
+        # ファイルを開く・書き込む・閉じる処理は、ディスクが遅い場合に他の接続の処理を止めないよう別スレッドで行う
+        f = await asyncio.to_thread(open, os.path.join(config['dir_path'], filename), 'wb+')
+        try:
+            while total_received < original_file_size:
+                remaining = original_file_size - total_received
+                chunk_size = min(frame_size, remaining)
+
+                encrypted_chunk = await reader.readexactly(chunk_size + 12 + 16)
+                # 復号に失敗した場合も、このフレームは読み取り済みとして残りを読み捨てる
+                total_received += chunk_size
+                decrypted_chunk = session.decrypt(encrypted_chunk)
+
+                await asyncio.to_thread(f.write, decrypted_chunk[:chunk_size])
+        finally:
+            await asyncio.to_thread(f.close)
+
+        print('ファイルのアップロードが完了しました。')
+        return None
+
+    except Exception as file_err:
+        print(f"File storage error: {file_err}")
+        await discard_upload(reader, session, original_file_size - total_received, frame_size)
+
+        return ErrorInfo('1001', 'ファイル保存中のエラー:' + str(file_err), '解決しない場合は管理者にお問い合わせください。')
+
+async def discard_upload(reader, session, remaining, frame_size):
+    """エラー時に残りのアップロードを読み捨てる関数
+
+    同じ接続で次のジョブを受け付けられるよう、読み捨てるフレームも復号してセッションのnonceを進める
+    """
+    try:
+        while remaining > 0:
+            chunk_size = min(frame_size, remaining)
+            frame = await reader.readexactly(chunk_size + 12 + 16)
+            remaining -= chunk_size
+            session.decrypt(frame)
+    except Exception:
+        pass
+
+# FFMPEG・FFPROBEの実行に関する関数はここから実装
+async def run_ffmpeg(ffmpeg_cmd:list, ffmpeg_slots:asyncio.Semaphore):
+    # 空きスロットができるまで待機し、イベントループを止めずにFFMPEGを実行する
+    async with ffmpeg_slots:
+        print(f"FFMPEG実行中: {' '.join(ffmpeg_cmd)}")
+        process = await asyncio.create_subprocess_exec(
+            *ffmpeg_cmd,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+        _, stderr = await process.communicate()
+
+    if process.returncode != 0:
+        raise Exception(f"FFMPEG エラー: {stderr}")
+
+async def get_video_duration(filepath:str):
+    process = await asyncio.create_subprocess_exec(
+        *build_duration_probe_command(filepath),
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+    stdout, _ = await process.communicate()
+
+    return float(stdout)
+
+# レスポンスに関係する関数はここから実装
+def write_frame(writer, session, data):
+    # ４バイトの長さ、nonce、暗号文＋タグを連結せずにトランスポートに渡す
+    nonce, sealed = session.seal(data)
+    writer.writelines([(len(nonce) + len(sealed)).to_bytes(4, 'big'), nonce, sealed])
+
+async def write_file_frames(writer, session, filepath, file_size, frame_size):
+    # ファイルをメモリマップし、frame_sizeごとのmemoryviewをそのまま暗号化して送る
+    if file_size > 0:
+        with open(filepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            with memoryview(mapped_file) as view:
+                for offset in range(0, file_size, frame_size):
+                    write_frame(writer, session, view[offset:offset + frame_size])
+                    # 送信バッファが溜まっている場合はクライアントの受信を待つ
+                    await writer.drain()
+
+async def send_encrypted_response(writer, filepath, frame_size, session):
+    try:
+        file_size = os.path.getsize(filepath)
+
+        # サクセスコード：１（１バイト)とSuccessInfoのJSON
+        write_frame(writer, session, b'\x01')
+        write_frame(writer, session, SuccessInfo(filepath, file_size).to_json().encode('utf-8'))
+
+        print(f"処理済みファイル（{file_size}バイト）を送信中")
+
+        await write_file_frames(writer, session, filepath, file_size, frame_size)
+        await writer.drain()
+
+        print("処理済みファイルの送信完了")
+        return None
+
+    except Exception as error:
+        print(f"ファイル送信エラー: {str(error)}")
+        return ErrorInfo('1004', f'ファイル送信エラー: {str(error)}', 'ネットワーク接続を確認してください。')
+
+async def send_encrypted_multipart_response(writer, outputs, frame_size, session):
+    # MultipartSuccessInfoのJSONの後に、各ファイルのデータをpartsの順に送る
+    try:
+        parts = [(label, filepath, os.path.getsize(filepath)) for label, filepath in outputs]
+
+        write_frame(writer, session, b'\x01')
+        write_frame(writer, session, MultipartSuccessInfo(parts).to_json().encode('utf-8'))
+
+        for label, filepath, file_size in parts:
+            print(f"処理済みファイル（{label}、{file_size}バイト）を送信中")
+            await write_file_frames(writer, session, filepath, file_size, frame_size)
+
+        await writer.drain()
+
+        print("処理済みファイルの送信完了")
+        return None
+
+    except Exception as error:
+        print(f"ファイル送信エラー: {str(error)}")
+        return ErrorInfo('1004', f'ファイル送信エラー: {str(error)}', 'ネットワーク接続を確認してください。')
+
+async def send_encrypted_error_response(writer, error_info, session):
+    try:
+        encrypted_header = session.encrypt(b'\x00')
+        writer.write(len(encrypted_header).to_bytes(4, 'big') + encrypted_header)
+
+        encrypted_json = session.encrypt(error_info.to_json().encode('utf-8'))
+        writer.write(len(encrypted_json).to_bytes(4, 'big') + encrypted_json)
+        await writer.drain()
+
+        print(f"暗号化されたエラーレスポンス送信: {error_info.error_code}")
+
+    except Exception as error:
+        print(f"暗号化エラーレスポンス送信失敗: {str(error)}")
+
+# メイン（エントリーポイント）
+async def serve_client(config, reader, writer, ffmpeg_slots):
+    client_address = writer.get_extra_info('peername')
+    print(f'{client_address}と接続しました。')
+
+    session = None
+
+    try:
+        aes_key, counter_nonces = await establish_aes_key(reader, writer)
+        # 以降の送受信はすべてこのセッションで暗号化・復号する
+        session = AeadSession(aes_key, counter_nonces)
+
+        await handle_client_request(config, reader, writer, session, ffmpeg_slots)
+
+    except Exception as e:
+        error = ErrorInfo('1002', str(e), '解決しない場合は管理者にお問い合わせください。')
+        print(error.to_json())
+        if session is not None:
+            await send_encrypted_error_response(writer, error, session)
+        else:
+            print("AES鍵が利用できないため、暗号化されていないエラーレスポンスを送信できません")
+
+    finally:
+        print(f'{client_address}とのコネクションを閉じます')
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+
+async def main():
+    server.initialize_rsa()
+
+    config = load_server_config()
+    server.initialize_session_tickets(config)
+    ffmpeg_slots = asyncio.Semaphore(config['ffmpeg_workers'])
+    print(f"FFMPEGワーカー数: {config['ffmpeg_workers']}")
+
+    async_server = await asyncio.start_server(
+        lambda reader, writer: serve_client(config, reader, writer, ffmpeg_slots),
+        config['server_address'],
+        config['server_port'],
+        backlog=config['backlog']
+    )
+    print('サーバーが起動します。クライアントからの接続を待ちます。')
+
+    async with async_server:
+        await async_server.serve_forever()
+
+if __name__ == '__main__':
+    asyncio.run(main())
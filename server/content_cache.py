@@ -0,0 +1,141 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+
+class ContentCache:
+    """内容のハッシュをキーにファイルを保存するキャッシュ
+
+    処理結果（入力のハッシュと処理パラメータがキー）と、アップロード済みの入力（入力のハッシュがキー）の保存に使う
+    容量を超えた場合は最後に使われた時刻が古いものから削除する（使用中のファイルは削除しない）
+    """
+    def __init__(self, cache_dir, max_bytes) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # キー -> (ファイル名, サイズ)、末尾ほど最近使われたもの
+        self.entries = OrderedDict()
+        # 送信中のキー -> 参照数
+        self.pinned = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.load_entries()
+
+    @staticmethod
+    def make_key(input_hash:str, action_params:dict) -> str:
+        params_json = json.dumps(action_params, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(f'{input_hash}:{params_json}'.encode('utf-8')).hexdigest()
+
+    def load_entries(self):
+        """起動時にキャッシュディレクトリ内のファイルを最終アクセス時刻順に読み込む関数"""
+        cached_files = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_file() or entry.name.endswith('.tmp'):
+                continue
+            key = entry.name.split('.')[0]
+            stat = entry.stat()
+            cached_files.append((stat.st_atime, key, entry.name, stat.st_size))
+
+        for _, key, filename, size in sorted(cached_files):
+            self.entries[key] = (filename, size)
+            self.total_bytes += size
+
+        self.evict()
+
+    def lookup(self, key):
+        """キャッシュ済みのファイルパスを返す関数（見つかった場合はreleaseを呼ぶまで削除されない）"""
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            self.pinned[key] = self.pinned.get(key, 0) + 1
+            filename, _ = self.entries[key]
+
+        return os.path.join(self.cache_dir, filename)
+
+    def release(self, key):
+        with self.lock:
+            count = self.pinned.get(key, 0) - 1
+            if count > 0:
+                self.pinned[key] = count
+            else:
+                self.pinned.pop(key, None)
+            self.evict()
+
+    def store(self, key, filepath, link=False):
+        """ファイルをキャッシュに移動してパスを返す関数（lookupと同様にreleaseが必要）
+
+        linkがTrueの場合は元のファイルを残し、ハードリンク（できない場合はコピー）でキャッシュに追加する
+        """
+        file_extension = os.path.splitext(filepath)[1]
+        filename = f'{key}{file_extension}'
+        cache_path = os.path.join(self.cache_dir, filename)
+        size = os.path.getsize(filepath)
+
+        with self.lock:
+            if link and key in self.entries:
+                # 同じ内容のファイルは既にあるため、使用順のみ更新する
+                self.entries.move_to_end(key)
+                self.pinned[key] = self.pinned.get(key, 0) + 1
+                return os.path.join(self.cache_dir, self.entries[key][0])
+
+            if link:
+                link_or_copy(filepath, cache_path)
+            else:
+                os.replace(filepath, cache_path)
+
+            if key in self.entries:
+                self.total_bytes -= self.entries[key][1]
+            self.entries[key] = (filename, size)
+            self.entries.move_to_end(key)
+            self.total_bytes += size
+            self.pinned[key] = self.pinned.get(key, 0) + 1
+            self.evict()
+
+        return cache_path
+
+    def evict(self):
+        # lockを保持した状態で呼び出すこと
+        for key in list(self.entries):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if key in self.pinned:
+                continue
+
+            filename, size = self.entries.pop(key)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(os.path.join(self.cache_dir, filename))
+            except FileNotFoundError:
+                pass
+            print(f"キャッシュから削除しました: {filename}")
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+def link_or_copy(source_path, destination_path):
+    """ハードリンクを作成する関数（別のファイルシステムなどでリンクできない場合はコピーする）"""
+    try:
+        if os.path.exists(destination_path):
+            os.remove(destination_path)
+        os.link(source_path, destination_path)
+    except OSError:
+        shutil.copyfile(source_path, destination_path)
@@ -0,0 +1,136 @@
+import time
+import itertools
+import threading
+
+# 優先度のクラス（値が小さいほど先に実行する）
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_BATCH: 'batch'}
+# バッチのジョブがこの秒数以上待った場合は、インタラクティブのジョブと同じ順位で並べる（ただし使える枠は増やさない）
+BATCH_PROMOTION_SECONDS = 300
+
+class AdmissionError(Exception):
+    """実行待ちのジョブが多すぎて、ジョブを受け付けられないことを表す例外"""
+    pass
+
+class JobTicket:
+    """受け付けたジョブ1つ分の実行の状態"""
+    def __init__(self, seq) -> None:
+        self.seq = seq
+        self.admitted_at = time.monotonic()
+        # acquireで決まる推定コスト、優先度、FFMPEGのスレッド数
+        self.cost = None
+        self.priority = None
+        self.threads = None
+        self.running = False
+
+    @property
+    def priority_name(self):
+        return PRIORITY_NAMES.get(self.priority)
+
+class JobScheduler:
+    """FFMPEGを実行するジョブの順番とスレッド数を決め、新しいジョブを受け付けるかを判定するクラス
+
+    推定コストがinteractive_cost以下のジョブはインタラクティブ、それより大きいジョブはバッチとして扱い、
+    空いた実行枠はインタラクティブのジョブから順に割り当てる
+    max_runningが2以上の場合、バッチのジョブは1枠を残して実行し、短いジョブが長いエンコードの後ろで待たないようにする
+    各ジョブのFFMPEGには、cpu_budgetを実行枠の数で割ったスレッド数を割り当てる
+    受け付けの際は、実行待ちのジョブの数がmax_queuedに達している場合に拒否する（保存領域の空きはStorageManagerで判定する）
+    """
+    def __init__(self, cpu_budget, max_running, max_queued, interactive_cost) -> None:
+        self.cpu_budget = cpu_budget
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.interactive_cost = interactive_cost
+        self.threads_per_job = max(cpu_budget // max_running, 1)
+        self.batch_slots = max(max_running - 1, 1)
+
+        self.sequence = itertools.count()
+        # 受け付け済みで、まだ実行していないジョブ
+        self.waiting = []
+        self.running_tickets = []
+        self.admitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.condition = threading.Condition()
+
+    def admit(self):
+        """ジョブを受け付けてJobTicketを返す関数（受け付けられない場合はAdmissionError）"""
+        with self.condition:
+            if len(self.waiting) >= self.max_queued:
+                self.rejected += 1
+                raise AdmissionError(f'実行待ちのジョブが上限（{self.max_queued}件）に達しています')
+
+            ticket = JobTicket(next(self.sequence))
+            self.waiting.append(ticket)
+            self.admitted += 1
+            return ticket
+
+    def classify(self, cost) -> int:
+        return PRIORITY_INTERACTIVE if cost <= self.interactive_cost else PRIORITY_BATCH
+
+    def order_key(self, ticket, now):
+        priority = ticket.priority
+        if priority == PRIORITY_BATCH and now - ticket.admitted_at >= BATCH_PROMOTION_SECONDS:
+            priority = PRIORITY_INTERACTIVE
+        return priority, ticket.seq
+
+    def can_start(self, ticket) -> bool:
+        # conditionを保持した状態で呼び出すこと
+        if len(self.running_tickets) >= self.max_running:
+            return False
+        if ticket.priority == PRIORITY_BATCH:
+            running_batch = sum(1 for running in self.running_tickets if running.priority == PRIORITY_BATCH)
+            return running_batch < self.batch_slots
+        return True
+
+    def next_ticket(self):
+        # 実行できるジョブのうち、最も順位が高いもの（conditionを保持した状態で呼び出すこと）
+        now = time.monotonic()
+        ready = [ticket for ticket in self.waiting if ticket.priority is not None and self.can_start(ticket)]
+        return min(ready, key=lambda ticket: self.order_key(ticket, now), default=None)
+
+    def acquire(self, ticket, cost):
+        """推定コストから優先度を決め、実行枠が割り当てられるまで待機する関数（FFMPEGのスレッド数を返す）"""
+        with self.condition:
+            ticket.cost = cost
+            ticket.priority = self.classify(cost)
+            # バッチの昇格を反映するため、一定時間ごとに順番を見直す
+            while self.next_ticket() is not ticket:
+                self.condition.wait(timeout=BATCH_PROMOTION_SECONDS / 10)
+
+            self.waiting.remove(ticket)
+            self.running_tickets.append(ticket)
+            ticket.running = True
+            ticket.threads = self.threads_per_job
+            # 実行枠がまだ空いている場合は、次のジョブも開始できるようにする
+            self.condition.notify_all()
+            return ticket.threads
+
+    def release(self, ticket):
+        """FFMPEGの実行が終わった時点で、実行枠を次のジョブに渡す関数"""
+        with self.condition:
+            if ticket.running:
+                self.running_tickets.remove(ticket)
+                ticket.running = False
+                self.completed += 1
+                self.condition.notify_all()
+
+    def finish(self, ticket):
+        """ジョブの終了時（実行しなかった場合も含む）に、実行枠を解放して実行待ちから取り除く関数"""
+        self.release(ticket)
+
+        with self.condition:
+            if ticket in self.waiting:
+                self.waiting.remove(ticket)
+                self.condition.notify_all()
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {
+                'running': len(self.running_tickets),
+                'waiting': len(self.waiting),
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'completed': self.completed
+            }
@@ -0,0 +1,165 @@
+import os
+import json
+import subprocess
+import threading
+from collections import OrderedDict
+
+# メモリ上に保持するメタデータの最大件数（それ以外はstorage_dir内のJSONから読み込む）
+MAX_MEMORY_ENTRIES = 1024
+
+def build_media_probe_command(filepath:str):
+    # コンテナとストリームの情報をJSONで取得する
+    return [
+        'ffprobe',
+        '-v', 'quiet',
+        '-print_format', 'json',
+        '-show_format',
+        '-show_streams',
+        filepath
+    ]
+
+def build_keyframe_probe_command(filepath:str):
+    # 映像のパケットのうちキーフレームの時刻を取得する（デコードせずにパケットのフラグのみを読む）
+    return [
+        'ffprobe',
+        '-v', 'quiet',
+        '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts_time,flags',
+        '-of', 'csv=p=0',
+        filepath
+    ]
+
+def parse_number(value, number_type=float):
+    try:
+        return number_type(value)
+    except (TypeError, ValueError):
+        return None
+
+def parse_frame_rate(value):
+    # '30000/1001'のような表記を小数にする
+    try:
+        numerator, denominator = (int(part) for part in str(value).split('/'))
+        return numerator / denominator if denominator else None
+    except ValueError:
+        return None
+
+def probe_media(filepath:str) -> dict:
+    """ffprobeで入力ファイルのメタデータ（長さ、コンテナ、コーデック、解像度、ビットレート、キーフレーム、音声の構成）を取得する関数"""
+    result = subprocess.run(build_media_probe_command(filepath), capture_output=True)
+    if result.returncode != 0:
+        raise Exception(f"FFPROBE エラー: {result.stderr}")
+    probed = json.loads(result.stdout)
+
+    format_info = probed.get('format', {})
+    streams = probed.get('streams', [])
+    video_stream = next((stream for stream in streams if stream.get('codec_type') == 'video'), None)
+    audio_stream = next((stream for stream in streams if stream.get('codec_type') == 'audio'), None)
+
+    media_info = {
+        'duration': parse_number(format_info.get('duration')),
+        'container': format_info.get('format_name'),
+        'size': parse_number(format_info.get('size'), int),
+        'bit_rate': parse_number(format_info.get('bit_rate'), int),
+        'video': None,
+        'audio': None,
+        'keyframes': []
+    }
+
+    if video_stream is not None:
+        media_info['video'] = {
+            'codec': video_stream.get('codec_name'),
+            'width': video_stream.get('width'),
+            'height': video_stream.get('height'),
+            'pix_fmt': video_stream.get('pix_fmt'),
+            'frame_rate': parse_frame_rate(video_stream.get('avg_frame_rate')),
+            'bit_rate': parse_number(video_stream.get('bit_rate'), int)
+        }
+
+        result = subprocess.run(build_keyframe_probe_command(filepath), capture_output=True, text=True)
+        for line in result.stdout.splitlines():
+            pts_time, _, flags = line.partition(',')
+            if 'K' in flags and parse_number(pts_time) is not None:
+                media_info['keyframes'].append(float(pts_time))
+
+    if audio_stream is not None:
+        media_info['audio'] = {
+            'codec': audio_stream.get('codec_name'),
+            'channels': audio_stream.get('channels'),
+            'channel_layout': audio_stream.get('channel_layout'),
+            'sample_rate': parse_number(audio_stream.get('sample_rate'), int),
+            'bit_rate': parse_number(audio_stream.get('bit_rate'), int)
+        }
+
+    return media_info
+
+class MediaIndex:
+    """入力のハッシュをキーに、入力ファイルのメタデータを保持する索引
+
+    アップロードを保存した時点で1回だけffprobeを実行し、結果をメモリとindex_dir内のJSON（<ハッシュ>.json）に保存する
+    以降の検証や処理の計画では、ffprobeを実行せずにこの索引を参照する
+    """
+    def __init__(self, index_dir) -> None:
+        self.index_dir = index_dir
+        # ハッシュ -> メタデータ、末尾ほど最近使われたもの
+        self.entries = OrderedDict()
+        self.probes = 0
+        self.hits = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(self.index_dir, exist_ok=True)
+
+    def entry_path(self, input_hash):
+        return os.path.join(self.index_dir, f'{input_hash}.json')
+
+    def lookup(self, input_hash):
+        """索引済みのメタデータを返す関数（ない場合はNone）"""
+        with self.lock:
+            if input_hash in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(input_hash)
+                return self.entries[input_hash]
+
+        try:
+            with open(self.entry_path(input_hash), 'r', encoding='utf-8') as f:
+                media_info = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        with self.lock:
+            self.hits += 1
+            self.remember(input_hash, media_info)
+        return media_info
+
+    def index(self, input_hash, filepath):
+        """入力ファイルのメタデータを返す関数（未索引の場合はffprobeで取得して保存する）"""
+        media_info = self.lookup(input_hash)
+        if media_info is not None:
+            return media_info
+
+        media_info = probe_media(filepath)
+
+        # 書き込み途中のJSONを読まないよう、一時ファイルに書いてから置き換える
+        entry_path = self.entry_path(input_hash)
+        with open(entry_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(media_info, f)
+        os.replace(entry_path + '.tmp', entry_path)
+
+        with self.lock:
+            self.probes += 1
+            self.remember(input_hash, media_info)
+        return media_info
+
+    def remember(self, input_hash, media_info):
+        # lockを保持した状態で呼び出すこと
+        self.entries[input_hash] = media_info
+        self.entries.move_to_end(input_hash)
+        while len(self.entries) > MAX_MEMORY_ENTRIES:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'memory_entries': len(self.entries),
+                'probes': self.probes,
+                'hits': self.hits
+            }
@@ -0,0 +1,249 @@
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Prometheusのテキスト形式（バージョン0.0.4）で計測値を公開する
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 各段階（鍵交換、ヘッダーの復号、アップロード、レスポンスの送信）とFFMPEGの実行時間のバケット（秒）
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+# アップロードの速度のバケット（バイト/秒）
+THROUGHPUT_BUCKETS = (1e5, 1e6, 5e6, 1e7, 2.5e7, 5e7, 1e8, 2.5e8, 5e8, 1e9)
+# 実時間に対するエンコード速度（出力の長さ / 経過時間）のバケット
+REALTIME_FACTOR_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+
+def format_value(value) -> str:
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        if math.isnan(value):
+            return 'NaN'
+    return str(value)
+
+def format_labels(labels:dict) -> str:
+    if not labels:
+        return ''
+    escaped = (
+        f'{name}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for name, value in labels.items()
+    )
+    return '{' + ','.join(escaped) + '}'
+
+class Metric:
+    """ラベルの値の組み合わせごとに値を持つ計測値の基底クラス"""
+    metric_type = 'untyped'
+
+    def __init__(self, name, description, label_names=()) -> None:
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        # ラベルの値のタプル -> 値
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels:dict) -> tuple:
+        # ラベルが足りない場合はKeyError
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def snapshot(self):
+        with self.lock:
+            return sorted(self.values.items())
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.metric_type}']
+        for key, value in self.snapshot():
+            lines += self.render_sample(dict(zip(self.label_names, key)), value)
+        return lines
+
+    def render_sample(self, labels:dict, value) -> list:
+        return [f'{self.name}{format_labels(labels)} {format_value(value)}']
+
+class Counter(Metric):
+    """増える一方の計測値（処理したバイト数、エラーの回数など）"""
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """増減する計測値（処理中の接続の数、保存領域の使用量など）"""
+    metric_type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    """観測値の分布（バケットごとの累積の件数、合計、件数）"""
+    metric_type = 'histogram'
+
+    def __init__(self, name, description, label_names=(), buckets=SECONDS_BUCKETS) -> None:
+        super().__init__(name, description, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                # [バケットごとの件数, 件数, 合計]
+                state = self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            state[1] += 1
+            state[2] += value
+
+    def snapshot(self):
+        with self.lock:
+            return sorted((key, [list(state[0]), state[1], state[2]]) for key, state in self.values.items())
+
+    def render_sample(self, labels:dict, value) -> list:
+        bucket_counts, count, total = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, bucket_counts):
+            cumulative += bucket_count
+            lines.append(f'{self.name}_bucket{format_labels({**labels, "le": format_value(float(bound))})} {cumulative}')
+        lines.append(f'{self.name}_bucket{format_labels({**labels, "le": "+Inf"})} {count}')
+        lines.append(f'{self.name}_sum{format_labels(labels)} {format_value(total)}')
+        lines.append(f'{self.name}_count{format_labels(labels)} {count}')
+        return lines
+
+class MetricsRegistry:
+    """計測値をまとめて、Prometheusのテキスト形式で出力するクラス
+
+    add_collectorで登録した関数は出力のたびに呼び出し、返された計測値（他のクラスのstatsから作るものなど）も出力する
+    """
+    def __init__(self) -> None:
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, description, label_names=()) -> Counter:
+        return self.register(Counter(name, description, label_names))
+
+    def gauge(self, name, description, label_names=()) -> Gauge:
+        return self.register(Gauge(name, description, label_names))
+
+    def histogram(self, name, description, label_names=(), buckets=SECONDS_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, description, label_names, buckets))
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        for collector in self.collectors:
+            try:
+                collected = collector()
+            except Exception as e:
+                print(f"計測値の収集中にエラーが発生しました: {e}")
+                continue
+            for metric in collected:
+                lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+class ServerMetrics(MetricsRegistry):
+    """server.pyの各段階の計測値"""
+    def __init__(self) -> None:
+        super().__init__()
+        self.stage_seconds = self.histogram(
+            'videocompressor_stage_seconds',
+            'リクエストの各段階（handshake、header、upload、response）にかかった時間（秒）',
+            ('stage',)
+        )
+        self.upload_bytes = self.counter(
+            'videocompressor_upload_bytes_total',
+            '受信したアップロードのバイト数',
+            ('mode',)
+        )
+        self.upload_throughput = self.histogram(
+            'videocompressor_upload_throughput_bytes_per_second',
+            'アップロード1件あたりの受信速度（バイト/秒、ストリーミング入力ではFFMPEGの処理速度に制限される）',
+            ('mode',),
+            THROUGHPUT_BUCKETS
+        )
+        self.response_bytes = self.counter(
+            'videocompressor_response_bytes_total',
+            '送信した処理済みファイルのバイト数'
+        )
+        self.ffmpeg_seconds = self.histogram(
+            'videocompressor_ffmpeg_seconds',
+            'アクションごとのFFMPEGの実行時間（秒、実行枠の待ち時間を除く）',
+            ('action',)
+        )
+        self.ffmpeg_cpu_seconds = self.histogram(
+            'videocompressor_ffmpeg_cpu_seconds',
+            'アクションごとの、このサーバーで実行したFFMPEGのCPU時間（秒、ワーカーで実行した分は含まない）',
+            ('action',)
+        )
+        self.ffmpeg_realtime_factor = self.histogram(
+            'videocompressor_ffmpeg_realtime_factor',
+            'アクションごとの、出力の長さをFFMPEGの実行時間で割った値（1より大きいほど実時間より速い）',
+            ('action',),
+            REALTIME_FACTOR_BUCKETS
+        )
+        self.jobs = self.counter(
+            'videocompressor_jobs_total',
+            '処理したジョブの数',
+            ('action', 'status')
+        )
+        self.errors = self.counter(
+            'videocompressor_errors_total',
+            'エラーコードごとのエラーレスポンスの数',
+            ('error_code',)
+        )
+        self.connections_in_flight = self.gauge(
+            'videocompressor_connections_in_flight',
+            '処理中の接続の数'
+        )
+        self.uploads_in_flight = self.gauge(
+            'videocompressor_uploads_in_flight',
+            '受信中のアップロードの数'
+        )
+        self.ffmpeg_in_flight = self.gauge(
+            'videocompressor_ffmpeg_in_flight',
+            'このサーバーで実行中のFFMPEGのプロセスの数'
+        )
+
+def start_metrics_server(registry, address, port):
+    """registryの計測値をhttp://address:port/metricsで公開するHTTPサーバーを、別スレッドで開始する関数"""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # 収集のたびにアクセスログを出さない
+            pass
+
+    http_server = ThreadingHTTPServer((address, port), MetricsHandler)
+    http_server.daemon_threads = True
+    threading.Thread(target=http_server.serve_forever, daemon=True, name='metrics').start()
+    return http_server
@@ -0,0 +1,157 @@
+import os
+import re
+import json
+import time
+import threading
+
+# アップロードIDはクライアントが生成するUUID（16進数32文字）
+UPLOAD_ID_PATTERN = re.compile(r'[0-9a-f]{32}')
+
+class UploadSession:
+    """再開可能なアップロード1件分の途中経過を管理するクラス
+
+    受信したデータは partial_dir/<upload_id>.<拡張子> に追記し、
+    fsync済みのバイト数とチャンク数を partial_dir/<upload_id>.json にチェックポイントとして保存する
+    """
+    def __init__(self, partial_dir, upload_id, file_size, mediatype) -> None:
+        self.upload_id = upload_id
+        self.file_size = file_size
+        self.mediatype = mediatype
+        self.data_path = os.path.join(partial_dir, f'{upload_id}.{mediatype}')
+        self.checkpoint_path = os.path.join(partial_dir, f'{upload_id}.json')
+        # fsync済みのバイト数と、それまでに受信したチャンク数
+        self.bytes_written = 0
+        self.chunks_written = 0
+        # 前回のチェックポイント以降に書き込んだ（まだfsyncしていない）バイト数とチャンク数
+        self.pending_bytes = 0
+        self.pending_chunks = 0
+
+        self.load_checkpoint()
+
+    def load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+                checkpoint = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+
+        # ファイルサイズや形式が異なる場合は別のファイルとみなし、最初から受信する
+        if checkpoint.get('file_size') != self.file_size or checkpoint.get('mediatype') != self.mediatype:
+            print(f"アップロード {self.upload_id} のチェックポイントが一致しないため、最初から受信します")
+            return
+        if not os.path.exists(self.data_path) or os.path.getsize(self.data_path) < checkpoint['bytes_written']:
+            return
+
+        self.bytes_written = checkpoint['bytes_written']
+        self.chunks_written = checkpoint['chunks_written']
+
+    def open_data_file(self, buffering=-1):
+        """チェックポイントの位置から追記するためにファイルを開く関数（チェックポイント以降の未確定のデータは捨てる）"""
+        f = open(self.data_path, 'r+b' if os.path.exists(self.data_path) else 'w+b', buffering=buffering)
+        f.truncate(self.bytes_written)
+        f.seek(self.bytes_written)
+        return f
+
+    def read_written_data(self, chunk_size=1024 * 1024):
+        """再開時にハッシュを計算し直すため、受信済みのデータを先頭から返すジェネレータ"""
+        remaining = self.bytes_written
+        with open(self.data_path, 'rb') as f:
+            while remaining > 0:
+                data = f.read(min(chunk_size, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+
+    def advance(self, size):
+        self.pending_bytes += size
+        self.pending_chunks += 1
+
+    def checkpoint(self, f):
+        """書き込み済みのデータをディスクに確定させ、その位置をチェックポイントとして保存する関数"""
+        f.flush()
+        os.fsync(f.fileno())
+
+        self.bytes_written += self.pending_bytes
+        self.chunks_written += self.pending_chunks
+        self.pending_bytes = 0
+        self.pending_chunks = 0
+
+        checkpoint = {
+            'upload_id': self.upload_id,
+            'file_size': self.file_size,
+            'mediatype': self.mediatype,
+            'bytes_written': self.bytes_written,
+            'chunks_written': self.chunks_written,
+            'updated_at': time.time()
+        }
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as cf:
+            json.dump(checkpoint, cf)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def complete(self, destination_path):
+        """受信完了したファイルを作業用のパスに移動し、チェックポイントを削除する関数"""
+        os.replace(self.data_path, destination_path)
+        try:
+            os.remove(self.checkpoint_path)
+        except FileNotFoundError:
+            pass
+
+class ResumableUploadManager:
+    """再開可能なアップロードのセッションと、放置された途中のアップロードの削除を管理するクラス"""
+    def __init__(self, partial_dir, expiry_seconds, checkpoint_bytes) -> None:
+        self.partial_dir = partial_dir
+        self.expiry_seconds = expiry_seconds
+        self.checkpoint_bytes = checkpoint_bytes
+        # 受信中のアップロードID（同じIDの同時受信を防ぐ）
+        self.active_upload_ids = set()
+        self.lock = threading.Lock()
+
+        os.makedirs(self.partial_dir, exist_ok=True)
+
+    def acquire(self, upload_id, file_size, mediatype) -> UploadSession:
+        if not isinstance(upload_id, str) or not UPLOAD_ID_PATTERN.fullmatch(upload_id):
+            raise ValueError(f'アップロードIDが無効です: {upload_id}')
+
+        with self.lock:
+            if upload_id in self.active_upload_ids:
+                raise ValueError(f'アップロード {upload_id} は別の接続で受信中です')
+            self.active_upload_ids.add(upload_id)
+
+        try:
+            return UploadSession(self.partial_dir, upload_id, file_size, mediatype)
+        except Exception:
+            self.release(upload_id)
+            raise
+
+    def release(self, upload_id):
+        with self.lock:
+            self.active_upload_ids.discard(upload_id)
+
+    def remove_expired(self):
+        """最後のチェックポイントからexpiry_seconds以上経過した途中のアップロードを削除する関数"""
+        now = time.time()
+        for entry in os.scandir(self.partial_dir):
+            upload_id = entry.name.split('.')[0]
+            with self.lock:
+                if upload_id in self.active_upload_ids:
+                    continue
+                try:
+                    if now - entry.stat().st_mtime < self.expiry_seconds:
+                        continue
+                    os.remove(entry.path)
+                    print(f"期限切れの途中のアップロードを削除しました: {entry.name}")
+                except FileNotFoundError:
+                    pass
+
+    def start_expiry_sweeper(self, interval_seconds):
+        def sweep():
+            while True:
+                try:
+                    self.remove_expired()
+                except Exception as e:
+                    print(f"途中のアップロードの削除に失敗: {e}")
+                time.sleep(interval_seconds)
+
+        threading.Thread(target=sweep, daemon=True, name='upload-expiry').start()
@@ -1,28 +1,71 @@
 import socket
 import os
+import re
 import json
 import uuid
 import subprocess
+import hashlib
+import itertools
+import mmap
+import time
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.backends import default_backend
+
+from content_cache import ContentCache, link_or_copy
+from job_scheduler import JobScheduler, AdmissionError
+from media_index import MediaIndex, parse_number
+from metrics import ServerMetrics, Counter, Gauge, start_metrics_server
+from resumable_upload import ResumableUploadManager
+from session_crypto import AeadSession, NONCE_SIZE, TAG_SIZE, parse_key_message, parse_nonce_mode
+from session_ticket import SessionTicketManager, MAX_TICKET_SIZE, SESSION_RANDOM_SIZE, derive_resumed_key
+from storage_manager import StorageManager, StorageError, preallocate_file
+from worker_pool import WorkerPool, WorkerTask, WorkerError
 
 class SuccessInfo:
-    def __init__(self, filepath, file_size) -> None:
+    def __init__(self, filepath, file_size, streaming=False) -> None:
         self.filepath = filepath
         self.file_size = file_size
+        # Trueの場合、file_sizeは未確定(None)で、最終サイズは末尾のトレーラーで通知する
+        self.streaming = streaming
 
     @property
     def file_extension(self):
         return os.path.splitext(self.filepath)[1].lstrip('.')
 
     def to_dict(self):
-        return {
+        success_dict = {
             'status_code': 'success',
             'file_extension': self.file_extension,
             'file_size': self.file_size
         }
+        if self.streaming:
+            success_dict['streaming'] = True
+        return success_dict
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), ensure_ascii=False)
+
+class MultipartSuccessInfo:
+    """複数の出力ファイルを返す場合のSuccessInfo（partsの順に、各ファイルのデータを続けて送信する）"""
+    def __init__(self, parts) -> None:
+        # [(ラベル, ファイルパス, ファイルサイズ)]
+        self.parts = parts
+
+    def to_dict(self):
+        return {
+            'status_code': 'success',
+            'parts': [
+                {
+                    'rendition': label,
+                    'file_extension': SuccessInfo(filepath, file_size).file_extension,
+                    'file_size': file_size
+                }
+                for label, filepath, file_size in self.parts
+            ]
+        }
 
     def to_json(self):
         return json.dumps(self.to_dict(), ensure_ascii=False)
@@ -49,20 +92,108 @@ def create_server_socket(config):
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     sock.bind((config['server_address'], config['server_port']))
-    sock.listen(1)
+    sock.listen(config['backlog'])
     print('サーバーが起動します。クライアントからの接続を待ちます。')
     return sock
 
+# 処理結果のキャッシュ（result_cacheが無効の場合はNone）
+global_result_cache = None
+# 重複排除のために保存するアップロード済みの入力（upload_dedupが無効の場合はNone）
+global_source_cache = None
+# 再開可能なアップロードの管理（resumable_uploadが無効の場合はNone）
+global_upload_manager = None
+# セッションチケットの発行・検証（session_ticketが無効の場合はNone）
+global_ticket_manager = None
+# 入力ファイルのメタデータの索引（media_indexが無効の場合はNone）
+global_media_index = None
+# FFMPEGを実行するジョブのスケジューラー（job_schedulerが無効の場合はNone）
+global_job_scheduler = None
+# FFMPEGのタスクを実行させるワーカー（workersが空の場合はNone）
+global_worker_pool = None
+# 作業用ファイルと保存領域の予約の管理
+global_storage_manager = None
+# 各段階の計測値（metrics_portを指定していない場合はNone）
+global_metrics = None
+
 # リクエストに関係する関数はここから実装
 def initialize_rsa():
     global global_rsa_manager
     global_rsa_manager = RSAManager()
     print("RSA鍵を生成")
 
-def exchange_public_keys(connection):
+def initialize_session_tickets(config):
+    global global_ticket_manager
+    if not config['session_ticket']:
+        return
+
+    global_ticket_manager = SessionTicketManager(config['session_ticket_lifetime'], config['ticket_key_rotation'])
+    print("セッションチケットを有効化")
+
+def recv_exact(connection, size, allow_eof=False):
+    """sizeバイトを受信する関数（allow_eofがTrueの場合、何も受信しないまま接続が閉じられたらNoneを返す）"""
+    data = b''
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            if allow_eof and not data:
+                return None
+            raise Exception("Connection closed unexpectedly")
+        data += chunk
+    return data
+
+def establish_aes_key(connection):
+    """セッションチケットまたはRSAの鍵交換で、このセッションのAES鍵を決める関数
+
+    クライアントが公開鍵の長さとして０を送った場合はセッションチケットによる再開とみなし、
+    チケットが使えない場合はそのまま同じ接続で公開鍵の交換（フルハンドシェイク）を行う
+    戻り値は（AES鍵, クライアントが通知したnonceのモードがカウンターか）
+    """
+    client_public_key_length = int.from_bytes(recv_exact(connection, 4), 'big')
+    if client_public_key_length == 0:
+        aes_key = resume_session(connection)
+        if aes_key is not None:
+            return aes_key
+        client_public_key_length = int.from_bytes(recv_exact(connection, 4), 'big')
+
+    exchange_public_keys(connection, client_public_key_length)
+    return receive_encrypted_aes_key(connection)
+
+def resume_session(connection):
+    """チケット（４バイトの長さ＋チケット）、クライアントの乱数、nonceのモード（１バイト）を受け取り、
+    再開できれば（AES鍵, カウンターのnonceを使うか）を返す関数
+
+    再開できる場合は0x01とサーバーの乱数を、できない場合は0x00を返す
+    """
+    ticket_length = int.from_bytes(recv_exact(connection, 4), 'big')
+    if ticket_length > MAX_TICKET_SIZE:
+        raise Exception('セッションチケットが長すぎます')
+    ticket = recv_exact(connection, ticket_length)
+    client_random = recv_exact(connection, SESSION_RANDOM_SIZE)
+    counter_nonces = parse_nonce_mode(recv_exact(connection, 1))
+
+    resumption_secret = global_ticket_manager.open(ticket) if global_ticket_manager is not None else None
+    if resumption_secret is None:
+        print("セッションチケットが無効なため、公開鍵の交換を行います")
+        connection.sendall(b'\x00')
+        return None
+
+    server_random = os.urandom(SESSION_RANDOM_SIZE)
+    connection.sendall(b'\x01' + server_random)
+    print("セッションチケットでセッションを再開")
+    return derive_resumed_key(resumption_secret, client_random, server_random), counter_nonces
+
+def send_session_ticket(connection, session):
+    # 次回の接続で使うセッションチケット（秘密値（３２バイト）、有効期限（８バイト）、チケット）を暗号化して送信
+    # チケットが無効な設定の場合は空のデータを送る
+    if global_ticket_manager is None:
+        session.send_frame(connection, b'')
+    else:
+        resumption_secret, expires_at, ticket = global_ticket_manager.issue()
+        session.send_frame(connection, resumption_secret + expires_at.to_bytes(8, 'big') + ticket)
+
+def exchange_public_keys(connection, client_public_key_length):
     try:
         # RSA公開鍵の取得（鍵の長さ（４バイト）、鍵）
-        client_public_key_length = int.from_bytes(connection.recv(4), 'big')
         client_public_key_pem = connection.recv(client_public_key_length).decode('utf-8')
         client_public_key = serialization.load_pem_public_key(client_public_key_pem.encode())
         print("クライアントの公開鍵をロード完了")
@@ -91,67 +222,148 @@ def receive_encrypted_aes_key(connection):
         if len(encrypted_aes_key) != encrypted_aes_key_size:
             raise Exception("受信したAES鍵が期待する長さを満たしません")
         
-        decrypted_aes_key = global_rsa_manager.decryptContent(encrypted_aes_key)
-        
-        return decrypted_aes_key
+        # AES鍵とnonceのモード（従来のクライアントはAES鍵のみ）
+        return parse_key_message(global_rsa_manager.decryptContent(encrypted_aes_key))
     
     except Exception as e:
         print(f"暗号化されたAES鍵の受信に失敗：{e}")
         raise
 
-def decrypt_chunk(encrypted_chunk, aes_key):
-    try:
-        nonce = encrypted_chunk[:12]
-
-        auth_tag = encrypted_chunk[-16:]
-
-        encrypted_data = encrypted_chunk[12:-16]
-
-        cipher = Cipher(
-            algorithms.AES(aes_key),
-            modes.GCM(nonce, auth_tag),
-            backend=default_backend()
-        )
-
-        decryptor = cipher.decryptor()
+def handle_client_request(config, connection, session):
+    """鍵交換の済んだ接続で、クライアントのジョブを順に処理する関数
 
-        decrypted_data = decryptor.update(encrypted_data) + decryptor.finalize()
+    req_dataのkeep_aliveがTrueのジョブは、レスポンスの後も接続を閉じずに次のジョブを受け付け、レスポンスの前にジョブIDのフレームを送る
+    pipelineもTrueのジョブは、クライアントがレスポンスを待たずに次のジョブ（または書き込み側のシャットダウン）を送るものとして、
+    FFMPEGの実行中に次のジョブのアップロードを受信し、それが終わってからこのジョブのレスポンスを送る
+    （ソケットへの送信は常にどちらか一方のスレッドだけが行う）
+    """
+    pending_job = None
 
-        return decrypted_data
-    
-    except Exception as e:
-        print(f"AES暗号化されたメッセージの解読に失敗：{e}")
-        raise
-
-def encrypt_chunk(chunk, aes_key):
-    try:
-        nonce = os.urandom(12)
-
-        cipher = Cipher(
-            algorithms.AES(aes_key),
-            modes.GCM(nonce),
-            default_backend()
-        )
-        encryptor = cipher.encryptor()
-
-        encrypted_chunk = encryptor.update(chunk) + encryptor.finalize()
-
-        auth_tag = encryptor.tag
-
-        return nonce + encrypted_chunk + auth_tag
-    
-    except Exception as e:
-        print(f"AES暗号化に失敗：{e}")
-        raise
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='pipelined-job') as job_executor:
+        try:
+            while True:
+                # パイプライン処理中のジョブがある場合は、そのレスポンスを送る前にアップロードをすべて受信するため、ストリーミング入力は使わない
+                job = receive_job(config, connection, session, allow_streaming_ingest=pending_job is None)
+                if job is None:
+                    break
 
+                # 前のジョブのレスポンスを先に送る
+                if pending_job is not None:
+                    try:
+                        finish_pending_job(pending_job)
+                    except BaseException:
+                        # このジョブは実行しないため、予約とファイルをここで解放する
+                        finish_job(job)
+                        raise
+                    pending_job = None
+
+                if job.pipelined:
+                    job.future = job_executor.submit(execute_job, config, connection, session, job)
+                    pending_job = job
+                else:
+                    execute_job(config, connection, session, job)
 
-def handle_client_request(config, connection):
-    client_public_key = exchange_public_keys(connection)
-    aes_key = receive_encrypted_aes_key(connection)
+                if not job.keep_alive:
+                    break
 
+        finally:
+            if pending_job is not None:
+                finish_pending_job(pending_job)
+
+class ClientJob:
+    """1つのジョブ（リクエスト、受信したアップロード、受信時のエラー）を保持するクラス"""
+    def __init__(self, connection, session, req_data, filename, inputfile_path, frame_size) -> None:
+        self.connection = connection
+        self.session = session
+        self.req_data = req_data
+        self.action = req_data.get('action', 0)
+        self.job_id = req_data.get('job_id')
+        self.filename = filename
+        self.inputfile_path = inputfile_path
+        # 作業用ファイルの名前の先頭（入力のuuid）で、このジョブのファイルと保存領域の予約を管理する
+        self.storage_key = filename.split('.')[0]
+        self.frame_size = frame_size
+        self.keep_alive = bool(req_data.get('keep_alive', False))
+        # ストリーミングレスポンスはFFMPEGの実行中に送信するため、パイプライン処理の対象外
+        self.pipelined = self.keep_alive and bool(req_data.get('pipeline', False)) and not req_data.get('stream_response', False)
+
+        self.upload = None
+        # 確保した再開可能なアップロード（受信を終えるまで、同じアップロードIDを他の接続で使わせない）
+        self.upload_session = None
+        self.input_chunks = None
+        self.input_tee = None
+        # 索引から取得した入力のメタデータ（ストリーミング入力の場合や索引が無効の場合はNone）
+        self.media_info = None
+        # スケジューラーが受け付けたジョブ（スケジューラーが無効の場合や、受け付ける前のエラーの場合はNone）
+        self.ticket = None
+        self.error = None
+        self.future = None
+
+        # レスポンスを送ってよいか（パイプライン処理では次のジョブの受信が終わるまで待つ）
+        self.response_turn = threading.Event()
+        if not self.pipelined:
+            self.response_turn.set()
+        self.response_started = False
+        # クライアントが進捗のフレームを求めたか（ストリーミングレスポンスでは出力そのものが届くため送らない）
+        self.progress = bool(req_data.get('progress', False)) and not req_data.get('stream_response', False)
+        self.progress_sent_at = 0
+
+    def begin_response(self):
+        """レスポンスを送る直前に呼び出す関数（送信の順番を待ち、keep_aliveの場合はジョブIDのフレームを送る）"""
+        if self.response_started:
+            return
+        self.response_turn.wait()
+        self.response_started = True
+
+        if self.keep_alive:
+            self.session.send_frame(self.connection, json.dumps({'job_id': self.job_id}).encode('utf-8'))
+
+    def send_progress(self, progress:dict):
+        """エンコードの進捗のフレームを送る関数
+
+        前回の送信からPROGRESS_INTERVAL秒経っていない場合と、パイプライン処理でまだレスポンスを送る順番でない場合は送らない
+        （FFMPEGの出力を読むスレッドから呼ばれるため、順番を待たずに戻る）
+        """
+        now = time.monotonic()
+        if now - self.progress_sent_at < PROGRESS_INTERVAL or not self.response_turn.is_set():
+            return
+        self.progress_sent_at = now
+
+        self.begin_response()
+        send_encrypted_progress(self.connection, progress, self.session)
+
+def finish_job(job):
+    """ジョブの終了時（実行しなかった場合も含む）に、実行枠と保存領域の予約、アップロードIDを解放し、ジョブのファイルを削除する関数"""
+    if job.upload_session is not None:
+        global_upload_manager.release(job.upload_session.upload_id)
+        job.upload_session = None
+    if job.ticket is not None:
+        global_job_scheduler.finish(job.ticket)
+        job.ticket = None
+    if global_storage_manager is not None:
+        global_storage_manager.release(job.storage_key)
+
+def retain_storage(path):
+    # ジョブの終了後もキャッシュに残るファイルを、保存領域の使用量に加える
+    if global_storage_manager is not None:
+        global_storage_manager.retain(path)
+
+def finish_pending_job(job):
+    # パイプライン処理中のジョブにレスポンスの送信を許可し、送信が終わるまで待つ
+    job.response_turn.set()
+    job.future.result()
+
+def receive_job(config, connection, session, allow_streaming_ingest=True):
+    """リクエストヘッダーからアップロードの受信までを行い、ClientJobを返す関数（クライアントが接続を閉じた場合はNone）
+
+    ストリーミング入力の場合は、アップロードの残りをFFMPEGの実行時に受信する
+    """
     # AESによって暗号化されたヘッダー（３６バイト）、解読されたヘッダー（８バイト）の中にある、JSONサイズ（２バイト）、メディアタイプ（１バイト）、ファイルサイズ（５バイト）
-    encrypted_header = connection.recv(8 + 12 + 16)
-    decrypted_header = decrypt_chunk(encrypted_header, aes_key)
+    encrypted_header = recv_exact(connection, 8 + 12 + 16, allow_eof=True)
+    if encrypted_header is None:
+        return None
+    header_started_at = time.monotonic()
+    decrypted_header = session.decrypt(encrypted_header)
     json_size = int.from_bytes(decrypted_header[:2], 'big')
     mediatype_size = int.from_bytes(decrypted_header[2:3], 'big')
     file_size = int.from_bytes(decrypted_header[3:], 'big')
@@ -159,198 +371,1068 @@ def handle_client_request(config, connection):
     # ファイルサイズが0の場合はエラーとして扱う
     if file_size <= 0:
         raise Exception('ファイルサイズが無効です')
-    
-    encrypted_req_params = connection.recv(json_size + 12 + 16)
-    decrypted_req_params = decrypt_chunk(encrypted_req_params, aes_key).decode('utf-8')
-    encrypted_mediatype = connection.recv(mediatype_size + 12 + 16)
-    decrypted_mediatype = decrypt_chunk(encrypted_mediatype, aes_key).decode('utf-8')
 
-    filename = f'{uuid.uuid4().hex}.{decrypted_mediatype}'
+    encrypted_req_params = recv_exact(connection, json_size + 12 + 16)
+    decrypted_req_params = session.decrypt(encrypted_req_params).decode('utf-8')
+    encrypted_mediatype = recv_exact(connection, mediatype_size + 12 + 16)
+    decrypted_mediatype = session.decrypt(encrypted_mediatype).decode('utf-8')
 
-    upload_error = store_uploaded_file_encrypted(config, connection, filename, file_size, aes_key)
+    # メディアタイプはファイル名の拡張子になるため、英数字以外は受け付けない
+    if not MEDIATYPE_PATTERN.match(decrypted_mediatype):
+        raise Exception('メディアタイプが無効です')
+    observe_stage('header', time.monotonic() - header_started_at)
 
-    if upload_error is not None:
-        return upload_error, aes_key
+    filename = f'{uuid.uuid4().hex}.{decrypted_mediatype}'
+    inputfile_path = os.path.join(config['dir_path'], filename)
 
     req_data = json.loads(decrypted_req_params)
     action = req_data.get('action', 0)
 
-    print(f"受信したアクション: {action}")
+    print(f"受信したアクション: {action}" + (f"（ジョブID: {req_data['job_id']}）" if 'job_id' in req_data else ''))
 
-    match action:
-        case 1:
-            try:
-                processed_filename, output_path = compress_video(filename, config['dir_path'])
-                print(f'動画圧縮完了: {processed_filename}')
-                error = send_encrypted_response(connection, output_path, config['stream_rate'], aes_key)
-
-                if error is not None:
-                    return error, aes_key
-            except Exception as process_err:
-                error = ErrorInfo('1002', f'動画圧縮中のエラー: {str(process_err)}', 'FFMPEGが正しくインストールされているか確認してください。')
-                print(f"圧縮処理エラー: {str(process_err)}")
-                return error, aes_key
-        case 2:
-            try:
-                processed_filename, output_path = handle_resolution_change(filename, config['dir_path'], req_data)
-                print(f'解像度変更完了: {processed_filename}')
-                error  = send_encrypted_response(connection, output_path, config['stream_rate'], aes_key)
+    # クライアントが求めた場合は、次回の接続でRSAの鍵交換を省略するためのセッションチケットを送る
+    if req_data.get('session_ticket'):
+        send_session_ticket(connection, session)
 
-                if error is not None:
-                    return error, aes_key
+    # クライアントがフレームサイズを指定した場合は、このセッションのアップロードで使うフレームサイズを決めて返す
+    frame_size = config['stream_rate']
+    if 'frame_size' in req_data:
+        frame_size = negotiate_frame_size(config, req_data['frame_size'])
+        send_frame_size_reply(connection, frame_size, session)
 
-            except Exception as process_err:
-                error = ErrorInfo('1003', f'動画処理中のエラー: {str(process_err)}', 'FFMPEGが正しくインストールされているか確認してください。')
-                print(f"解像度処理エラー: {str(process_err)}")
-                return error, aes_key
-        case 3:
+    job = ClientJob(connection, session, req_data, filename, inputfile_path, frame_size)
+    upload = UploadStream(config, connection, file_size, session, frame_size=frame_size)
+    job.upload = upload
+    head_chunks = []
+    deduplicated = False
+
+    # 作業用ファイル（重複排除のリンクを含む）を作る前にジョブを登録し、定期的な削除の対象から外す
+    if global_storage_manager is not None:
+        global_storage_manager.track(job.storage_key)
+
+    try:
+        # クライアントがファイルのSHA-256を通知した場合は、保存済みの入力があるかを返す（ある場合はアップロードを省略）
+        if 'sha256' in req_data:
+            deduplicated = link_uploaded_source(req_data['sha256'], inputfile_path)
+            if deduplicated:
+                upload = StoredUpload(file_size, req_data['sha256'])
+                job.upload = upload
+
+        # アップロードIDが指定された場合は、前回までに受信した部分を確保し、残りの分だけ保存領域を予約する
+        resumable = not deduplicated and 'upload_id' in req_data
+        if resumable:
+            job.error = acquire_resumable_upload(job, req_data['upload_id'], file_size, decrypted_mediatype)
+        upload_size = 0 if deduplicated else file_size - (job.upload_session.bytes_written if job.upload_session is not None else 0)
+
+        # 事前検証を求めた場合は、パラメータとファイルの先頭部分を検証し、アップロードの前にジョブを受け付けるかを返す
+        preflight = bool(req_data.get('preflight', False))
+        if preflight:
+            job.error = run_preflight(connection, session, job, decrypted_mediatype, file_size, upload_size)
+            if job.error is not None:
+                # クライアントはアップロードを送らないため、読み捨てずにエラーのレスポンスを返す
+                return job
+
+        if 'sha256' in req_data:
+            send_upload_reply(connection, deduplicated, session)
+            if deduplicated:
+                print(f"保存済みの入力を使用します: {req_data['sha256']}")
+
+        # アップロードIDが指定された場合は、前回までに受信済みの位置を返し、その続きから受信する
+        if resumable:
+            if job.error is not None:
+                # 再開できない場合は、アップロードを送らないようクライアントに伝えてエラーを返す
+                send_resume_offset(connection, RESUME_REJECTED_OFFSET, session)
+                return job
+            upload = begin_resumable_upload(config, connection, job.upload_session, file_size, session, frame_size)
+            job.upload = upload
+
+        # 事前検証をしていない場合は、パラメータが不正な場合や、実行待ちのジョブが多すぎる・保存領域が足りない場合に
+        # アップロードを読み捨ててエラーを返す
+        if not preflight:
+            job.error = validate_action_params(req_data, file_size) or admit_job(job, upload_size)
+            if job.error is not None:
+                upload.drain()
+                return job
+
+        # 再開したアップロード（受信済みの部分がある場合）は、全体を保存してから処理する
+        resumed = job.upload_session is not None and job.upload_session.bytes_written > 0
+        if (not deduplicated and not resumed and allow_streaming_ingest and not job.pipelined
+                and config['streaming_ingest'] and action in STREAMING_ACTIONS):
+            # 先頭部分を見てストリーミング可能なコンテナか判定し、可能ならアップロードを直接FFMPEGに流し込む
+            head_chunks, streamable = read_upload_head(upload, decrypted_mediatype)
+            if streamable:
+                job.input_chunks = itertools.chain(head_chunks, upload)
+                if job.upload_session is not None:
+                    # 接続が切れても続きから再開できるよう、FFMPEGに流し込みながらチェックポイント付きで途中のアップロードとして保存する
+                    job.input_tee = job.upload_session.open_data_file(UPLOAD_WRITE_BUFFER_SIZE)
+                    job.input_chunks = checkpoint_chunks(job.input_chunks, job.upload_session, job.input_tee)
+                elif global_source_cache is not None:
+                    # 次回以降の重複排除のため、FFMPEGに流し込みながら入力も保存する
+                    job.input_tee = open(inputfile_path, 'wb', buffering=UPLOAD_WRITE_BUFFER_SIZE)
+                    job.input_chunks = tee_chunks(job.input_chunks, job.input_tee)
+
+        if job.input_chunks is None:
+            if job.upload_session is not None:
+                with measure_upload(upload, 'resumable', upload.total_consumed):
+                    job.error = store_resumable_upload(upload, job.upload_session, inputfile_path, head_chunks)
+                # store_resumable_upload でアップロードIDを解放済み
+                job.upload_session = None
+
+                if job.error is not None:
+                    return job
+
+                retain_uploaded_source(inputfile_path, upload)
+
+            elif not deduplicated:
+                # ストリーミング判定のために先に受信した分も含めて計測する
+                with measure_upload(upload, 'stored'):
+                    job.error = store_uploaded_file_encrypted(config, upload, filename, head_chunks)
+
+                if job.error is not None:
+                    return job
+
+                retain_uploaded_source(inputfile_path, upload)
+
+            job.media_info = index_uploaded_source(inputfile_path, upload)
+
+            endseconds = get_requested_endseconds(req_data)
+            if endseconds is not None:
+                job.error = validate_video_duration(inputfile_path, endseconds, job.media_info)
+
+    except BaseException:
+        # 受信中に接続が切れた場合などは、ジョブを実行しないため予約と受信途中のファイルを解放する
+        finish_job(job)
+        raise
+
+    return job
+
+def execute_job(config, connection, session, job):
+    """受信済みのジョブを処理し、処理結果またはエラーのレスポンスを送る関数"""
+    error = job.error
+
+    try:
+        if error is None:
             try:
-                processed_filename, output_path = handle_aspect_change(filename, config['dir_path'], req_data)
-                print(f'アスペクト比変更完了: {processed_filename}')
-                error = send_encrypted_response(connection, output_path, config['stream_rate'], aes_key)
+                # ストリーミング入力の場合は、FFMPEGの実行中にアップロードを受信する
+                with measure_upload(job.upload if job.input_chunks is not None else None, 'streaming'):
+                    error = run_action(config, connection, session, job.action, job.filename, job.req_data, job.upload, job.frame_size, job.input_chunks, job.begin_response, job.media_info, job.ticket, job.send_progress if job.progress else None)
+            finally:
+                if job.input_tee is not None:
+                    close_input_tee(job)
+                    retain_uploaded_source(job.inputfile_path, job.upload)
+                    index_uploaded_source(job.inputfile_path, job.upload)
+                    delete_tmp_files([job.inputfile_path])
+    finally:
+        # エラーで途中のファイルが残った場合も、ここでジョブのファイルをすべて削除する
+        finish_job(job)
+
+    if global_metrics is not None:
+        global_metrics.jobs.inc(action=job.action, status='ok' if error is None else 'error')
+
+    if error is not None:
+        print(error.to_json())
+        job.begin_response()
+        send_encrypted_error_response(connection, error, session)
+
+def run_action(config, connection, session, action, filename, req_data, upload, frame_size, input_chunks=None, before_response=None, media_info=None, ticket=None, on_progress=None):
+    """アクションを実行して結果をクライアントに送信する関数
+
+    input_chunksを指定した場合はアップロードをFFMPEGの標準入力に流し込み、
+    req_dataのstream_responseがTrueの場合はFFMPEGの出力をパイプから直接クライアントに送信する
+    結果はframe_sizeごとのフレームに分けて送信し、before_responseを指定した場合は送信の直前に呼び出す
+    media_info（入力のメタデータ）がある場合は、再エンコードが不要な処理をストリームのコピーで行う
+    ticket（スケジューラーが受け付けたジョブ）を指定した場合は、FFMPEGの実行の順番を待ち、割り当てられたスレッド数で実行する
+    on_progressを指定した場合は、FFMPEGの実行中にエンコードの進捗（FfmpegProgress.to_dictの辞書）を渡して呼び出す
+    """
+    before_response = before_response or (lambda: None)
+
+    if action == 7:
+        return run_ladder_action(config, connection, session, filename, req_data, upload, frame_size, input_chunks, before_response, media_info, ticket, on_progress)
+
+    inputfile_path = os.path.join(config['dir_path'], filename)
+    input_path = 'pipe:0' if input_chunks is not None else None
+    response = None
 
-                if error is not None:
-                    return error, aes_key
+    # 保存済みの入力であればハッシュが確定しているため、同じ入力・同じ処理の結果があればそれを返す
+    if global_result_cache is not None and input_chunks is None:
+        cache_key = ContentCache.make_key(upload.input_hash(), normalize_action_params(req_data))
+        cached_path = global_result_cache.lookup(cache_key)
+        print(f"キャッシュ{'ヒット' if cached_path else 'ミス'}: {global_result_cache.stats()}")
 
-            except Exception as process_err:
-                error = ErrorInfo('1004', f'動画のアスペクト比変更中のエラー: {str(process_err)}', 'アップロード動画を確認し再度アップロードおよび操作をしてください、解決しない場合は管理者にお問い合わせください。')
-                print(f"処理エラー: {str(process_err)}")
-                return error, aes_key
-        case 4:
+        if cached_path is not None:
             try:
-                processed_filename, output_path = handle_video_conversion(filename, config['dir_path'])
-                print(f'オーディオへの変換完了: {processed_filename}')
-                error  = send_encrypted_response(connection, output_path, config['stream_rate'], aes_key)
+                before_response()
+                error = send_encrypted_response(connection, cached_path, frame_size, session)
+            finally:
+                global_result_cache.release(cache_key)
 
-                if error is not None:
-                    return error, aes_key
+            delete_tmp_files([inputfile_path])
+            return error
 
-            except Exception as process_err:
-                error = ErrorInfo('1005', f'オーディオへの変換中のエラー: {str(process_err)}', 'アップロード動画を確認し再度アップロードおよび操作をしてください、解決しない場合は管理者にお問い合わせください。')
-                print(f"オーディオへの変換中のエラー: {str(process_err)}")
-                return error, aes_key
-        case 5:
-                filepath = os.path.join(config['dir_path'], filename)
-                error = validate_video_duration(filepath,req_data.get('endseconds'))
-                if error != None:
-                    return error, aes_key
-                
-                try:
-                    processed_filename,output_path = handle_process_video_clip(filename, config['dir_path'], req_data)
-                    print(f'時間範囲での動画を作成完了: {processed_filename}')
-                    send_encrypted_response(connection, output_path, config['stream_rate'], aes_key)
-
-                except Exception as process_err:
-                    error = ErrorInfo('1006', f'動画処理中のエラー: {str(process_err)}', 'アップロードした動画を再度確認し、再度トライしてください。')
-                    print(f"処理エラー: {str(process_err)}")
-                    return error, aes_key
+    try:
+        threads = acquire_job_slot(ticket, action, req_data, media_info, upload.file_size)
+        with measure_ffmpeg(action) as usage:
+            if req_data.get('stream_response', False):
+                output_filename, output_path, ffmpeg_cmd = prepare_action(action, filename, config['dir_path'], req_data, input_path, upload.file_size, media_info)
+                # キャッシュが有効な場合は、送信と同時に出力をファイルにも書き込む
+                tee_path = output_path if global_result_cache is not None else None
+                response = StreamingResponse(connection, output_filename, frame_size, session, tee_path, before_response)
+                execute_ffmpeg(build_pipe_output_command(ffmpeg_cmd, output_filename), input_chunks, response.send_chunk, threads)
+            elif action == 5 and select_clip_mode(req_data, media_info) == 'exact':
+                # 境界のGOPだけを再エンコードし、残りはコピーして連結する（FFMPEGを複数回実行する）
+                output_filename, output_path = run_exact_clip(filename, config['dir_path'], req_data, media_info, threads)
+                usage.out_seconds = get_expected_output_seconds(action, req_data, media_info)
+            else:
+                output_filename, output_path, ffmpeg_cmd = prepare_action(action, filename, config['dir_path'], req_data, input_path, upload.file_size, media_info)
+                progress = create_progress(action, req_data, media_info, None if input_chunks is not None else inputfile_path, on_progress)
+
+                # 長い動画の再エンコードは、キーフレームで区切って複数のプロセス（ワーカーがある場合はワーカー）で同時にエンコードする
+                # スケジューラーが無効の場合は、cpu_budgetをFFMPEGワーカー数で分けた分をこのジョブのCPUの数とする
+                cores = threads or max(config['cpu_budget'] // config['ffmpeg_workers'], 1)
+                segments = plan_encode_segments(config, action, ffmpeg_cmd, media_info, max(cores, get_worker_capacity())) if input_chunks is None else None
+                if segments is not None:
+                    run_segmented_encode(ffmpeg_cmd, output_path, segments, cores, progress, upload.input_hash())
+                elif input_chunks is not None or not execute_on_workers(ffmpeg_cmd, upload.input_hash(), output_path, progress):
+                    execute_ffmpeg(ffmpeg_cmd, input_chunks, threads=threads, progress=progress)
+                log_encode_speed(action, progress)
+                usage.record_progress(progress)
+
+        print(f'{ACTION_ERROR_INFO[action][0]}完了: {output_filename}')
+
+    except UploadError as upload_err:
+        upload.drain()
+        if response is not None:
+            response.discard_tee()
+        error = ErrorInfo('1001', 'ファイル保存中のエラー:' + str(upload_err), '解決しない場合は管理者にお問い合わせください。')
+        return finish_streaming_response(response, error)
+
+    except Exception as process_err:
+        upload.drain()
+        if response is not None:
+            response.discard_tee()
+        return finish_streaming_response(response, create_action_error(action, process_err))
+
+    finally:
+        # 処理結果の送信中は、次のジョブがFFMPEGを実行できるようにする
+        release_job_slot(ticket)
+
+    if response is not None:
+        response.close_tee()
+
+    tmp_files = [inputfile_path] if input_chunks is None else []
+
+    # 処理結果をキャッシュに移動する（ストリーミング入力の場合はハッシュが確定したここでキーを作る）
+    cache_key = None
+    if global_result_cache is not None and upload.input_hash() is not None and os.path.exists(output_path):
+        cache_key = ContentCache.make_key(upload.input_hash(), normalize_action_params(req_data))
+        output_path = global_result_cache.store(cache_key, output_path)
+        retain_storage(output_path)
+    else:
+        tmp_files.append(output_path)
+
+    try:
+        if response is not None:
+            error = finish_streaming_response(response)
+        else:
+            before_response()
+            error = send_encrypted_response(connection, output_path, frame_size, session)
+    finally:
+        if cache_key is not None:
+            global_result_cache.release(cache_key)
 
+    if error is not None:
+        return error
+
+    delete_tmp_files(tmp_files)
+
+    return None
+
+def run_ladder_action(config, connection, session, filename, req_data, upload, frame_size, input_chunks, before_response, media_info=None, ticket=None, on_progress=None):
+    """1回のFFMPEGで複数の解像度（とオーディオ）を作成し、マルチパートのレスポンスとして送信する関数
+
+    出力が複数あるため、処理結果のキャッシュとストリーミングレスポンスは使わない
+    """
     inputfile_path = os.path.join(config['dir_path'], filename)
-    delete_tmp_files([inputfile_path, output_path])
+    input_path = 'pipe:0' if input_chunks is not None else None
+
+    try:
+        outputs, ffmpeg_cmd = build_ladder_command(filename, config['dir_path'], req_data, input_path, media_info)
+        threads = acquire_job_slot(ticket, 7, req_data, media_info, upload.file_size)
+        progress = create_progress(7, req_data, media_info, None if input_chunks is not None else inputfile_path, on_progress)
+        with measure_ffmpeg(7) as usage:
+            execute_ffmpeg(ffmpeg_cmd, input_chunks, threads=threads, progress=progress)
+            usage.record_progress(progress)
+        log_encode_speed(7, progress)
+        print(f"{ACTION_ERROR_INFO[7][0]}完了: {', '.join(output_filename for _, output_filename, _ in outputs)}")
+
+    except UploadError as upload_err:
+        upload.drain()
+        return ErrorInfo('1001', 'ファイル保存中のエラー:' + str(upload_err), '解決しない場合は管理者にお問い合わせください。')
+
+    except Exception as process_err:
+        upload.drain()
+        return create_action_error(7, process_err)
+
+    finally:
+        release_job_slot(ticket)
+
+    before_response()
+    error = send_encrypted_multipart_response(connection, [(label, output_path) for label, _, output_path in outputs], frame_size, session)
+    if error is not None:
+        return error
+
+    tmp_files = [inputfile_path] if input_chunks is None else []
+    delete_tmp_files(tmp_files + [output_path for _, _, output_path in outputs])
 
-    return None, aes_key
+    return None
+
+# キャッシュキーに含める、アクションごとの処理パラメータ
+ACTION_PARAM_KEYS = {
+    1: (),
+    2: ('resolution',),
+    3: ('aspect_ratio',),
+    4: (),
+    5: ('startseconds', 'endseconds', 'extension', 'clip_mode'),
+    6: ('operations',)
+}
+
+def normalize_action_params(req_data:dict) -> dict:
+    """出力に影響するパラメータのみを取り出し、表記揺れをなくした辞書を返す関数"""
+    action = req_data.get('action', 0)
+    action_params = {'action': action}
+
+    for key in ACTION_PARAM_KEYS.get(action, ()):
+        value = req_data.get(key)
+        if key in ('startseconds', 'endseconds') and value is not None:
+            value = float(value)
+        elif key == 'extension' and value is not None:
+            value = str(value).lower()
+        elif key == 'operations' and value is not None:
+            value = [normalize_action_params(operation) for operation in value]
+        action_params[key] = value
+
+    return action_params
+
+class UploadError(Exception):
+    """アップロードの受信・復号に失敗したことを表す例外"""
+    pass
+
+class UploadStream:
+    """暗号化されたアップロードを受信し、復号したチャンクを順に返すクラス
+
+    offsetを指定した場合は、再開したアップロードとしてその位置以降のデータを受信する
+    受信には事前に確保したバッファを使い回し、復号はバッファのmemoryviewから直接行う
+    """
+    def __init__(self, config, connection, file_size, session, offset=0, frame_size=None) -> None:
+        self.connection = connection
+        # 1フレームあたりの平文のサイズ（指定がない場合は従来どおりstream_rate）
+        self.frame_size = frame_size or config['stream_rate']
+        self.file_size = file_size
+        self.session = session
+        # ソケットから読み取り済みのバイト数（復号前の平文換算）
+        self.total_consumed = offset
+        # 復号したデータのハッシュ（キャッシュのキーに使用）
+        self.sha256 = hashlib.sha256()
+        self.total_hashed = 0
+        # 受信用のバッファ（nonce＋暗号文＋タグ）
+        self.frame_view = memoryview(bytearray(self.frame_size + 12 + 16))
+
+    def receive_frame(self, encrypted_chunk_size):
+        """1フレーム分をrecv_intoで受信用バッファに読み込み、そのmemoryviewを返す関数"""
+        frame = self.frame_view[:encrypted_chunk_size]
+        received = 0
+        while received < encrypted_chunk_size:
+            received_size = self.connection.recv_into(frame[received:])
+            if received_size == 0:
+                return None
+            received += received_size
+        return frame
+
+    def __iter__(self):
+        while self.total_consumed < self.file_size:
+            remaining = self.file_size - self.total_consumed
+
+            chunk_size = min(self.frame_size, remaining)
+            encrypted_chunk_size = chunk_size + 12 + 16
+
+            try:
+                encrypted_chunk = self.receive_frame(encrypted_chunk_size)
+                if encrypted_chunk is None:
+                    raise Exception("Connection closed unexpectedly")
+
+                self.total_consumed += chunk_size
+                decrypted_chunk = self.session.decrypt(encrypted_chunk)
+
+            except Exception as e:
+                raise UploadError(str(e)) from e
+
+            decrypted_chunk = decrypted_chunk[:chunk_size]
+            self.sha256.update(decrypted_chunk)
+            self.total_hashed += len(decrypted_chunk)
+
+            yield decrypted_chunk
+
+    def input_hash(self):
+        """アップロード全体のSHA-256を返す関数（全体を受信していない場合はNone）"""
+        if self.total_hashed != self.file_size:
+            return None
+        return self.sha256.hexdigest()
+
+    def drain(self):
+        """エラー時に残りのアップロードを読み捨てる関数
+
+        同じ接続で次のジョブを受け付けられるよう、読み捨てるフレームも復号してセッションのnonceを進める
+        """
+        try:
+            while self.total_consumed < self.file_size:
+                remaining = self.file_size - self.total_consumed
+                chunk_size = min(self.frame_size, remaining)
+
+                frame = self.receive_frame(chunk_size + 12 + 16)
+                if frame is None:
+                    return
+
+                self.total_consumed += chunk_size
+                self.session.decrypt(frame)
+        except Exception:
+            pass
+
+class StoredUpload:
+    """保存済みの入力を使うため、アップロードを受信しない場合のUploadStreamの代わり"""
+    def __init__(self, file_size, source_hash) -> None:
+        self.file_size = file_size
+        self.source_hash = source_hash
+
+    def input_hash(self):
+        return self.source_hash
+
+    def drain(self):
+        pass
+
+# 再開可能なアップロードに関する関数はここから実装
+# 再開できないアップロードIDの場合に、受信済みの位置の代わりに送る値（クライアントはアップロードを送らずにエラーのレスポンスを受信する）
+RESUME_REJECTED_OFFSET = 2 ** 64 - 1
+
+def acquire_resumable_upload(job, upload_id, file_size, mediatype) -> ErrorInfo | None:
+    """アップロードIDの受信途中のファイルを確保してjob.upload_sessionに設定する関数（再開できない場合はErrorInfo）
+
+    再開可能なアップロードが無効の場合は何もせず、最初から受信する
+    """
+    if global_upload_manager is None:
+        return None
 
-def store_uploaded_file_encrypted(config, connection, filename, original_file_size, aes_key):
     try:
-        with open(os.path.join(config['dir_path'], filename), 'wb+') as f:
-            total_received = 0
-            
-            while total_received < original_file_size:
-                remaining = original_file_size - total_received
+        job.upload_session = global_upload_manager.acquire(upload_id, file_size, mediatype)
+    except ValueError as upload_err:
+        print(f"アップロードを再開できません: {upload_err}")
+        return ErrorInfo('1013', f'アップロードを再開できません: {str(upload_err)}', '同じファイルのアップロードが終わってから、再度お試しください。')
+
+    return None
+
+def begin_resumable_upload(config, connection, upload_session, file_size, session, frame_size):
+    """受信済みの位置（８バイト）をクライアントに送信し、その位置から受信するUploadStreamを返す関数（upload_sessionがNoneの場合は最初から）"""
+    offset = upload_session.bytes_written if upload_session is not None else 0
+    upload = UploadStream(config, connection, file_size, session, offset, frame_size)
+
+    if offset:
+        # 受信済みの部分のハッシュを計算し直し、アップロード全体のハッシュが得られるようにする
+        for data in upload_session.read_written_data():
+            upload.sha256.update(data)
+            upload.total_hashed += len(data)
+        print(f"アップロード {upload_session.upload_id} を{offset}バイト目（{upload_session.chunks_written}チャンク）から再開します")
+
+    send_resume_offset(connection, offset, session)
+    return upload
+
+def send_resume_offset(connection, offset, session):
+    session.send_frame(connection, offset.to_bytes(8, 'big'))
+
+def checkpoint_chunks(chunks, upload_session, f):
+    """チャンクを途中のアップロードのファイルに書き込み、checkpoint_bytesごとにチェックポイントを保存しながらそのまま返すジェネレータ"""
+    for chunk in chunks:
+        f.write(chunk)
+        upload_session.advance(len(chunk))
+        if upload_session.pending_bytes >= global_upload_manager.checkpoint_bytes:
+            upload_session.checkpoint(f)
+        yield chunk
+
+def close_input_tee(job):
+    """ストリーミング入力で保存したファイルを閉じる関数
+
+    途中のアップロードとして保存していた場合は、受信できた分までをチェックポイントにし、
+    すべて受信できていれば作業用のパスに移動する（途中で切れた場合は、次の接続で続きから再開できるよう残す）
+    """
+    upload_session = job.upload_session
+    if upload_session is None:
+        job.input_tee.close()
+        return
+
+    try:
+        upload_session.checkpoint(job.input_tee)
+    finally:
+        job.input_tee.close()
+    if upload_session.bytes_written == upload_session.file_size:
+        upload_session.complete(job.inputfile_path)
+
+def store_resumable_upload(upload, upload_session, inputfile_path, head_chunks=()):
+    """チェックポイントを保存しながらアップロードを受信し、完了したら作業用のパスに移動する関数"""
+    try:
+        with upload_session.open_data_file(UPLOAD_WRITE_BUFFER_SIZE) as f:
+            try:
+                # ストリーミング判定のために先に受信した分も書き込む
+                for _ in checkpoint_chunks(itertools.chain(head_chunks, upload), upload_session, f):
+                    pass
+            finally:
+                # 接続が切れた場合も、受信できた分までを再開位置として保存する
+                upload_session.checkpoint(f)
+
+        upload_session.complete(inputfile_path)
+        print('ファイルのアップロードが完了しました。')
+        return None
+
+    except Exception as file_err:
+        print(f"File storage error: {file_err}")
+        upload.drain()
+
+        return ErrorInfo('1001', 'ファイル保存中のエラー:' + str(file_err), f'同じアップロードID（{upload_session.upload_id}）で再接続すると、{upload_session.bytes_written}バイト目から再開できます。')
+
+    finally:
+        global_upload_manager.release(upload_session.upload_id)
 
-                chunk_size = min(config['stream_rate'], remaining)
-                encrypted_chunk_size = chunk_size + 12 + 16
+# アップロードのフレームサイズに関する関数はここから実装
+# クライアントが指定できるフレームサイズの下限（上限はmax_frame_size）
+MIN_FRAME_SIZE = 64 * 1024
+# 受信したアップロードをファイルに書き込む際のバッファサイズ（小さなフレームをまとめて書き込む）
+UPLOAD_WRITE_BUFFER_SIZE = 1024 * 1024
 
-                encrypted_chunk = b''
-                while len(encrypted_chunk) < encrypted_chunk_size:
-                    data = connection.recv(encrypted_chunk_size - len(encrypted_chunk))
-                    if not data:
-                        raise Exception("Connection closed unexpectedly")
-                    encrypted_chunk += data
+def negotiate_frame_size(config, requested_frame_size) -> int:
+    """クライアントが指定したフレームサイズを、サーバーが受け付ける範囲に収めて返す関数"""
+    if not isinstance(requested_frame_size, int) or isinstance(requested_frame_size, bool):
+        return config['stream_rate']
+    return max(MIN_FRAME_SIZE, min(requested_frame_size, config['max_frame_size']))
 
-                decrypted_chunk = decrypt_chunk(encrypted_chunk, aes_key)
+def send_frame_size_reply(connection, frame_size, session):
+    # このセッションで使うフレームサイズ（４バイト）を暗号化して送信
+    session.send_frame(connection, frame_size.to_bytes(4, 'big'))
 
-                actual_chunk_size = min(len(decrypted_chunk), remaining)
-                f.write(decrypted_chunk[:actual_chunk_size])
-                total_received += actual_chunk_size
+def tee_chunks(chunks, f):
+    """チャンクをファイルに書き込みながらそのまま返すジェネレータ"""
+    for chunk in chunks:
+        f.write(chunk)
+        yield chunk
+
+def store_uploaded_file_encrypted(config, upload, filename, head_chunks=()):
+    try:
+        with open(os.path.join(config['dir_path'], filename), 'wb+', buffering=UPLOAD_WRITE_BUFFER_SIZE) as f:
+            # 受信を始める前に領域を確保し、ディスクの空きが足りない場合は途中まで受信せずにエラーにする
+            preallocate_file(f, upload.file_size)
+
+            # ストリーミング判定のために先に受信した分を書き込む
+            for chunk in head_chunks:
+                f.write(chunk)
+
+            for chunk in upload:
+                f.write(chunk)
 
         print('ファイルのアップロードが完了しました。')
         return None
 
     except Exception as file_err:
         print(f"File storage error: {file_err}")
-        try:
-            remaining = original_file_size - total_received
-            while remaining > 0:
-                chunk_size = min(config['stream_rate'] + 28, remaining)
-                connection.recv(chunk_size)
-                remaining -= (chunk_size - 28)
-        except:
-            pass
-            
+        upload.drain()
+
         error = ErrorInfo('1001', 'ファイル保存中のエラー:' + str(file_err), '解決しない場合は管理者にお問い合わせください。')
         return error
 
+# 事前検証に関する関数はここから実装
+# 事前検証のためにクライアントが送る、ファイルの先頭部分の最大サイズ
+PREFLIGHT_HEAD_SIZE = 1024 * 1024
+# アップロードを保存するファイル名の拡張子に使えるメディアタイプ
+MEDIATYPE_PATTERN = re.compile(r'^[0-9A-Za-z]{1,16}$')
+# 切り取り（action 5）で出力できる形式
+CLIP_OUTPUT_EXTENSIONS = ('gif', 'webm', 'mp4')
+ASPECT_RATIO_PATTERN = re.compile(r'^[1-9][0-9]{0,3}:[1-9][0-9]{0,3}$')
+# MP4のファイルの先頭に現れるトップレベルのボックス
+MP4_TOP_LEVEL_BOXES = (b'ftyp', b'styp', b'moov', b'moof', b'mdat', b'free', b'skip', b'wide', b'pnot', b'uuid')
+# 先頭部分のヘッダーに動画の長さが書かれているコンテナ（ffprobeのformat_nameに含まれる名前）
+HEADER_DURATION_FORMATS = ('mov', 'matroska')
+
+def run_preflight(connection, session, job, mediatype, file_size, upload_size) -> ErrorInfo | None:
+    """ジョブを2段階で検証・受け付け、それぞれの結果をクライアントに返す関数（受け付けられない場合はErrorInfo）
+
+    1. パラメータを検証し、問題がなければクライアントがファイルの先頭部分（PREFLIGHT_HEAD_SIZEまで）を送る
+    2. 入力を動画として読めるか、終了時刻が動画の長さを超えていないかを検証し、
+       問題がなければ保存領域の予約とスケジューラーへの受け付けまで行う
+    """
+    # アップロードIDで再開できない場合など、既にエラーが決まっている場合はそのまま拒否する
+    error = job.error
+    if error is None:
+        error = validate_action_params(job.req_data, file_size)
+    send_preflight_reply(connection, error is None, session)
+    if error is not None:
+        # クライアントは先頭部分も送らない
+        print(f"事前検証: {error.to_json()}")
+        return error
+
+    head = session.decrypt(recv_exact(connection, min(PREFLIGHT_HEAD_SIZE, file_size) + 12 + 16))
+    error = validate_upload_head(job.req_data, mediatype, head, file_size)
+    if error is None:
+        error = admit_job(job, upload_size)
+
+    print(f"事前検証: {'受け付けます' if error is None else error.to_json()}")
+    send_preflight_reply(connection, error is None, session)
+    return error
+
+def send_preflight_reply(connection, accepted, session):
+    # 検証を通ったか（１バイト、0x01：次のデータ（先頭部分またはアップロード）を送る、0x00：受け付けないため何も送らない）を暗号化して送信
+    session.send_frame(connection, b'\x01' if accepted else b'\x00')
+
+def validate_action_params(req_data:dict, file_size) -> ErrorInfo | None:
+    """アップロードを受信する前に、アクションのパラメータを検証する関数（不正な場合はErrorInfo）"""
+    action = req_data.get('action', 0)
+    try:
+        check_action_params(action, req_data)
+        # 入力のファイルを使わずにコマンドを組み立て、組み立てられないパラメータ（処理の組み合わせなど）を検出する
+        if action == 7:
+            build_ladder_command('preflight.mp4', '', req_data, 'pipe:0')
+        else:
+            prepare_action(action, 'preflight.mp4', '', req_data, 'pipe:0', file_size)
+    except (KeyError, ValueError, TypeError) as param_err:
+        print(f"パラメータが不正です: {param_err}")
+        return ErrorInfo('1012', f'リクエストのパラメータが不正です: {str(param_err)}', 'パラメータを確認し、再度トライしてください。')
+
+    return None
+
+def check_action_params(action, req_data:dict, in_chain=False):
+    # 不正なパラメータの場合はValueErrorを送出する
+    match action:
+        case 2:
+            if req_data.get('resolution') not in RESOLUTION_CHOICES:
+                raise ValueError(f"未対応の解像度です: {req_data.get('resolution')}")
+        case 3:
+            if not ASPECT_RATIO_PATTERN.match(str(req_data.get('aspect_ratio'))):
+                raise ValueError(f"未対応のアスペクト比です: {req_data.get('aspect_ratio')}")
+        case 5:
+            startseconds = float(req_data.get('startseconds', 0))
+            endseconds = float(req_data.get('endseconds'))
+            if not 0 <= startseconds < endseconds:
+                raise ValueError(f'時間範囲が不正です: {startseconds}〜{endseconds}')
+            # まとめて実行する処理では、出力形式の指定は省略できる
+            if (not in_chain or req_data.get('extension')) and str(req_data.get('extension')).lower() not in CLIP_OUTPUT_EXTENSIONS:
+                raise ValueError(f"未対応の出力形式です: {req_data.get('extension')}")
+            if req_data.get('clip_mode', 'accurate') not in CLIP_MODES:
+                raise ValueError(f"未対応の切り取り方法です: {req_data.get('clip_mode')}")
+        case 6:
+            operations = req_data.get('operations')
+            if not isinstance(operations, list) or not all(isinstance(operation, dict) for operation in operations):
+                raise ValueError('まとめて実行する処理の指定が不正です')
+            for operation in operations:
+                check_action_params(operation.get('action'), operation, in_chain=True)
+
+def validate_upload_head(req_data:dict, mediatype, head:bytes, file_size) -> ErrorInfo | None:
+    """ファイルの先頭部分から、入力を動画として読めるかと、終了時刻が動画の長さを超えていないかを検証する関数
+
+    索引に入力のメタデータがある場合はその長さを使い、先頭部分だけでは判断できない場合は受信後の検証に任せる
+    """
+    media_info = None
+    if global_media_index is not None and is_sha256_hex(req_data.get('sha256')):
+        media_info = global_media_index.lookup(req_data['sha256'].lower())
+
+    duration = media_info.get('duration') if media_info is not None else None
+    if media_info is None:
+        head_info = probe_upload_head(mediatype, head, len(head) == file_size)
+        if head_info is False:
+            return ErrorInfo('1012', 'アップロードされたファイルを動画として読み込めません', '対応している形式の動画ファイルを指定してください。')
+        if head_info is not None:
+            duration = head_info['duration']
+
+    endseconds = get_requested_endseconds(req_data)
+    if duration is not None and endseconds is not None:
+        return check_video_duration(duration, float(endseconds))
+    return None
+
+def probe_upload_head(mediatype, head:bytes, complete:bool):
+    """ファイルの先頭部分をffprobeで読み、{'format_name', 'duration'}を返す関数
+
+    動画として読めない場合はFalse、先頭部分だけでは判断できない場合（moovが末尾にあるMP4など）はNoneを返す
+    durationは、ヘッダーに長さが書かれているコンテナか、ファイル全体を読んだ場合のみ返す（それ以外はNone）
+    """
+    result = subprocess.run(build_head_probe_command(), input=head, capture_output=True)
+    if result.returncode != 0:
+        if b'Invalid data found' not in result.stderr:
+            # ffprobeが異常終了した場合などは、受信後の検証に任せる
+            return None
+        # moovがmdatより後ろにあるMP4は、先頭部分だけでは読めない
+        if mediatype.lower() in MP4_CONTAINERS and head[4:8] in MP4_TOP_LEVEL_BOXES and not complete:
+            return None
+        return False
+
+    try:
+        probe_format = json.loads(result.stdout).get('format', {})
+    except ValueError:
+        return None
+
+    format_name = probe_format.get('format_name', '')
+    duration = parse_number(probe_format.get('duration'))
+    if not complete and not any(name in format_name.split(',') for name in HEADER_DURATION_FORMATS):
+        duration = None
+    return {'format_name': format_name, 'duration': duration}
+
+def build_head_probe_command():
+    return [
+        'ffprobe',
+        '-v', 'error',
+        '-show_entries', 'format=format_name,duration',
+        '-of', 'json',
+        '-i', 'pipe:0'
+    ]
+
+# ストリーミング入力に関する関数はここから実装
+# 入力を先頭から順に読むだけで処理できるアクション（5は動画の長さの検証にファイルが必要）
+STREAMING_ACTIONS = (1, 2, 3, 4, 7)
+# 先頭から順に読めるコンテナ
+STREAMABLE_CONTAINERS = ('ts', 'mts', 'm2ts', 'webm', 'mkv')
+# moovボックスがmdatより前にある場合のみ順に読めるコンテナ
+MP4_CONTAINERS = ('mp4', 'm4v', 'mov')
+# ストリーミング判定のために読み込む先頭部分の上限
+STREAMING_HEAD_LIMIT = 1024 * 1024
+
+def detect_streamable_input(mediatype:str, head:bytes) -> bool | None:
+    """先頭部分からストリーミング可能か判定する関数（判定にさらにデータが必要な場合はNone）"""
+    mediatype = mediatype.lower()
+    if mediatype in STREAMABLE_CONTAINERS:
+        return True
+    if mediatype not in MP4_CONTAINERS:
+        return False
+
+    # トップレベルのボックスを順にたどり、moovとmdatのどちらが先に現れるかを見る
+    offset = 0
+    while offset + 8 <= len(head):
+        box_size = int.from_bytes(head[offset:offset + 4], 'big')
+        box_type = head[offset + 4:offset + 8]
+
+        if box_type in (b'moov', b'moof'):
+            return True
+        if box_type == b'mdat':
+            return False
+
+        if box_size == 1:
+            # 64ビットのボックスサイズ
+            if offset + 16 > len(head):
+                return None
+            box_size = int.from_bytes(head[offset + 8:offset + 16], 'big')
+        if box_size < 8:
+            return False
+        offset += box_size
+
+    return None
+
+def read_upload_head(upload, mediatype):
+    """ストリーミング可否が判定できるまでアップロードの先頭を読み込む関数"""
+    head_chunks = []
+    head = bytearray()
+
+    for chunk in upload:
+        head_chunks.append(chunk)
+        head += chunk
+        streamable = detect_streamable_input(mediatype, head)
+        if streamable is not None:
+            return head_chunks, streamable
+        if len(head) >= STREAMING_HEAD_LIMIT:
+            break
+
+    return head_chunks, detect_streamable_input(mediatype, head) is True
+
+# アップロードの重複排除に関する関数はここから実装
+def link_uploaded_source(source_hash, inputfile_path):
+    """保存済みの入力があれば作業用のファイル名でリンクし、Trueを返す関数"""
+    if global_source_cache is None or not is_sha256_hex(source_hash):
+        return False
+
+    source_key = source_hash.lower()
+    source_path = global_source_cache.lookup(source_key)
+    if source_path is None:
+        return False
+
+    try:
+        link_or_copy(source_path, inputfile_path)
+    finally:
+        global_source_cache.release(source_key)
+
+    return True
+
+def retain_uploaded_source(inputfile_path, upload):
+    """受信した入力を、次回以降の重複排除のためにハッシュをキーとして保存する関数"""
+    if global_source_cache is None or upload.input_hash() is None or not os.path.exists(inputfile_path):
+        return
+
+    source_key = upload.input_hash()
+    retain_storage(global_source_cache.store(source_key, inputfile_path, link=True))
+    global_source_cache.release(source_key)
+
+def index_uploaded_source(inputfile_path, upload):
+    """受信した入力のメタデータを返す関数（未索引の場合はこの時点で1回だけffprobeを実行して索引に登録する）"""
+    if global_media_index is None or upload.input_hash() is None or not os.path.exists(inputfile_path):
+        return None
+
+    try:
+        return global_media_index.index(upload.input_hash(), inputfile_path)
+    except Exception as index_err:
+        # 索引に登録できない場合も処理は続ける（必要な検証は従来どおりffprobeで行う）
+        print(f"メタデータの取得に失敗しました: {index_err}")
+        return None
+
+def is_sha256_hex(value) -> bool:
+    if not isinstance(value, str) or len(value) != 64:
+        return False
+    try:
+        int(value, 16)
+        return True
+    except ValueError:
+        return False
+
+def send_upload_reply(connection, deduplicated, session):
+    # アップロードが必要か（１バイト、0x01：保存済みのためアップロード不要、0x00：アップロードが必要）を暗号化して送信
+    session.send_frame(connection, b'\x01' if deduplicated else b'\x00')
+
 # レスポンスに関係する関数はここから実装
-def send_encrypted_response(connection, filepath, stream_rate, aes_key):
+# sendmsgでまとめて送信するフレームの合計サイズと、バッファ数の上限（IOV_MAXを超えないようにする）
+SEND_BATCH_BYTES = 256 * 1024
+SEND_BATCH_BUFFERS = 768
+
+def send_buffers(connection, buffers):
+    """複数のバッファを連結せずに1回のsendmsgで送信する関数（一部だけ送信された場合は残りを送り直す）"""
+    if not hasattr(connection, 'sendmsg'):
+        # sendmsgがない環境（Windowsなど）では連結して送信する
+        connection.sendall(b''.join(buffers))
+        return
+
+    buffers = [memoryview(buffer) for buffer in buffers]
+    while buffers:
+        sent = connection.sendmsg(buffers)
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if sent:
+            buffers[0] = buffers[0][sent:]
+
+class FrameSender:
+    """データを暗号化したフレーム（４バイトの長さ＋nonce＋暗号文＋タグ）をためて、sendmsgでまとめて送信するクラス
+
+    暗号化はflushの際にセッションの送信ロックを取ってから行い、他のスレッドが送るフレームとnonceの順番が入れ替わらないようにする
+    （ためたデータはコピーしないため、ファイルのmemoryviewなどはflushするまで有効でなければならない）
+    SEND_BATCH_BYTES以上のフレームは1フレームずつ送信するため、メモリ上に保持するのは常に1フレーム分まで
+    """
+    def __init__(self, connection, session) -> None:
+        self.connection = connection
+        self.session = session
+        # 暗号化して送るデータ（Noneは暗号化しない長さ０の区切り）
+        self.frames = []
+        self.pending_bytes = 0
+
+    def send(self, data):
+        self.frames.append(data)
+        self.pending_bytes += 4 + NONCE_SIZE + len(data) + TAG_SIZE
+
+        # 1フレームは長さ、nonce、暗号文＋タグの３つのバッファで送る
+        if self.pending_bytes >= SEND_BATCH_BYTES or len(self.frames) * 3 >= SEND_BATCH_BUFFERS:
+            self.flush()
+
+    def send_delimiter(self):
+        # ストリーミングレスポンスのデータチャンクの終わりを示す、長さ０の区切り
+        self.frames.append(None)
+        self.pending_bytes += 4
+
+    def flush(self):
+        if not self.frames:
+            return
+        frames = self.frames
+        self.frames = []
+        self.pending_bytes = 0
+
+        with self.session.send_lock:
+            buffers = []
+            for data in frames:
+                if data is None:
+                    buffers.append((0).to_bytes(4, 'big'))
+                    continue
+                nonce, sealed = self.session.seal(data)
+                buffers += [(len(nonce) + len(sealed)).to_bytes(4, 'big'), nonce, sealed]
+            send_buffers(self.connection, buffers)
+
+def send_file_frames(sender, filepath, file_size, frame_size):
+    # ファイルをメモリマップし、frame_sizeごとのmemoryviewをそのまま暗号化して送る
+    if file_size > 0:
+        with open(filepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            with memoryview(mapped_file) as view:
+                for offset in range(0, file_size, frame_size):
+                    sender.send(view[offset:offset + frame_size])
+                # マップを閉じる前に、ためたフレームを送る
+                sender.flush()
+
+def send_encrypted_response(connection, filepath, frame_size, session):
     # 各処理後にプロセス後のデータを含むレスポンスをクライアントに返す関数
     try:
-        with open(filepath, 'rb') as f:
-            f.seek(0, os.SEEK_END)
-            file_size = f.tell()
-            f.seek(0, 0)
+        started_at = time.monotonic()
+        file_size = os.path.getsize(filepath)
+        sender = FrameSender(connection, session)
 
-            # サクセスコード：１（１バイト)とファイルサイズ（８バイト）
-            success_header = b'\x01'
-            encrypted_header = encrypt_chunk(success_header, aes_key)
+        # サクセスコード：１（１バイト)とSuccessInfoのJSON
+        sender.send(b'\x01')
+        sender.send(SuccessInfo(filepath, file_size).to_json().encode('utf-8'))
 
-            connection.send(len(encrypted_header).to_bytes(4, 'big'))
-            connection.sendall(encrypted_header)
+        print(f"処理済みファイル（{file_size}バイト）を送信中")
 
-            success_json = SuccessInfo(filepath, file_size).to_json()
-            success_bytes = success_json.encode('utf-8')
-            encrypted_json = encrypt_chunk(success_bytes, aes_key)
+        send_file_frames(sender, filepath, file_size, frame_size)
+        sender.flush()
+        observe_response(started_at, file_size)
 
-            connection.send(len(encrypted_json).to_bytes(4, 'big'))
-            connection.sendall(encrypted_json)
+        print("処理済みファイルの送信完了")
+        return None
 
-            print(f"処理済みファイル（{file_size}バイト）を送信中")
+    except Exception as error:
+        print(f"ファイル送信エラー: {str(error)}")
+        return ErrorInfo('1004', f'ファイル送信エラー: {str(error)}', 'ネットワーク接続を確認してください。')
 
-            # ファイルをstream_rateサイズに分割して送る
-            total_sent = 0
-            while total_sent < file_size:
-                data = f.read(stream_rate)
-                if not data:
-                    break
+def send_encrypted_multipart_response(connection, outputs, frame_size, session):
+    """複数の処理済みファイル（[(ラベル, ファイルパス)]）を1つのレスポンスで返す関数
 
-                encrypted_chunk = encrypt_chunk(data, aes_key)
+    MultipartSuccessInfoのJSONの後に、各ファイルのデータをpartsの順に送る（ファイルの境界では必ずフレームを区切る）
+    """
+    try:
+        started_at = time.monotonic()
+        parts = [(label, filepath, os.path.getsize(filepath)) for label, filepath in outputs]
+        sender = FrameSender(connection, session)
 
-                connection.send(len(encrypted_chunk).to_bytes(4, 'big'))
-                connection.send(encrypted_chunk)
+        sender.send(b'\x01')
+        sender.send(MultipartSuccessInfo(parts).to_json().encode('utf-8'))
 
-                total_sent += len(data)
+        for label, filepath, file_size in parts:
+            print(f"処理済みファイル（{label}、{file_size}バイト）を送信中")
+            send_file_frames(sender, filepath, file_size, frame_size)
 
-            print("処理済みファイルの送信完了")
-            return None
+        sender.flush()
+        observe_response(started_at, sum(file_size for _, _, file_size in parts))
+
+        print("処理済みファイルの送信完了")
+        return None
 
     except Exception as error:
         print(f"ファイル送信エラー: {str(error)}")
         return ErrorInfo('1004', f'ファイル送信エラー: {str(error)}', 'ネットワーク接続を確認してください。')
 
-def send_encrypted_error_response(connection, error_info, aes_key):
+# ストリーミングレスポンスで出力可能な形式（拡張子ごとのFFMPEGの出力オプション）
+PIPE_OUTPUT_FORMATS = {
+    # moovを先頭に置き、キーフレームごとにフラグメントを書き出す
+    'mp4': ['-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov+default_base_moof'],
+    'mp3': ['-f', 'mp3'],
+    'webm': ['-f', 'webm'],
+    'gif': ['-f', 'gif']
+}
+
+def build_pipe_output_command(ffmpeg_cmd:list, output_filename:str):
+    """出力先（コマンドの末尾）を標準出力に置き換えたFFMPEGコマンドを返す関数"""
+    output_extension = os.path.splitext(output_filename)[1].lstrip('.').lower()
+    if output_extension not in PIPE_OUTPUT_FORMATS:
+        raise ValueError(f'ストリーミングレスポンスに対応していない形式です: {output_extension}')
+
+    return ffmpeg_cmd[:-1] + PIPE_OUTPUT_FORMATS[output_extension] + ['pipe:1']
+
+class StreamingResponse:
+    """FFMPEGの出力を受け取った順に暗号化してクライアントに送るクラス
+
+    サクセスヘッダー（file_sizeはNone、streamingはTrue）、データチャンク（４バイトの長さ＋暗号化チャンク）を送り、
+    最後に長さ０の区切りと、最終的なファイルサイズまたはエラー情報を含むトレーラーJSONを送る
+    """
+    def __init__(self, connection, output_filename, frame_size, session, tee_path=None, before_response=None) -> None:
+        self.connection = connection
+        self.output_filename = output_filename
+        self.frame_size = frame_size
+        self.session = session
+        self.sender = FrameSender(connection, session)
+        self.started = False
+        self.total_sent = 0
+        # 送信した出力を書き込むファイル（キャッシュ用）
+        self.tee_path = tee_path
+        self.tee_file = open(tee_path, 'wb') if tee_path is not None else None
+        self.before_response = before_response
+
+    def send_header(self):
+        if self.before_response is not None:
+            self.before_response()
+        self.sender.send(b'\x01')
+        self.sender.send(SuccessInfo(self.output_filename, None, streaming=True).to_json().encode('utf-8'))
+        self.sender.flush()
+
+        self.started = True
+        print("処理済みファイルをストリーミング送信中")
+
+    def send_chunk(self, data):
+        # 最初の出力が届いた時点でサクセスヘッダーを送る（それまでのエラーは通常のエラーレスポンスで返す）
+        if not self.started:
+            self.send_header()
+
+        if self.tee_file is not None:
+            self.tee_file.write(data)
+
+        with memoryview(data) as view:
+            for offset in range(0, len(data), self.frame_size):
+                self.sender.send(view[offset:offset + self.frame_size])
+            # 出力が届くたびに送信し、クライアントへの到着を遅らせない
+            self.sender.flush()
+
+        self.total_sent += len(data)
+
+    def close_tee(self):
+        if self.tee_file is not None:
+            self.tee_file.close()
+            self.tee_file = None
+
+    def discard_tee(self):
+        """エラー時に書きかけの出力ファイルを削除する関数"""
+        if self.tee_file is not None:
+            self.close_tee()
+            delete_tmp_files([self.tee_path])
+
+    def finish(self, error_info=None):
+        if not self.started:
+            self.send_header()
+
+        if error_info is None:
+            trailer = SuccessInfo(self.output_filename, self.total_sent).to_dict()
+        else:
+            trailer = error_info.to_dict()
+
+        # 長さ０の区切りとトレーラーJSONのフレームを続けて送る
+        self.sender.send_delimiter()
+        self.sender.send(json.dumps(trailer, ensure_ascii=False).encode('utf-8'))
+        self.sender.flush()
+        print(f"処理済みファイル（{self.total_sent}バイト）のストリーミング送信完了")
+
+def finish_streaming_response(response, error_info=None):
+    """ストリーミングレスポンスを終了する関数（送信開始前のエラーはそのまま返し、通常のエラーレスポンスで送る）"""
+    if response is None or (error_info is not None and not response.started):
+        return error_info
+
+    try:
+        response.finish(error_info)
+    except Exception as error:
+        print(f"ファイル送信エラー: {str(error)}")
+
+    if error_info is not None:
+        count_error(error_info)
+        print(error_info.to_json())
+    return None
+
+def send_encrypted_error_response(connection, error_info, session):
     # エラーレスポンスをクライアントに返す関数
+    count_error(error_info)
     try:
         # エラーコード：０（１バイト）とエラーJSON（ErrorInfoオブジェクト）を共にAES暗号化し、データサイズとデータを送信
-        error_header = b'\x00'
-        encrypted_header = encrypt_chunk(error_header, aes_key)
-        connection.send(len(encrypted_header).to_bytes(4, 'big'))
-        connection.sendall(encrypted_header)
-
-        error_json = error_info.to_json()
-        error_bytes = error_json.encode('utf-8')
-        encrypted_json = encrypt_chunk(error_bytes, aes_key)
-        connection.send(len(encrypted_json).to_bytes(4, 'big'))
-        connection.sendall(encrypted_json)
+        sender = FrameSender(connection, session)
+        sender.send(b'\x00')
+        sender.send(error_info.to_json().encode('utf-8'))
+        sender.flush()
 
         print(f"暗号化されたエラーレスポンス送信: {error_info.error_code}")
 
@@ -369,9 +1451,204 @@ def load_server_config():
         'server_port': config['server_port'],
         'max_storage': config['max_storage'],
         'dir_path': BASE_DIR + config['storage_dir'],
-        'stream_rate': config['stream_rate']
+        'stream_rate': config['stream_rate'],
+        'backlog': config.get('backlog', 16),
+        'connection_workers': config.get('connection_workers', 32),
+        'ffmpeg_workers': config.get('ffmpeg_workers') or os.cpu_count(),
+        'streaming_ingest': config.get('streaming_ingest', False),
+        'result_cache': config.get('result_cache', False),
+        'upload_dedup': config.get('upload_dedup', False),
+        'resumable_upload': config.get('resumable_upload', False),
+        'upload_expiry_seconds': config.get('upload_expiry_seconds', 86400),
+        'checkpoint_bytes': config.get('checkpoint_bytes', 8 * 1024 * 1024),
+        'max_frame_size': config.get('max_frame_size', 4 * 1024 * 1024),
+        'session_ticket': config.get('session_ticket', False),
+        'session_ticket_lifetime': config.get('session_ticket_lifetime', 86400),
+        'ticket_key_rotation': config.get('ticket_key_rotation', 3600),
+        'media_index': config.get('media_index', False),
+        'job_scheduler': config.get('job_scheduler', False),
+        'cpu_budget': config.get('cpu_budget') or os.cpu_count(),
+        'max_queued_jobs': config.get('max_queued_jobs', 32),
+        'interactive_cost': config.get('interactive_cost', 60),
+        'segmented_encode': config.get('segmented_encode', False),
+        'workers': config.get('workers', []),
+        'worker_token': config.get('worker_token'),
+        'worker_health_interval': config.get('worker_health_interval', 10),
+        'storage_gc_interval': config.get('storage_gc_interval', 600),
+        'orphan_seconds': config.get('orphan_seconds', 3600),
+        'metrics_address': config.get('metrics_address', '127.0.0.1'),
+        'metrics_port': config.get('metrics_port')
     }
 
+def initialize_ffmpeg_executor(config):
+    global global_ffmpeg_executor
+    # FFMPEGはCPUを占有するため、同時実行数はffmpeg_workersで制限する
+    global_ffmpeg_executor = ThreadPoolExecutor(max_workers=config['ffmpeg_workers'], thread_name_prefix='ffmpeg')
+    print(f"FFMPEGワーカー数: {config['ffmpeg_workers']}")
+
+def run_ffmpeg(ffmpeg_cmd:list):
+    """FFMPEGジョブ用のプールでコマンドを実行し、完了まで待機する関数"""
+    future = global_ffmpeg_executor.submit(feed_ffmpeg, ffmpeg_cmd)
+    return future.result()
+
+# パイプから標準出力を読み込む際の最大サイズ
+PIPE_READ_SIZE = 64 * 1024
+
+def feed_ffmpeg(ffmpeg_cmd:list, input_chunks=None, on_output=None):
+    """FFMPEGの標準入力へのチャンクの書き込みと、標準出力の受け取りを行いながら実行する関数
+
+    結果のcpu_secondsには、FFMPEGが使用したCPU時間（秒、計測できない環境ではNone）を入れる
+    """
+    process = subprocess.Popen(
+        ffmpeg_cmd,
+        stdin=subprocess.PIPE if input_chunks is not None else subprocess.DEVNULL,
+        stdout=subprocess.PIPE if on_output is not None else subprocess.DEVNULL,
+        stderr=subprocess.PIPE
+    )
+    if global_metrics is not None:
+        global_metrics.ffmpeg_in_flight.inc()
+
+    # 標準エラー出力のパイプが詰まるとFFMPEGが停止するため、別スレッドで読み続ける
+    stderr_chunks = []
+    stderr_reader = threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True)
+    stderr_reader.start()
+
+    input_errors = []
+
+    def write_input():
+        try:
+            for chunk in input_chunks:
+                process.stdin.write(chunk)
+        except BrokenPipeError:
+            # FFMPEGが入力を読み終える前に終了した場合は終了コードで判定する
+            pass
+        except BaseException as e:
+            input_errors.append(e)
+            process.kill()
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    input_writer = None
+
+    try:
+        if on_output is None:
+            if input_chunks is not None:
+                write_input()
+        else:
+            # 入力と出力を同時に扱う場合は、入力の書き込みを別スレッドで行う
+            if input_chunks is not None:
+                input_writer = threading.Thread(target=write_input, daemon=True)
+                input_writer.start()
+
+            while True:
+                data = process.stdout.read1(PIPE_READ_SIZE)
+                if not data:
+                    break
+                on_output(data)
+
+    except BaseException:
+        process.kill()
+        raise
+
+    finally:
+        if input_writer is not None:
+            input_writer.join()
+        cpu_seconds = wait_process(process)
+        stderr_reader.join()
+        if global_metrics is not None:
+            global_metrics.ffmpeg_in_flight.dec()
+
+    if input_errors:
+        raise input_errors[0]
+
+    result = subprocess.CompletedProcess(ffmpeg_cmd, process.returncode, None, b''.join(stderr_chunks))
+    result.cpu_seconds = cpu_seconds
+    return result
+
+def wait_process(process):
+    """プロセスの終了を待ち、使用したCPU時間（秒）を返す関数（wait4がない環境ではNone）"""
+    if not hasattr(os, 'wait4'):
+        process.wait()
+        return None
+
+    _, status, usage = os.wait4(process.pid, 0)
+    # 終了を待ったプロセスをPopenが待ち直さないよう、終了コードを設定する
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return usage.ru_utime + usage.ru_stime
+
+def initialize_content_caches(config):
+    global global_result_cache, global_source_cache
+
+    # 作業用のファイルのためにmax_storageの半分を残し、処理結果と入力の両方を保存する場合は残りを半分ずつ割り当てる
+    enabled_caches = int(config['result_cache']) + int(config['upload_dedup'])
+    if enabled_caches == 0:
+        return
+    max_bytes = config['max_storage'] // 2 // enabled_caches
+
+    if config['result_cache']:
+        global_result_cache = ContentCache(os.path.join(config['dir_path'], 'cache'), max_bytes)
+        print(f"処理結果のキャッシュを有効化: {global_result_cache.stats()}")
+
+    if config['upload_dedup']:
+        global_source_cache = ContentCache(os.path.join(config['dir_path'], 'sources'), max_bytes)
+        print(f"アップロードの重複排除を有効化: {global_source_cache.stats()}")
+
+def initialize_storage_manager(config):
+    global global_storage_manager
+
+    global_storage_manager = StorageManager(config['dir_path'], config['max_storage'], config['orphan_seconds'])
+    # 前回の異常終了などで残ったジョブのファイルを削除してから受け付けを始める
+    global_storage_manager.start_collector(config['storage_gc_interval'])
+    print(f"保存領域の管理を開始（上限: {config['max_storage']}バイト）: {global_storage_manager.stats()}")
+
+def initialize_media_index(config):
+    global global_media_index
+    if not config['media_index']:
+        return
+
+    global_media_index = MediaIndex(os.path.join(config['dir_path'], 'metadata'))
+    print(f"メタデータの索引を有効化: {global_media_index.stats()}")
+
+def initialize_job_scheduler(config):
+    global global_job_scheduler
+    if not config['job_scheduler']:
+        return
+
+    # 同時に実行するジョブの数はFFMPEGワーカー数と同じにし、cpu_budgetをそれぞれのスレッド数に分ける
+    global_job_scheduler = JobScheduler(
+        config['cpu_budget'],
+        config['ffmpeg_workers'],
+        config['max_queued_jobs'],
+        config['interactive_cost']
+    )
+    print(f"ジョブのスケジューラーを有効化（CPU: {config['cpu_budget']}、1ジョブあたりのスレッド数: {global_job_scheduler.threads_per_job}）")
+
+def initialize_worker_pool(config):
+    global global_worker_pool
+    if not config['workers']:
+        return
+
+    global_worker_pool = WorkerPool(config['workers'], config['worker_token'], config['worker_health_interval'])
+    global_worker_pool.start_health_checks()
+    print(f"ワーカーへの分散を有効化（使用できるワーカー: {len(global_worker_pool.healthy_nodes())}/{len(global_worker_pool.nodes)}）")
+
+def initialize_upload_manager(config):
+    global global_upload_manager
+    if not config['resumable_upload']:
+        return
+
+    global_upload_manager = ResumableUploadManager(
+        os.path.join(config['dir_path'], 'partial'),
+        config['upload_expiry_seconds'],
+        config['checkpoint_bytes']
+    )
+    # 起動時と、その後は有効期限の1/24ごとに放置されたアップロードを削除する
+    global_upload_manager.start_expiry_sweeper(max(config['upload_expiry_seconds'] // 24, 60))
+    print("再開可能なアップロードを有効化")
+
 def delete_tmp_files(file_paths_to_delete:list):
     """指定されたパスのファイルを削除する関数"""
     for file_path in file_paths_to_delete:
@@ -411,23 +1688,555 @@ class RSAManager:
         )
         return decrypted_bytes
 
+# アクションごとの処理名とエラー情報（エラーコード、説明、解決策）
+ACTION_ERROR_INFO = {
+    1: ('動画圧縮', '1002', '動画圧縮中のエラー', 'FFMPEGが正しくインストールされているか確認してください。'),
+    2: ('解像度変更', '1003', '動画処理中のエラー', 'FFMPEGが正しくインストールされているか確認してください。'),
+    3: ('アスペクト比変更', '1004', '動画のアスペクト比変更中のエラー', 'アップロード動画を確認し再度アップロードおよび操作をしてください、解決しない場合は管理者にお問い合わせください。'),
+    4: ('オーディオへの変換', '1005', 'オーディオへの変換中のエラー', 'アップロード動画を確認し再度アップロードおよび操作をしてください、解決しない場合は管理者にお問い合わせください。'),
+    5: ('時間範囲での動画を作成', '1006', '動画処理中のエラー', 'アップロードした動画を再度確認し、再度トライしてください。'),
+    6: ('複数の処理をまとめて実行', '1008', '複数の処理をまとめて実行中のエラー', '処理の組み合わせを確認し、再度トライしてください。'),
+    7: ('複数の解像度への変換', '1009', '複数の解像度への変換中のエラー', '解像度の指定を確認し、再度トライしてください。')
+}
+
+def create_action_error(action, process_err) -> ErrorInfo:
+    if action not in ACTION_ERROR_INFO:
+        return ErrorInfo('1002', f'未対応のアクションです: {action}', 'メニュー内のアクションを指定してください。')
+
+    label, code, description, solution = ACTION_ERROR_INFO[action]
+    print(f"{label}エラー: {str(process_err)}")
+    return ErrorInfo(code, f'{description}: {str(process_err)}', solution)
+
+def prepare_action(action, input_filename, dir_path, req_data, input_path=None, input_file_size=None, media_info=None):
+    """アクションに対応する出力ファイル名、出力パス、FFMPEGコマンドを返す関数
+
+    input_pathを指定した場合は保存済みファイルの代わりにそのパス（pipe:0など）を入力とする
+    media_infoを指定した場合は、結果が同じになるならストリームのコピー（再エンコードなし）のコマンドにする
+    """
+    match action:
+        case 1:
+            return build_compress_command(input_filename, dir_path, input_path, input_file_size)
+        case 2:
+            return build_resolution_command(input_filename, dir_path, req_data, input_path, media_info)
+        case 3:
+            return build_aspect_command(input_filename, dir_path, req_data, input_path, media_info)
+        case 4:
+            return build_audio_command(input_filename, dir_path, input_path, media_info)
+        case 5:
+            return build_clip_command(input_filename, dir_path, req_data, input_path, media_info)
+        case 6:
+            return build_chain_command(input_filename, dir_path, req_data, input_path, input_file_size, media_info)
+        case _:
+            raise ValueError(f'未対応のアクションです: {action}')
+
+def execute_ffmpeg(ffmpeg_cmd:list, input_chunks=None, on_output=None, threads=None, progress=None):
+    """FFMPEGを実行する関数
+
+    input_chunksを指定した場合は標準入力に書き込み、on_outputを指定した場合は標準出力を受け取るたびに呼び出す
+    threadsを指定した場合は、デコード・エンコードのスレッド数をその数に制限する
+    progress（FfmpegProgress）を指定した場合は、-progressで標準出力に書き出される進捗を読み取らせる（on_outputとは併用できない）
+    """
+    if threads is not None:
+        ffmpeg_cmd = apply_ffmpeg_threads(ffmpeg_cmd, threads)
+    if progress is not None:
+        ffmpeg_cmd = [ffmpeg_cmd[0], '-progress', 'pipe:1', '-nostats'] + ffmpeg_cmd[1:]
+        on_output = progress.feed
+    print(f"FFMPEG実行中: {' '.join(ffmpeg_cmd)}")
+
+    if input_chunks is None and on_output is None:
+        result = run_ffmpeg(ffmpeg_cmd)
+    else:
+        result = global_ffmpeg_executor.submit(feed_ffmpeg, ffmpeg_cmd, input_chunks, on_output).result()
+    add_ffmpeg_cpu_seconds(current_ffmpeg_usage(), result)
+
+    if result.returncode != 0:
+        raise Exception(f"FFMPEG エラー: {result.stderr}")
+
+# エンコードの進捗に関する関数はここから実装
+# 進捗のフレームを送る間隔（秒）
+PROGRESS_INTERVAL = 1.0
+
+class FfmpegProgress:
+    """FFMPEGの-progressの出力（key=valueの行）を読み取り、1回分（progress=の行まで）ごとにon_progressを呼び出すクラス"""
+    def __init__(self, total_seconds, on_progress=None) -> None:
+        # 出力の長さ（わからない場合はNoneで、割合と残り時間は計算しない）
+        self.total_seconds = total_seconds
+        self.on_progress = on_progress or (lambda progress: None)
+        self.started_at = time.monotonic()
+        self.buffer = b''
+        self.values = {}
+        # 最後に読み取った進捗
+        self.latest = None
+
+    def feed(self, data):
+        lines = (self.buffer + data).split(b'\n')
+        self.buffer = lines.pop()
+
+        for line in lines:
+            key, _, value = line.decode('utf-8', errors='replace').strip().partition('=')
+            if key != 'progress':
+                self.values[key] = value
+                continue
+
+            out_time_us = parse_number(self.values.get('out_time_us'), int)
+            out_seconds = max(out_time_us, 0) / 1000000 if out_time_us is not None else None
+            # speedは「1.5x」のような表記（開始直後はN/A）
+            speed = parse_number(self.values.get('speed', '').rstrip('x'))
+            self.update(out_seconds, speed, parse_number(self.values.get('fps')), finished=value == 'end')
+            self.values = {}
+
+    def update(self, out_seconds, speed, fps, finished=False):
+        self.latest = self.to_dict(out_seconds, speed, fps)
+        if not finished:
+            self.on_progress(self.latest)
+
+    def to_dict(self, out_seconds, speed, fps) -> dict:
+        """進捗（割合、出力済みの長さ、エンコード速度、fps、残り時間の推定、経過時間）を返す関数"""
+        percent = None
+        eta_seconds = None
+        if self.total_seconds and out_seconds is not None:
+            percent = min(out_seconds / self.total_seconds * 100, 100.0)
+            if speed:
+                eta_seconds = max(self.total_seconds - out_seconds, 0) / speed
+
+        return {
+            'percent': percent,
+            'out_seconds': out_seconds,
+            'speed': speed,
+            'fps': fps,
+            'eta_seconds': eta_seconds,
+            'elapsed_seconds': time.monotonic() - self.started_at
+        }
+
+def get_expected_output_seconds(action, req_data, media_info, inputfile_path=None):
+    """出力の長さを返す関数（進捗の割合の計算に使う、わからない場合はNone）
+
+    索引のメタデータがない保存済みの入力は、ffprobeで長さを取得する
+    """
+    match action:
+        case 5:
+            return float(req_data.get('endseconds')) - float(req_data.get('startseconds'))
+        case 6:
+            clip_range = resolve_clip_range(req_data.get('operations') or [])
+            if clip_range is not None:
+                return clip_range[1] - clip_range[0]
+
+    if media_info is not None and media_info.get('duration') is not None:
+        return media_info['duration']
+    if inputfile_path is not None:
+        return get_video_duration(inputfile_path)
+    return None
+
+def create_progress(action, req_data, media_info, inputfile_path, on_progress=None):
+    """FFMPEGの進捗を読み取るFfmpegProgressを返す関数（出力の長さはon_progressを指定した場合のみ求める）"""
+    total_seconds = None
+    if on_progress is not None:
+        try:
+            total_seconds = get_expected_output_seconds(action, req_data, media_info, inputfile_path)
+        except (TypeError, ValueError):
+            # 長さがわからない場合も、出力済みの長さとエンコード速度は送る
+            pass
+
+    return FfmpegProgress(total_seconds, on_progress)
+
+def log_encode_speed(action, progress):
+    # プリセットの調整に使えるよう、アクションごとの最終的なエンコード速度を記録する
+    if progress.latest is None:
+        return
+
+    latest = progress.latest
+    speed = f"{latest['speed']:.2f}x" if latest['speed'] is not None else '不明'
+    fps = f"、{latest['fps']:.1f}fps" if latest['fps'] is not None else ''
+    print(
+        f"{ACTION_ERROR_INFO[action][0]}のエンコード速度: {speed}{fps}"
+        f"（出力{latest['out_seconds'] or 0:.1f}秒、経過{latest['elapsed_seconds']:.1f}秒）"
+    )
+
+def send_encrypted_progress(connection, progress:dict, session):
+    # 進捗コード：２（１バイト）と進捗のJSONを送る（サクセスコードまたはエラーコードの前に0回以上送る）
+    sender = FrameSender(connection, session)
+    sender.send(b'\x02')
+    sender.send(json.dumps(progress).encode('utf-8'))
+    sender.flush()
+
+# ジョブのスケジューリングに関する関数はここから実装
+# 推定コストの単位（1080pの映像1秒を、fastプリセットのlibx264でエンコードする処理量を1とする）
+REFERENCE_PIXELS = 1920 * 1080
+# libx264のプリセットごとの処理量の倍率
+PRESET_COST_FACTORS = {'ultrafast': 0.3, 'fast': 1.0, 'medium': 2.0, 'slow': 4.0}
+# ストリームのコピー、音声のみの変換、GIFへの変換の、映像のエンコードに対する処理量の倍率
+COPY_COST_FACTOR = 0.01
+AUDIO_COST_FACTOR = 0.05
+GIF_COST_FACTOR = 2.0
+# メタデータがない場合に、入力のサイズから長さを推定する際のビットレート（8Mbps）
+FALLBACK_BIT_RATE = 8 * 1000 * 1000
+# 値を取らないFFMPEGのオプション（これ以外の-で始まる引数は、次の引数を値として取る）
+FFMPEG_FLAG_OPTIONS = {'-y', '-n', '-sn', '-dn', '-vn', '-an', '-shortest', '-nostdin', '-nostats'}
+
+def admit_job(job, upload_size) -> ErrorInfo | None:
+    """受信する入力と出力の推定サイズの保存領域を予約し、スケジューラーにジョブを受け付けさせる関数（受け付けられない場合はErrorInfoを返す）"""
+    if global_storage_manager is not None:
+        try:
+            global_storage_manager.reserve(job.storage_key, upload_size + estimate_output_bytes(job.action, job.req_data, job.upload.file_size))
+        except StorageError as storage_err:
+            print(f"ジョブを受け付けられません: {global_storage_manager.stats()}")
+            return ErrorInfo('1011', f'保存領域が不足しています: {str(storage_err)}', 'しばらく待ってから再度お試しください。')
+
+    if global_job_scheduler is None:
+        return None
+
+    try:
+        job.ticket = global_job_scheduler.admit()
+    except AdmissionError as admission_err:
+        print(f"ジョブを受け付けられません: {global_job_scheduler.stats()}")
+        return ErrorInfo('1010', f'サーバーが混み合っています: {str(admission_err)}', 'しばらく待ってから再度お試しください。')
+
+    return None
+
+def estimate_output_bytes(action, req_data, input_file_size) -> int:
+    """出力に必要な領域の推定（出力1つあたり入力と同程度とし、複数の解像度は出力の数、区間に分けるエンコードは区間と連結後の2つ分）"""
+    output_count = 1
+    if action == 7:
+        output_count = max(len(req_data.get('resolutions') or []) + int(bool(req_data.get('audio', False))), 1)
+    elif action in SEGMENTED_ACTIONS:
+        output_count = 2
+    return input_file_size * output_count
+
+def acquire_job_slot(ticket, action, req_data, media_info, input_file_size):
+    """FFMPEGを実行する順番が来るまで待ち、割り当てられたスレッド数を返す関数（スケジューラーが無効の場合はNone）"""
+    if ticket is None:
+        return None
+
+    try:
+        cost = estimate_job_cost(action, req_data, media_info, input_file_size)
+    except (TypeError, ValueError, KeyError):
+        # パラメータが不正なジョブはFFMPEGの実行前にエラーになるため、待たせずに実行する
+        cost = 0
+
+    threads = global_job_scheduler.acquire(ticket, cost)
+    print(f"ジョブを開始します（推定コスト: {cost:.1f}、優先度: {ticket.priority_name}、スレッド数: {threads}）: {global_job_scheduler.stats()}")
+    return threads
+
+def release_job_slot(ticket):
+    if ticket is not None:
+        global_job_scheduler.release(ticket)
+
+def estimate_job_cost(action, req_data, media_info, input_file_size) -> float:
+    """ジョブの処理量を、1080pの映像1秒をエンコードする量を1として見積もる関数
+
+    media_infoがない場合は、入力のサイズとFALLBACK_BIT_RATEから長さを推定し、1080pとして扱う
+    """
+    duration = (media_info or {}).get('duration') or input_file_size * 8 / FALLBACK_BIT_RATE
+    video_size = get_video_size(media_info)
+    input_scale = video_size[0] * video_size[1] / REFERENCE_PIXELS if video_size and all(video_size) else 1.0
+
+    match action:
+        case 1:
+            return duration * input_scale * PRESET_COST_FACTORS[select_compress_preset(input_file_size)]
+        case 2:
+            width, height = RESOLUTION_CHOICES[req_data.get('resolution')]
+            if video_size == (width, height) and can_copy_to_mp4(media_info):
+                return duration * COPY_COST_FACTOR
+            return duration * max(input_scale, width * height / REFERENCE_PIXELS)
+        case 3:
+            if can_copy_to_mp4(media_info):
+                return duration * COPY_COST_FACTOR
+            return duration * input_scale * PRESET_COST_FACTORS['ultrafast']
+        case 4:
+            return duration * AUDIO_COST_FACTOR
+        case 5:
+            clip_seconds = max(float(req_data.get('endseconds')) - float(req_data.get('startseconds')), 0)
+            match select_clip_mode(req_data, media_info):
+                case 'keyframe':
+                    return clip_seconds * COPY_COST_FACTOR
+                case 'exact':
+                    # 再エンコードするのは両端の最大2GOP分
+                    gop_seconds = duration / len(media_info['keyframes'])
+                    return clip_seconds * COPY_COST_FACTOR + min(clip_seconds, 2 * gop_seconds) * input_scale
+            cost_factor = GIF_COST_FACTOR if str(req_data.get('extension')).lower() == 'gif' else 1.0
+            return clip_seconds * input_scale * cost_factor
+        case 6:
+            operations = req_data.get('operations') or []
+            clip_range = resolve_clip_range(operations)
+            seconds = clip_range[1] - clip_range[0] if clip_range is not None else duration
+            actions = [operation.get('action') for operation in operations]
+            if 4 in actions:
+                return seconds * AUDIO_COST_FACTOR
+            cost_factor = PRESET_COST_FACTORS[select_compress_preset(input_file_size)] if 1 in actions else 1.0
+            return seconds * input_scale * cost_factor
+        case 7:
+            cost = duration * AUDIO_COST_FACTOR if req_data.get('audio', False) else 0.0
+            for resolution in dict.fromkeys(req_data.get('resolutions') or []):
+                width, height = RESOLUTION_CHOICES[resolution]
+                if video_size == (width, height) and can_copy_to_mp4(media_info):
+                    cost += duration * COPY_COST_FACTOR
+                else:
+                    cost += duration * width * height / REFERENCE_PIXELS
+            return cost
+        case _:
+            return 0.0
+
+def apply_ffmpeg_threads(ffmpeg_cmd:list, threads:int) -> list:
+    """FFMPEGのコマンドに、フィルター・各入力のデコード・各出力のエンコードのスレッド数の指定を追加する関数"""
+    thread_options = ['-threads', str(threads)]
+    limited_cmd = [ffmpeg_cmd[0], '-filter_threads', str(threads), '-filter_complex_threads', str(threads)]
+
+    index = 1
+    while index < len(ffmpeg_cmd):
+        argument = ffmpeg_cmd[index]
+        if argument == '-i':
+            limited_cmd += thread_options + ffmpeg_cmd[index:index + 2]
+            index += 2
+        elif argument.startswith('-') and argument not in FFMPEG_FLAG_OPTIONS:
+            limited_cmd += ffmpeg_cmd[index:index + 2]
+            index += 2
+        elif argument.startswith('-'):
+            limited_cmd.append(argument)
+            index += 1
+        else:
+            # オプションの値ではない引数は出力ファイル（pipe:1を含む）
+            limited_cmd += thread_options + [argument]
+            index += 1
+
+    return limited_cmd
+
+# 分割エンコードに関する関数はここから実装
+# 分割してエンコードできるアクション（圧縮、解像度の変更、アスペクト比の変更）
+SEGMENTED_ACTIONS = (1, 2, 3)
+# 1区間あたりの最短の長さ（秒）（短すぎるとFFMPEGの起動とエンコーダーの立ち上がりの分だけ遅くなる）
+MIN_SEGMENT_SECONDS = 30
+
+def is_stream_copy(ffmpeg_cmd:list) -> bool:
+    return '-c:v' in ffmpeg_cmd and ffmpeg_cmd[ffmpeg_cmd.index('-c:v') + 1] == 'copy'
+
+def plan_encode_segments(config, action, ffmpeg_cmd, media_info, cores):
+    """入力のキーフレームの位置で区切った、並列にエンコードする区間の（開始秒、終了秒）のリストを返す関数
+
+    区間の数は、動画の長さをMIN_SEGMENT_SECONDSで割った数と、使えるCPUの数の小さい方にする
+    分割しない場合（無効、対象外のアクション、ストリームのコピー、メタデータがない、短い動画）はNoneを返す（最後の区間の終了秒はNone）
+    """
+    if not config['segmented_encode'] or action not in SEGMENTED_ACTIONS or media_info is None or is_stream_copy(ffmpeg_cmd):
+        return None
+
+    duration = media_info.get('duration')
+    keyframes = media_info.get('keyframes')
+    if not duration or not keyframes:
+        return None
+
+    segment_count = min(cores, int(duration // MIN_SEGMENT_SECONDS))
+    if segment_count < 2:
+        return None
+
+    # 均等に区切った位置に最も近いキーフレームで区切る（同じキーフレームになった区切りはまとめる）
+    cut_points = sorted({
+        min(keyframes, key=lambda keyframe: abs(keyframe - duration * index / segment_count))
+        for index in range(1, segment_count)
+    } - {keyframes[0]})
+    if not cut_points:
+        return None
+
+    boundaries = [0.0] + cut_points
+    return [(start, end) for start, end in zip(boundaries, cut_points + [None])]
+
+def build_segment_command(ffmpeg_cmd:list, startseconds, endseconds, segment_path):
+    # アクションのコマンド（ffmpeg -y -i 入力 オプション 出力）と同じ映像の設定で、区間の映像だけをエンコードする
+    input_index = ffmpeg_cmd.index('-i')
+    input_path = ffmpeg_cmd[input_index + 1]
+    options = ffmpeg_cmd[input_index + 2:-1]
+
+    # 音声は連結の際に元のファイルから入れるため、音声の設定は除く
+    video_options = []
+    index = 0
+    while index < len(options):
+        if options[index] in ('-c:a', '-acodec'):
+            index += 2
+            continue
+        video_options.append(options[index])
+        index += 1
+
+    segment_cmd = ['ffmpeg', '-y', '-ss', str(startseconds), '-i', input_path]
+    if endseconds is not None:
+        segment_cmd += ['-t', str(endseconds - startseconds)]
+    return segment_cmd + video_options + ['-an', segment_path]
+
+def build_segment_concat_command(ffmpeg_cmd:list, list_path, output_path):
+    # 区間の映像を連結し、元のファイルの音声と合わせる（どちらもコピー）
+    input_path = ffmpeg_cmd[ffmpeg_cmd.index('-i') + 1]
+    concat_cmd = [
+        'ffmpeg',
+        '-y',
+        '-f', 'concat',
+        '-safe', '0',
+        '-i', list_path,
+        '-i', input_path,
+        '-map', '0:v',
+        '-map', '1:a?',
+        '-c', 'copy'
+    ]
+    # コンテナの表示アスペクト比も、元のコマンドと同じにする
+    if '-aspect' in ffmpeg_cmd:
+        concat_cmd += ['-aspect', ffmpeg_cmd[ffmpeg_cmd.index('-aspect') + 1]]
+    return concat_cmd + [output_path]
+
+def run_segmented_encode(ffmpeg_cmd:list, output_path, segments:list, cores:int, progress, input_hash=None):
+    """各区間を別々のFFMPEGのプロセスで同時にエンコードし、再エンコードせずに連結する関数
+
+    区間はキーフレームから始まるため、同じ設定でエンコードした映像はそのまま連結できる
+    input_hashを指定し、ワーカーがある場合は各区間をワーカーで実行する（実行できない場合はこのサーバーでエンコードし直す）
+    このサーバーでは、同時に実行するプロセスをcores個までにし、coresを区間の数で分けたスレッド数を各プロセスに割り当てる
+    （スケジューラーが無効の場合は、他のジョブのFFMPEGと同じFFMPEGワーカーの枠で実行する）
+    """
+    base_path = os.path.splitext(output_path)[0]
+    extension = os.path.splitext(output_path)[1]
+    segment_paths = [f'{base_path}_segment{index}{extension}' for index in range(len(segments))]
+    list_path = f'{base_path}_segments.txt'
+    threads = max(cores // len(segments), 1)
+
+    # 各区間の進捗を合計して、1つのエンコードの進捗として通知する
+    segment_seconds = [0.0] * len(segments)
+    segment_fps = [0.0] * len(segments)
+    progress_lock = threading.Lock()
+    # 区間のFFMPEGは別スレッドで実行するため、このスレッドで計測中のCPU時間に加える
+    usage = current_ffmpeg_usage()
+
+    def create_segment_progress(index):
+        def on_segment_progress(segment_progress):
+            with progress_lock:
+                segment_seconds[index] = segment_progress['out_seconds'] or 0.0
+                segment_fps[index] = segment_progress['fps'] or 0.0
+                out_seconds = sum(segment_seconds)
+                elapsed_seconds = time.monotonic() - progress.started_at
+                speed = out_seconds / elapsed_seconds if elapsed_seconds > 0 else None
+                progress.update(out_seconds, speed, sum(segment_fps))
+        return on_segment_progress
+
+    def encode_segment(index):
+        startseconds, endseconds = segments[index]
+        segment_cmd = apply_ffmpeg_threads(build_segment_command(ffmpeg_cmd, startseconds, endseconds, segment_paths[index]), threads)
+        segment_cmd = [segment_cmd[0], '-progress', 'pipe:1', '-nostats'] + segment_cmd[1:]
+        print(f"FFMPEG実行中（区間{index + 1}/{len(segments)}）: {' '.join(segment_cmd)}")
+
+        on_output = FfmpegProgress(None, create_segment_progress(index)).feed
+        if global_job_scheduler is None:
+            result = global_ffmpeg_executor.submit(feed_ffmpeg, segment_cmd, None, on_output).result()
+        else:
+            # スケジューラーが割り当てたスレッド数の範囲で実行するため、FFMPEGワーカーの枠は使わない
+            result = feed_ffmpeg(segment_cmd, None, on_output)
+        add_ffmpeg_cpu_seconds(usage, result)
+        if result.returncode != 0:
+            raise Exception(f"FFMPEG エラー（区間{index + 1}）: {result.stderr}")
+
+    worker_tasks = []
+    if input_hash is not None:
+        input_path = ffmpeg_cmd[ffmpeg_cmd.index('-i') + 1]
+        worker_tasks = [
+            build_worker_task(build_segment_command(ffmpeg_cmd, startseconds, endseconds, segment_paths[index]), input_path, input_hash, segment_paths[index], create_segment_progress(index))
+            for index, (startseconds, endseconds) in enumerate(segments)
+        ]
+
+    try:
+        if not run_on_workers(worker_tasks):
+            with ThreadPoolExecutor(max_workers=min(len(segments), cores), thread_name_prefix='segment') as segment_executor:
+                for future in [segment_executor.submit(encode_segment, index) for index in range(len(segments))]:
+                    future.result()
+
+        with open(list_path, 'w', encoding='utf-8') as f:
+            for segment_path in segment_paths:
+                f.write(f"file '{segment_path}'\n")
+
+        execute_ffmpeg(build_segment_concat_command(ffmpeg_cmd, list_path, output_path))
+
+    finally:
+        delete_tmp_files(segment_paths + [list_path])
+
+    # 連結後の長さと速度を最終的な進捗にする
+    elapsed_seconds = time.monotonic() - progress.started_at
+    progress.update(sum(segment_seconds), sum(segment_seconds) / elapsed_seconds if elapsed_seconds > 0 else None, sum(segment_fps), finished=True)
+
+# ワーカーへの分散に関する関数はここから実装
+def get_worker_capacity() -> int:
+    # 使用できるワーカーが同時に実行できるFFMPEGの数の合計（ワーカーがない場合は0）
+    if global_worker_pool is None:
+        return 0
+    return global_worker_pool.total_capacity()
+
+def build_worker_task(ffmpeg_cmd:list, input_path, input_hash, output_path, on_progress=None):
+    """保存済みの入力1つから出力1つを作るコマンドを、ワーカーで実行するWorkerTaskにする関数（それ以外のコマンドはNone）"""
+    if ffmpeg_cmd.count('-i') != 1 or ffmpeg_cmd[ffmpeg_cmd.index('-i') + 1] != input_path or ffmpeg_cmd[-1] != output_path:
+        return None
+
+    # ワーカーは入力と出力のパスを自身の保存先に置き換えて実行する
+    worker_cmd = ffmpeg_cmd[:-1] + ['{output}']
+    worker_cmd[worker_cmd.index('-i') + 1] = '{input}'
+    return WorkerTask(worker_cmd, input_path, input_hash, output_path, on_progress)
+
+def run_on_workers(worker_tasks:list) -> bool:
+    """タスクをワーカーで実行する関数（ワーカーがない、またはワーカーで実行できなかった場合はFalseを返す）"""
+    if global_worker_pool is None or not worker_tasks or None in worker_tasks:
+        return False
+
+    try:
+        global_worker_pool.run_tasks(worker_tasks)
+        return True
+    except WorkerError as worker_err:
+        print(f"ワーカーで実行できないため、このサーバーで実行します: {worker_err}")
+        return False
+
+def execute_on_workers(ffmpeg_cmd:list, input_hash, output_path, progress) -> bool:
+    """アクションのコマンド全体を1つのワーカーで実行する関数（実行できなかった場合はFalse）"""
+    if global_worker_pool is None or input_hash is None:
+        return False
+
+    # ワーカーの進捗には割合が含まれないため、このサーバーで出力の長さから計算し直す
+    def on_worker_progress(worker_progress):
+        progress.update(worker_progress['out_seconds'], worker_progress['speed'], worker_progress['fps'])
+
+    input_path = ffmpeg_cmd[ffmpeg_cmd.index('-i') + 1] if '-i' in ffmpeg_cmd else None
+    worker_task = build_worker_task(ffmpeg_cmd, input_path, input_hash, output_path, on_worker_progress)
+    if not run_on_workers([worker_task]):
+        return False
+
+    # 出力の受信までを含めた経過時間を、最終的な進捗にする
+    if progress.latest is not None:
+        latest = progress.latest
+        progress.update(latest['out_seconds'], latest['speed'], latest['fps'], finished=True)
+    return True
+
+# 再エンコードを省略できるかの判定に関する関数はここから実装
+# MP4にそのまま格納できる映像・音声のコーデック
+MP4_VIDEO_CODECS = ('h264', 'hevc', 'mpeg4', 'av1')
+MP4_AUDIO_CODECS = ('aac', 'mp3', 'ac3', 'eac3', 'alac', 'opus')
+# 映像・音声をコピーしてMP4に格納する（字幕とデータのストリームは含めない）
+MP4_STREAM_COPY_OPTIONS = ['-c:v', 'copy', '-c:a', 'copy', '-sn', '-dn']
+
+def can_copy_to_mp4(media_info) -> bool:
+    """入力の映像と音声を、再エンコードせずにMP4に格納できるかを返す関数（メタデータがない場合はFalse）"""
+    if media_info is None or media_info.get('video') is None:
+        return False
+    if media_info['video'].get('codec') not in MP4_VIDEO_CODECS:
+        return False
+
+    audio = media_info.get('audio')
+    return audio is None or audio.get('codec') in MP4_AUDIO_CODECS
+
+def get_video_size(media_info):
+    """入力の映像の（幅、高さ）を返す関数（メタデータがない場合はNone）"""
+    video = (media_info or {}).get('video')
+    if video is None:
+        return None
+    return video.get('width'), video.get('height')
+
 # 動画圧縮に関する関数はここから実装
-def compress_video(input_filename, dir_path):
-    input_path = os.path.join(dir_path, input_filename)
+def build_compress_command(input_filename, dir_path, input_path=None, input_file_size=None):
+    input_path = input_path or os.path.join(dir_path, input_filename)
     base_name = input_filename.split('.')[0]
     output_filename = f"{base_name}_compressed.mp4"
     output_path = os.path.join(dir_path, output_filename)
 
-    # 入力ファイルのサイズ取得(MB)
-    input_file_size = os.path.getsize(input_path) / (1024 * 1024)
-
-    # 圧縮率を動的に決定
-    if input_file_size > 300:
-        preset = 'slow'
-    elif input_file_size > 100:
-        preset = 'medium'
-    else:
-        preset = 'fast'
+    # 入力ファイルのサイズ取得
+    if input_file_size is None:
+        input_file_size = os.path.getsize(input_path)
+    preset = select_compress_preset(input_file_size)
 
     ffmpeg_cmd = [
         'ffmpeg',
@@ -440,57 +2249,147 @@ def compress_video(input_filename, dir_path):
         output_path
     ]
 
-    print(f"FFMPEG実行中: {' '.join(ffmpeg_cmd)}")
+    return output_filename, output_path, ffmpeg_cmd
 
-    result = subprocess.run(ffmpeg_cmd, capture_output=True, text=False)
-    if result.returncode != 0:
-        raise Exception(f"FFMPEG エラー: {result.stderr}")
+def select_compress_preset(input_file_size:int) -> str:
+    # 入力ファイルのサイズ(MB)から圧縮率を動的に決定
+    input_file_size = input_file_size / (1024 * 1024)
 
-    return output_filename, output_path
+    if input_file_size > 300:
+        return 'slow'
+    elif input_file_size > 100:
+        return 'medium'
+    else:
+        return 'fast'
 
 # 動画解像度などの機能的な関数はここから実装
-def handle_resolution_change(input_filename, dir_path, req_data):
+RESOLUTION_CHOICES = {
+    "480p": (854, 480),
+    "720p": (1280, 720),
+    "1080p": (1920, 1080),
+    "1440p": (2560, 1440),
+    "4K": (3840, 2160)
+}
+
+def build_resolution_command(input_filename, dir_path, req_data, input_path=None, media_info=None):
     chosen_resolution = req_data.get('resolution', 0)
 
-    input_path = os.path.join(dir_path, input_filename)
+    input_path = input_path or os.path.join(dir_path, input_filename)
     base_name = input_filename.split('.')[0]
     output_filename = f"{base_name}_{chosen_resolution}.mp4"
     output_path = os.path.join(dir_path, output_filename)
 
-    resolution_choices = {
-        "480p": (854, 480),
-        "720p": (1280, 720),
-        "1080p": (1920, 1080),
-        "1440p": (2560, 1440),
-        "4K": (3840, 2160)
-    }
+    width, height = RESOLUTION_CHOICES[chosen_resolution]
+
+    if get_video_size(media_info) == (width, height) and can_copy_to_mp4(media_info):
+        # 既に指定の解像度の場合は、再エンコードせずにMP4に入れ直すだけにする
+        ffmpeg_cmd = [
+            'ffmpeg',
+            '-y',
+            '-i', input_path,
+            *MP4_STREAM_COPY_OPTIONS,
+            output_path
+        ]
+        return output_filename, output_path, ffmpeg_cmd
 
     ffmpeg_cmd = [
         'ffmpeg',
         '-y',
         '-i', input_path,
-        '-vf', f'scale={resolution_choices[chosen_resolution][0]}:{resolution_choices[chosen_resolution][1]}',
+        '-vf', f'scale={width}:{height}',
         '-c:a', 'copy',
         '-preset', 'fast',
         output_path
     ]
 
-    print(f"FFMPEG実行中: {' '.join(ffmpeg_cmd)}")
+    return output_filename, output_path, ffmpeg_cmd
+
+def build_ladder_command(input_filename, dir_path, req_data, input_path=None, media_info=None):
+    """1回のデコードから複数の解像度（とオーディオ）を出力するFFMPEGコマンドを返す関数
+
+    映像はsplitフィルターで解像度の数だけ分岐させ、それぞれscaleしてから別々のファイルにエンコードする
+    media_infoから入力と同じ解像度とわかるものは、splitせずにストリームをコピーする
+    戻り値は（[(ラベル, 出力ファイル名, 出力パス)], FFMPEGコマンド）
+    """
+    # 同じ解像度が重複して指定された場合は1つにまとめる
+    resolutions = list(dict.fromkeys(req_data.get('resolutions') or []))
+    include_audio = bool(req_data.get('audio', False))
+    if not resolutions and not include_audio:
+        raise ValueError('作成する解像度が指定されていません')
+    for resolution in resolutions:
+        if resolution not in RESOLUTION_CHOICES:
+            raise ValueError(f'未対応の解像度です: {resolution}')
+
+    input_path = input_path or os.path.join(dir_path, input_filename)
+    base_name = input_filename.split('.')[0]
+    outputs = []
 
-    result = subprocess.run(ffmpeg_cmd, capture_output=True, text=False)
-    if result.returncode != 0:
-        raise Exception(f"FFMPEG エラー: {result.stderr}")
-    return output_filename, output_path
+    ffmpeg_cmd = [
+        'ffmpeg',
+        '-y',
+        '-i', input_path
+    ]
+
+    copy_resolutions = [
+        resolution for resolution in resolutions
+        if get_video_size(media_info) == RESOLUTION_CHOICES[resolution] and can_copy_to_mp4(media_info)
+    ]
+    encode_resolutions = [resolution for resolution in resolutions if resolution not in copy_resolutions]
+
+    if encode_resolutions:
+        filter_graph = [f"[0:v]split={len(encode_resolutions)}" + ''.join(f'[v{index}]' for index in range(len(encode_resolutions)))]
+        for index, resolution in enumerate(encode_resolutions):
+            width, height = RESOLUTION_CHOICES[resolution]
+            filter_graph.append(f'[v{index}]scale={width}:{height}[out{index}]')
+        ffmpeg_cmd += ['-filter_complex', ';'.join(filter_graph)]
+
+    for resolution in resolutions:
+        output_filename = f"{base_name}_{resolution}.mp4"
+        output_path = os.path.join(dir_path, output_filename)
+
+        if resolution in copy_resolutions:
+            # 入力と同じ解像度は、再エンコードせずにMP4に入れ直す
+            ffmpeg_cmd += ['-map', '0:v:0', '-map', '0:a?', *MP4_STREAM_COPY_OPTIONS, output_path]
+        else:
+            ffmpeg_cmd += [
+                '-map', f'[out{encode_resolutions.index(resolution)}]',
+                '-map', '0:a?',      # 音声がある場合はコピー
+                '-c:v', 'libx264',
+                '-preset', 'fast',
+                '-c:a', 'copy',
+                output_path
+            ]
+        outputs.append((resolution, output_filename, output_path))
+
+    if include_audio:
+        output_filename = f"{base_name}_audio.mp3"
+        output_path = os.path.join(dir_path, output_filename)
+        ffmpeg_cmd += ['-map', '0:a', *get_audio_output_options(media_info), output_path]
+        outputs.append(('audio', output_filename, output_path))
+
+    return outputs, ffmpeg_cmd
 
 # 動画アスペクト比処理に関する関数はここから実装
-def handle_aspect_change(input_filename, dir_path, req_data):
+def build_aspect_command(input_filename, dir_path, req_data, input_path=None, media_info=None):
     chosen_aspect_ratio = req_data.get('aspect_ratio', 0)
 
-    input_path = os.path.join(dir_path, input_filename)
+    input_path = input_path or os.path.join(dir_path, input_filename)
     base_name = input_filename.split('.')[0]
     output_filename = f"{base_name}_{chosen_aspect_ratio}.mp4"
     output_path = os.path.join(dir_path, output_filename)
 
+    if can_copy_to_mp4(media_info):
+        # -aspectはコンテナの表示アスペクト比を書き換えるだけなので、再エンコードせずにMP4に入れ直す
+        ffmpeg_cmd = [
+            'ffmpeg',
+            '-y',
+            '-i', input_path,
+            '-aspect', chosen_aspect_ratio,
+            *MP4_STREAM_COPY_OPTIONS,
+            output_path
+        ]
+        return output_filename, output_path, ffmpeg_cmd
+
     ffmpeg_cmd = [
         'ffmpeg',
         '-y',
@@ -502,17 +2401,19 @@ def handle_aspect_change(input_filename, dir_path, req_data):
         output_path
     ]
 
-    print(f"FFMPEG実行中: {' '.join(ffmpeg_cmd)}")
-
-    result = subprocess.run(ffmpeg_cmd, capture_output=True, text=False)
-    if result.returncode != 0:
-        raise Exception(f"FFMPEG エラー: {result.stderr}")
-
-    return output_filename, output_path
+    return output_filename, output_path, ffmpeg_cmd
 
 # 音声への変換処理に関する関数はここから実装
-def handle_video_conversion(input_filename, dir_path):
-    input_path = os.path.join(dir_path, input_filename)
+AUDIO_OUTPUT_OPTIONS = [
+    '-vn',
+    '-acodec', 'mp3',
+    '-ab', '192k',
+    '-ar', '44100',
+    '-ac', '2'
+]
+
+def build_audio_command(input_filename, dir_path, input_path=None, media_info=None):
+    input_path = input_path or os.path.join(dir_path, input_filename)
     base_name = input_filename.split('.')[0]
     output_filename = f"{base_name}_audio.mp3"
     output_path = os.path.join(dir_path, output_filename)
@@ -521,97 +2422,572 @@ def handle_video_conversion(input_filename, dir_path):
         'ffmpeg',
         '-y',
         '-i', input_path,
-        '-vn',
-        '-acodec', 'mp3',
-        '-ab', '192k',
-        '-ar', '44100',
-        '-ac', '2',
+        *get_audio_output_options(media_info),
         output_path
     ]
 
-    print(f"FFMPEG実行中: {' '.join(ffmpeg_cmd)}")
+    return output_filename, output_path, ffmpeg_cmd
 
-    result = subprocess.run(ffmpeg_cmd, capture_output=True, text=False)
-    if result.returncode != 0:
-        raise Exception(f"FFMPEG エラー: {result.stderr}")
-    return output_filename, output_path
+def get_audio_output_options(media_info=None):
+    # 音声が既にMP3の場合は、MP3への再エンコード（音質が劣化する）をせずにそのまま取り出す
+    audio = (media_info or {}).get('audio')
+    if audio is not None and audio.get('codec') == 'mp3':
+        return ['-vn', '-c:a', 'copy']
+    return AUDIO_OUTPUT_OPTIONS
 
 # GIFとWEBMへの変換処理に関する関数はここから実装
-def handle_process_video_clip(input_filename:str, dir_path:str, req_data:dict):
-    chosen_extension = req_data.get('extension')
-    startseconds = req_data.get('startseconds')
-    endseconds = req_data.get('endseconds')
-    input_path = os.path.join(dir_path, input_filename)
+# 切り取りのモード（clip_mode）
+#   accurate: 入力側でシークし、開始位置の直前のキーフレームからデコードして再エンコードする（既定）
+#   keyframe: 開始位置の直前のキーフレームからストリームをコピーする（最速だが、開始が最大1GOP早くなる）
+#   exact: 両端のGOPの一部だけを再エンコードし、キーフレームの間はストリームをコピーして連結する
+CLIP_MODES = ('accurate', 'keyframe', 'exact')
+# ストリームをコピーして切り取れる出力形式ごとの、映像・音声のコーデック
+CLIP_COPY_CODECS = {
+    'mp4': (MP4_VIDEO_CODECS, MP4_AUDIO_CODECS),
+    'webm': (('vp8', 'vp9', 'av1'), ('opus', 'vorbis'))
+}
+# exactモードで境界を再エンコードする際の、元のコーデックごとのエンコーダー
+CLIP_VIDEO_ENCODERS = {
+    'h264': 'libx264',
+    'hevc': 'libx265',
+    'mpeg4': 'mpeg4',
+    'vp8': 'libvpx',
+    'vp9': 'libvpx-vp9'
+}
+# Bフレームを使うエンコーダーのコーデック
+CLIP_B_FRAME_CODECS = ('h264', 'hevc', 'mpeg4')
+CLIP_AUDIO_ENCODERS = {
+    'aac': 'aac',
+    'mp3': 'libmp3lame',
+    'ac3': 'ac3',
+    'eac3': 'eac3',
+    'alac': 'alac',
+    'opus': 'libopus',
+    'vorbis': 'libvorbis'
+}
+
+def find_copy_range(keyframes:list, startseconds:float, endseconds:float):
+    """切り取る範囲の内側にある最初と最後のキーフレームの時刻を返す関数（キーフレームの間がない場合はNone）"""
+    inner_keyframes = [keyframe for keyframe in keyframes if startseconds <= keyframe <= endseconds]
+    if len(inner_keyframes) < 2:
+        return None
+    return inner_keyframes[0], inner_keyframes[-1]
+
+def select_clip_mode(req_data:dict, media_info=None) -> str:
+    """指定されたclip_modeが入力と出力形式で使えるかを判定し、実際に使うモードを返す関数（使えない場合はaccurate）"""
+    clip_mode = req_data.get('clip_mode', 'accurate')
+    if clip_mode not in CLIP_MODES or clip_mode == 'accurate':
+        return 'accurate'
+
+    extension = str(req_data.get('extension', '')).lower()
+    if extension not in CLIP_COPY_CODECS or media_info is None or media_info.get('video') is None or not media_info.get('keyframes'):
+        return 'accurate'
+
+    video_codecs, audio_codecs = CLIP_COPY_CODECS[extension]
+    video_codec = media_info['video'].get('codec')
+    audio = media_info.get('audio')
+    if video_codec not in video_codecs or (audio is not None and audio.get('codec') not in audio_codecs):
+        return 'accurate'
+
+    if clip_mode == 'exact':
+        startseconds = float(req_data.get('startseconds'))
+        endseconds = float(req_data.get('endseconds'))
+        if video_codec not in CLIP_VIDEO_ENCODERS or (audio is not None and audio.get('codec') not in CLIP_AUDIO_ENCODERS):
+            return 'accurate'
+        # 範囲が1GOPに収まる場合はコピーできる部分がないため、全体を再エンコードする
+        if find_copy_range(media_info['keyframes'], startseconds, endseconds) is None:
+            return 'accurate'
+
+    return clip_mode
+
+def get_clip_output(input_filename:str, dir_path:str, req_data:dict):
+    # MP4で出力する場合に入力ファイルを上書きしないよう、出力ファイル名には_clipを付ける
+    chosen_extension = str(req_data.get('extension')).lower()
     base_name = input_filename.split('.')[0]
-    output_filename = f"{base_name}.{chosen_extension}"
-    output_path = os.path.join(dir_path, output_filename)
-
+    output_filename = f"{base_name}_clip.{chosen_extension}"
+    return output_filename, os.path.join(dir_path, output_filename)
+
+def build_clip_command(input_filename:str, dir_path:str, req_data:dict, input_path=None, media_info=None):
+    startseconds = float(req_data.get('startseconds'))
+    endseconds = float(req_data.get('endseconds'))
+    input_path = input_path or os.path.join(dir_path, input_filename)
+    output_filename, output_path = get_clip_output(input_filename, dir_path, req_data)
+
+    if select_clip_mode(req_data, media_info) == 'keyframe':
+        # 開始位置の直前のキーフレームから、デコードせずにコピーする
+        keyframe = max((keyframe for keyframe in media_info['keyframes'] if keyframe <= startseconds), default=0.0)
+        ffmpeg_cmd = [
+            'ffmpeg',
+            '-y',
+            '-ss', str(keyframe),
+            '-i', input_path,
+            '-t', str(endseconds - keyframe),
+            '-c:v', 'copy',
+            '-c:a', 'copy',
+            '-sn', '-dn',
+            '-avoid_negative_ts', 'make_zero',
+            output_path
+        ]
+        return output_filename, output_path, ffmpeg_cmd
+
+    # -ssを-iの前に置くと、開始位置の直前のキーフレームまでシークしてからデコードする
+    # （-iの後に置くと、ファイルの先頭から開始位置までをすべてデコードする）
     ffmpeg_cmd = [
         'ffmpeg',
         '-y',
-        '-i', input_path,
         '-ss', str(startseconds),
-        '-to', str(endseconds),
+        '-i', input_path,
+        '-t', str(endseconds - startseconds),
         output_path
     ]
 
-    print(f"FFMPEG実行中: {' '.join(ffmpeg_cmd)}")
+    return output_filename, output_path, ffmpeg_cmd
+
+def build_clip_segment_command(input_path:str, startseconds:float, endseconds:float, copy:bool, media_info:dict, segment_path:str):
+    # exactモードの1区間を切り出すFFMPEGコマンド（copyがFalseの場合は元と同じコーデック・画素形式で再エンコードする）
+    ffmpeg_cmd = [
+        'ffmpeg',
+        '-y',
+        '-ss', str(startseconds),
+        '-i', input_path,
+        '-t', str(endseconds - startseconds),
+        '-sn', '-dn'
+    ]
+
+    if copy:
+        # 先頭の時刻をずらすと連結した位置で前の区間と重なるため、-avoid_negative_tsは指定しない
+        ffmpeg_cmd += ['-c:v', 'copy', '-c:a', 'copy']
+        # コピーでは-tを過ぎたBフレームも含まれ、次の区間と重なるため、キーフレーム間のフレーム数で止める
+        frame_rate = media_info['video'].get('frame_rate')
+        if frame_rate:
+            ffmpeg_cmd += ['-frames:v', str(round((endseconds - startseconds) * frame_rate))]
+    else:
+        video = media_info['video']
+        ffmpeg_cmd += ['-c:v', CLIP_VIDEO_ENCODERS[video['codec']]]
+        # Bフレームがあると区間の先頭のDTSが負になり、連結した位置でDTSが前後するため使わない
+        if video['codec'] in CLIP_B_FRAME_CODECS:
+            ffmpeg_cmd += ['-bf', '0']
+        if video.get('pix_fmt'):
+            ffmpeg_cmd += ['-pix_fmt', video['pix_fmt']]
+        if video.get('bit_rate'):
+            ffmpeg_cmd += ['-b:v', str(video['bit_rate'])]
+        if media_info.get('audio') is not None:
+            ffmpeg_cmd += ['-c:a', CLIP_AUDIO_ENCODERS[media_info['audio']['codec']]]
+
+    ffmpeg_cmd.append(segment_path)
+    return ffmpeg_cmd
+
+def run_exact_clip(input_filename:str, dir_path:str, req_data:dict, media_info:dict, threads=None):
+    """最初のキーフレームより前と最後のキーフレームより後だけを再エンコードし、その間はコピーして連結する関数
+
+    デコード・エンコードするのは両端の最大2GOP分のみで、切り取る位置や長さによらずほぼ一定の時間で終わる
+    """
+    startseconds = float(req_data.get('startseconds'))
+    endseconds = float(req_data.get('endseconds'))
+    input_path = os.path.join(dir_path, input_filename)
+    output_filename, output_path = get_clip_output(input_filename, dir_path, req_data)
+    extension = output_filename.split('.')[-1]
+    base_name = input_filename.split('.')[0]
+
+    first_keyframe, last_keyframe = find_copy_range(media_info['keyframes'], startseconds, endseconds)
+    segments = [
+        (startseconds, first_keyframe, False),
+        (first_keyframe, last_keyframe, True),
+        (last_keyframe, endseconds, False)
+    ]
+
+    segment_paths = []
+    segment_durations = []
+    list_path = os.path.join(dir_path, f'{base_name}_segments.txt')
+    try:
+        for segment_start, segment_end, copy in segments:
+            if segment_end <= segment_start:
+                continue
+            segment_path = os.path.join(dir_path, f'{base_name}_segment{len(segment_paths)}.{extension}')
+            segment_paths.append(segment_path)
+            segment_durations.append(segment_end - segment_start)
+            execute_ffmpeg(build_clip_segment_command(input_path, segment_start, segment_end, copy, media_info, segment_path), threads=threads)
+
+        # 音声のエンコーダーの遅延で区間の長さが延びても、次の区間が指定した時刻から始まるよう長さを明示する
+        with open(list_path, 'w', encoding='utf-8') as f:
+            for segment_path, segment_duration in zip(segment_paths, segment_durations):
+                f.write(f"file '{segment_path}'\nduration {segment_duration}\n")
+
+        execute_ffmpeg([
+            'ffmpeg',
+            '-y',
+            '-f', 'concat',
+            '-safe', '0',
+            '-i', list_path,
+            '-c', 'copy',
+            output_path
+        ], threads=threads)
+
+    finally:
+        delete_tmp_files(segment_paths + [list_path])
 
-    result = subprocess.run(ffmpeg_cmd, capture_output=True, text=False)
-    if result.returncode != 0:
-        raise Exception(f"FFMPEG エラー: {result.stderr}")
     return output_filename, output_path
 
-def get_video_duration(filepath:str):
-    cmd = [
+# 複数の処理をまとめて実行する関数はここから実装
+def resolve_clip_range(operations:list):
+    """operationsの切り取り（action 5）を順に適用した、元の動画での（開始秒、終了秒）を返す関数（切り取りがない場合はNone）
+
+    2つ目以降の切り取りは、それまでに切り取った範囲の先頭からの時刻として扱う
+    """
+    clip_range = None
+    for operation in operations:
+        if operation.get('action') != 5:
+            continue
+
+        startseconds = float(operation.get('startseconds', 0))
+        endseconds = float(operation.get('endseconds'))
+        if clip_range is None:
+            clip_range = (startseconds, endseconds)
+        else:
+            clip_range = (clip_range[0] + startseconds, min(clip_range[0] + endseconds, clip_range[1]))
+
+    return clip_range
+
+def get_requested_endseconds(req_data:dict):
+    """動画の長さと比較する終了時刻を返す関数（時間範囲の指定がないリクエストはNone）"""
+    match req_data.get('action', 0):
+        case 5:
+            return req_data.get('endseconds')
+        case 6:
+            clip_range = resolve_clip_range(req_data.get('operations') or [])
+            return clip_range[1] if clip_range is not None else None
+        case _:
+            return None
+
+def build_chain_command(input_filename:str, dir_path:str, req_data:dict, input_path=None, input_file_size=None, media_info=None):
+    """operations（各処理のreq_dataのリスト）を、1回のデコード・エンコードで実行するFFMPEGコマンドにまとめる関数
+
+    切り取りは入力側の-ss・-t、解像度とアスペクト比は指定した順のフィルターグラフ、圧縮とオーディオへの変換はエンコーダーの設定になる
+    media_infoから映像の変更がアスペクト比だけとわかる場合は、再エンコードせずにストリームをコピーする
+    """
+    operations = req_data.get('operations') or []
+    if not operations:
+        raise ValueError('まとめて実行する処理が指定されていません')
+
+    input_path = input_path or os.path.join(dir_path, input_filename)
+    video_filters = []
+    compress = False
+    audio_only = False
+    output_extension = 'mp4'
+    aspect_ratio = None
+    # フィルターを適用した時点の映像の大きさ（わからない場合はNone）
+    current_size = get_video_size(media_info)
+
+    for operation in operations:
+        match operation.get('action'):
+            case 1:
+                compress = True
+            case 2:
+                width, height = RESOLUTION_CHOICES[operation.get('resolution')]
+                # 同じ大きさへのscaleは何もしないため省く
+                if (width, height) != current_size:
+                    video_filters.append(f'scale={width}:{height}')
+                    current_size = (width, height)
+            case 3:
+                # -aspectと同じく表示アスペクト比を設定する（フィルターの順序を保つため、setdarフィルターで指定する）
+                aspect_ratio = str(operation.get('aspect_ratio'))
+                video_filters.append(f"setdar={aspect_ratio.replace(':', '/')}")
+            case 4:
+                audio_only = True
+                output_extension = 'mp3'
+            case 5:
+                if operation.get('extension'):
+                    output_extension = str(operation['extension']).lower()
+            case action:
+                raise ValueError(f'まとめて実行できない処理です: {action}')
+
+    if audio_only and (video_filters or compress or output_extension != 'mp3'):
+        raise ValueError('オーディオへの変換は、切り取り以外の処理と組み合わせられません')
+    if compress and output_extension != 'mp4':
+        raise ValueError(f'{output_extension}への変換と圧縮は組み合わせられません')
+
+    base_name = input_filename.split('.')[0]
+    output_filename = f"{base_name}_chain.{output_extension}"
+    output_path = os.path.join(dir_path, output_filename)
+
+    # 切り取りは入力側でシークし、開始位置の直前のキーフレームからデコードする
+    clip_range = resolve_clip_range(operations)
+    ffmpeg_cmd = ['ffmpeg', '-y']
+    if clip_range is not None:
+        ffmpeg_cmd += ['-ss', str(clip_range[0])]
+    ffmpeg_cmd += ['-i', input_path]
+    if clip_range is not None:
+        ffmpeg_cmd += ['-t', str(clip_range[1] - clip_range[0])]
+
+    # 映像の変更がアスペクト比の設定だけ（または何もない）の場合は、再エンコードせずにMP4に入れ直す
+    # （切り取りはキーフレーム単位になり結果が変わるため、コピーしない）
+    stream_copy = (
+        not compress and not audio_only and clip_range is None and output_extension == 'mp4'
+        and all(video_filter.startswith('setdar=') for video_filter in video_filters)
+        and can_copy_to_mp4(media_info)
+    )
+
+    if video_filters and not stream_copy:
+        ffmpeg_cmd += ['-vf', ','.join(video_filters)]
+
+    if audio_only:
+        ffmpeg_cmd += get_audio_output_options(media_info)
+    elif stream_copy:
+        if aspect_ratio is not None:
+            ffmpeg_cmd += ['-aspect', aspect_ratio]
+        ffmpeg_cmd += MP4_STREAM_COPY_OPTIONS
+    elif output_extension == 'mp4':
+        ffmpeg_cmd += ['-c:v', 'libx264']
+        if compress:
+            if input_file_size is None:
+                input_file_size = os.path.getsize(input_path)
+            ffmpeg_cmd += ['-crf', '28', '-preset', select_compress_preset(input_file_size)]
+        else:
+            ffmpeg_cmd += ['-preset', 'fast']
+        ffmpeg_cmd += ['-c:a', 'copy']
+
+    ffmpeg_cmd.append(output_path)
+
+    return output_filename, output_path, ffmpeg_cmd
+
+def build_duration_probe_command(filepath:str):
+    return [
         'ffprobe',
         '-v', 'quiet',
         '-show_entries', 'format=duration',
         '-of', 'csv=p=0',  # ヘッダーなしで数値のみ
         filepath
     ]
-    result = subprocess.run(cmd, capture_output=True)
+
+def get_video_duration(filepath:str):
+    result = subprocess.run(build_duration_probe_command(filepath), capture_output=True)
 
     return float(result.stdout)
 
-def validate_video_duration(filepath:str, endseconds:int) -> ErrorInfo | None:
-    duration_seconds = get_video_duration(filepath)
+def validate_video_duration(filepath:str, endseconds:int, media_info=None) -> ErrorInfo | None:
+    # 索引済みの入力であれば、ffprobeを実行せずにメタデータの長さを使う
+    if media_info is not None and media_info.get('duration') is not None:
+        return check_video_duration(media_info['duration'], endseconds)
+    return check_video_duration(get_video_duration(filepath), endseconds)
+
+def check_video_duration(duration_seconds:float, endseconds:int) -> ErrorInfo | None:
     error_info = None
     if duration_seconds < endseconds:
         error_info = ErrorInfo('1007', '指定した終了時刻が動画の長さを超えています', '指定範囲は動画の時間を超えない値で設定してください')
         print('指定した終了時刻が動画の長さを超えています。処理を終了します')
     return error_info
 
+# 計測に関する関数はここから実装
+# 計測中のFFMPEGのCPU時間（FfmpegUsage）をスレッドごとに保持する
+ffmpeg_usage_local = threading.local()
+
+class FfmpegUsage:
+    """1つのアクションで実行したFFMPEGのCPU時間の合計と、出力の長さ"""
+    def __init__(self) -> None:
+        self.cpu_seconds = 0.0
+        self.out_seconds = None
+        self.lock = threading.Lock()
+
+    def record_progress(self, progress):
+        if progress.latest is not None:
+            self.out_seconds = progress.latest['out_seconds']
+
+def current_ffmpeg_usage():
+    return getattr(ffmpeg_usage_local, 'usage', None)
+
+def add_ffmpeg_cpu_seconds(usage, result):
+    if usage is None or result.cpu_seconds is None:
+        return
+    with usage.lock:
+        usage.cpu_seconds += result.cpu_seconds
+
+@contextlib.contextmanager
+def measure_ffmpeg(action):
+    """ブロック内でFFMPEGを実行した時間、CPU時間、実時間に対する速度をアクションごとに記録するコンテキストマネージャー
+
+    CPU時間はこのサーバーで実行したFFMPEGの分のみで、例外で終わった場合は記録しない
+    """
+    usage = FfmpegUsage()
+    ffmpeg_usage_local.usage = usage
+    started_at = time.monotonic()
+    try:
+        yield usage
+    finally:
+        ffmpeg_usage_local.usage = None
+
+    elapsed_seconds = time.monotonic() - started_at
+    if global_metrics is None:
+        return
+    global_metrics.ffmpeg_seconds.observe(elapsed_seconds, action=action)
+    global_metrics.ffmpeg_cpu_seconds.observe(usage.cpu_seconds, action=action)
+    if usage.out_seconds and elapsed_seconds > 0:
+        global_metrics.ffmpeg_realtime_factor.observe(usage.out_seconds / elapsed_seconds, action=action)
+
+def observe_stage(stage, seconds):
+    if global_metrics is not None:
+        global_metrics.stage_seconds.observe(seconds, stage=stage)
+
+@contextlib.contextmanager
+def measure_stage(stage):
+    """ブロックの実行時間を段階の時間として記録するコンテキストマネージャー（例外で終わった場合は記録しない）"""
+    started_at = time.monotonic()
+    yield
+    observe_stage(stage, time.monotonic() - started_at)
+
+@contextlib.contextmanager
+def measure_upload(upload, mode, start_offset=0):
+    """ブロック内で受信したアップロード（start_offsetバイト目以降）のバイト数、時間、速度を記録するコンテキストマネージャー
+
+    保存済みの入力を使う場合（uploadがUploadStreamでない場合）は何も記録しない
+    """
+    if global_metrics is None or not isinstance(upload, UploadStream):
+        yield
+        return
+
+    started_at = time.monotonic()
+    global_metrics.uploads_in_flight.inc()
+    try:
+        yield
+    finally:
+        global_metrics.uploads_in_flight.dec()
+        received_bytes = upload.total_consumed - start_offset
+        elapsed_seconds = time.monotonic() - started_at
+        global_metrics.upload_bytes.inc(received_bytes, mode=mode)
+
+    if received_bytes > 0 and elapsed_seconds > 0:
+        global_metrics.upload_throughput.observe(received_bytes / elapsed_seconds, mode=mode)
+    # ストリーミング入力はFFMPEGの実行と重なるため、アップロードの段階の時間には含めない
+    if mode != 'streaming':
+        observe_stage('upload', elapsed_seconds)
+
+def observe_response(started_at, file_size):
+    if global_metrics is not None:
+        observe_stage('response', time.monotonic() - started_at)
+        global_metrics.response_bytes.inc(file_size)
+
+def count_error(error_info):
+    if global_metrics is not None:
+        global_metrics.errors.inc(error_code=error_info.error_code)
+
+def collect_component_metrics():
+    """保存領域、キャッシュ、スケジューラー、ワーカーの状態を計測値にする関数（計測値を出力するたびに呼ばれる）"""
+    collected = []
+
+    if global_storage_manager is not None:
+        storage = global_storage_manager.stats()
+        storage_bytes = Gauge('videocompressor_storage_bytes', '予約中のジョブ以外のファイルの使用量（used）、ジョブの予約（reserved）、上限（max）、ディスクの空き（disk_free）', ('kind',))
+        storage_bytes.set(storage['max_bytes'], kind='max')
+        storage_bytes.set(storage['reserved_bytes'], kind='reserved')
+        for kind, value in global_storage_manager.usage().items():
+            storage_bytes.set(value, kind=kind)
+        active_jobs = Gauge('videocompressor_jobs_in_flight', '受け付けてから終了していないジョブの数')
+        active_jobs.set(storage['active_jobs'])
+        storage_rejected = Counter('videocompressor_storage_rejected_total', '保存領域が足りずに拒否したジョブの数')
+        storage_rejected.inc(storage['rejected'])
+        storage_collected = Counter('videocompressor_storage_collected_bytes_total', 'どのジョブのものでもないため削除したファイルのバイト数')
+        storage_collected.inc(storage['collected_bytes'])
+        collected += [storage_bytes, active_jobs, storage_rejected, storage_collected]
+
+    caches = [(name, cache) for name, cache in (('result', global_result_cache), ('source', global_source_cache)) if cache is not None]
+    if caches:
+        cache_bytes = Gauge('videocompressor_cache_bytes', 'キャッシュが使用しているバイト数', ('cache',))
+        cache_entries = Gauge('videocompressor_cache_entries', 'キャッシュのエントリーの数', ('cache',))
+        cache_lookups = Counter('videocompressor_cache_lookups_total', 'キャッシュの検索の数', ('cache', 'result'))
+        cache_evictions = Counter('videocompressor_cache_evictions_total', 'キャッシュから削除したエントリーの数', ('cache',))
+        for name, cache in caches:
+            cache_stats = cache.stats()
+            cache_bytes.set(cache_stats['bytes'], cache=name)
+            cache_entries.set(cache_stats['entries'], cache=name)
+            cache_lookups.inc(cache_stats['hits'], cache=name, result='hit')
+            cache_lookups.inc(cache_stats['misses'], cache=name, result='miss')
+            cache_evictions.inc(cache_stats['evictions'], cache=name)
+        collected += [cache_bytes, cache_entries, cache_lookups, cache_evictions]
+
+    if global_job_scheduler is not None:
+        scheduler = global_job_scheduler.stats()
+        scheduler_jobs = Gauge('videocompressor_scheduler_jobs', 'スケジューラーで実行中（running）・実行待ち（waiting）のジョブの数', ('state',))
+        scheduler_jobs.set(scheduler['running'], state='running')
+        scheduler_jobs.set(scheduler['waiting'], state='waiting')
+        scheduler_admissions = Counter('videocompressor_scheduler_admissions_total', 'スケジューラーが受け付けた（admitted）・拒否した（rejected）ジョブの数', ('result',))
+        scheduler_admissions.inc(scheduler['admitted'], result='admitted')
+        scheduler_admissions.inc(scheduler['rejected'], result='rejected')
+        collected += [scheduler_jobs, scheduler_admissions]
+
+    if global_worker_pool is not None:
+        worker_healthy = Gauge('videocompressor_worker_healthy', 'ワーカーがヘルスチェックに応答しているか（1：応答している）', ('worker',))
+        worker_running = Gauge('videocompressor_worker_running_tasks', 'ワーカーで実行中のタスクの数', ('worker',))
+        worker_capacity = Gauge('videocompressor_worker_capacity', 'ワーカーが同時に実行できるFFMPEGの数', ('worker',))
+        worker_tasks = Counter('videocompressor_worker_tasks_total', 'ワーカーで完了した（completed）・失敗した（failed）タスクの数', ('worker', 'status'))
+        for address, node in global_worker_pool.stats().items():
+            worker_healthy.set(int(node['healthy']), worker=address)
+            worker_running.set(node['running'], worker=address)
+            worker_capacity.set(node['capacity'], worker=address)
+            worker_tasks.inc(node['completed'], worker=address, status='completed')
+            worker_tasks.inc(node['failed'], worker=address, status='failed')
+        collected += [worker_healthy, worker_running, worker_capacity, worker_tasks]
+
+    return collected
+
+def initialize_metrics(config):
+    global global_metrics
+    if config['metrics_port'] is None:
+        return
+
+    global_metrics = ServerMetrics()
+    global_metrics.add_collector(collect_component_metrics)
+    start_metrics_server(global_metrics, config['metrics_address'], config['metrics_port'])
+    print(f"計測値を公開します: http://{config['metrics_address']}:{config['metrics_port']}/metrics")
+
 # メイン（エントリーポイント）
-def main():
-    initialize_rsa()
+def serve_client(config, connection, client_address):
+    """1クライアント分のリクエストを処理し、コネクションを閉じる関数（接続用スレッドプールで実行）"""
+    session = None
+    if global_metrics is not None:
+        global_metrics.connections_in_flight.inc()
 
-    config = load_server_config()
-    sock = create_server_socket(config)
+    try:
+        with measure_stage('handshake'):
+            aes_key, counter_nonces = establish_aes_key(connection)
+        # 以降の送受信はすべてこのセッションで暗号化・復号する
+        session = AeadSession(aes_key, counter_nonces)
 
-    while True:
-        connection, client_address = sock.accept()
-        print(f'{client_address}と接続しました。')
+        handle_client_request(config, connection, session)
 
-        error = None
-        aes_key = None
+    except Exception as e:
+        error = ErrorInfo('1002', str(e), '解決しない場合は管理者にお問い合わせください。')
+        print(error.to_json())
+        if session is not None:
+            send_encrypted_error_response(connection, error, session)
+        else:
+            print("AES鍵が利用できないため、暗号化されていないエラーレスポンスを送信できません")
 
-        try:
-            error, aes_key = handle_client_request(config, connection)
+    finally:
+        print(f'{client_address}とのコネクションを閉じます')
+        connection.close()
+        if global_metrics is not None:
+            global_metrics.connections_in_flight.dec()
 
-        except Exception as e:
-            error = ErrorInfo('1002', str(e), '解決しない場合は管理者にお問い合わせください。')
+def main():
+    initialize_rsa()
 
-        finally:
-            if error is not None:
-                print(error.to_json())
-                if aes_key is not None:
-                    send_encrypted_error_response(connection, error, aes_key)
-                else:
-                    print("AES鍵が利用できないため、暗号化されていないエラーレスポンスを送信できません")
+    config = load_server_config()
+    initialize_metrics(config)
+    initialize_ffmpeg_executor(config)
+    initialize_storage_manager(config)
+    initialize_content_caches(config)
+    initialize_upload_manager(config)
+    initialize_session_tickets(config)
+    initialize_media_index(config)
+    initialize_job_scheduler(config)
+    initialize_worker_pool(config)
+    sock = create_server_socket(config)
 
-            print('コネクションを閉じます')
-            connection.close()
+    # アップロード・ダウンロードなどのネットワークI/Oはクライアントごとにスレッドで並行処理する
+    with ThreadPoolExecutor(max_workers=config['connection_workers'], thread_name_prefix='connection') as connection_executor:
+        while True:
+            connection, client_address = sock.accept()
+            print(f'{client_address}と接続しました。')
+            connection_executor.submit(serve_client, config, connection, client_address)
 
 if __name__ == '__main__':
     main()
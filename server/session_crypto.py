@@ -0,0 +1,87 @@
+import threading
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+# nonce（１２バイト）の先頭４バイトで送信方向を区別し、同じ鍵で両方向のnonceが重複しないようにする
+CLIENT_NONCE_PREFIX = b'\x00\x00\x00\x01'
+SERVER_NONCE_PREFIX = b'\x00\x00\x00\x02'
+NONCE_SIZE = 12
+TAG_SIZE = 16
+AES_KEY_SIZE = 32
+# 鍵交換でクライアントが通知する、このセッションで使うnonceのモード（１バイト）
+NONCE_MODE_RANDOM = b'\x00'
+NONCE_MODE_COUNTER = b'\x01'
+
+class NonceError(Exception):
+    """受信したフレームのnonceが期待するカウンターと一致しない（リプレイまたは順序の入れ替え）ことを表す例外"""
+    pass
+
+class AeadSession:
+    """1接続につき1つ作成するAES-GCMのセッション
+
+    フレームの形式は従来と同じ nonce（１２バイト）＋暗号文＋タグ（１６バイト）
+    送信するフレームのnonceは「送信方向（４バイト）＋カウンター（８バイト）」とし、フレームごとに乱数を生成しない
+    counter_noncesは鍵交換で相手が通知したnonceのモードで、Trueの場合は順番どおりのnonce以外を拒否する
+    （Falseはランダムなnonceを使う従来のクライアントで、受信したnonceをそのまま使う）
+    """
+    def __init__(self, aes_key, counter_nonces=True, is_server=True) -> None:
+        self.aead = AESGCM(aes_key)
+        self.send_prefix = SERVER_NONCE_PREFIX if is_server else CLIENT_NONCE_PREFIX
+        self.receive_prefix = CLIENT_NONCE_PREFIX if is_server else SERVER_NONCE_PREFIX
+        self.send_counter = 0
+        self.receive_counter = 0
+        self.counter_nonces = counter_nonces
+        # 複数のスレッド（進捗の送信、StreamingResponseなど）から送信する場合に、nonceの順番どおりにフレームが届くよう
+        # 暗号化から送信までをロックする（send_frame、FrameSenderのflushはロックしたままsealを呼ぶため、再入可能にする）
+        self.send_lock = threading.RLock()
+
+    def next_send_nonce(self) -> bytes:
+        with self.send_lock:
+            nonce = self.send_prefix + self.send_counter.to_bytes(8, 'big')
+            self.send_counter += 1
+        return nonce
+
+    def seal(self, data):
+        """dataを暗号化し、nonceと暗号文＋タグを別々に返す関数（連結せずにまとめて送信する場合に使う）"""
+        nonce = self.next_send_nonce()
+        return nonce, self.aead.encrypt(nonce, data, None)
+
+    def encrypt(self, data) -> bytes:
+        """dataを暗号化し、nonce＋暗号文＋タグのフレームを返す関数"""
+        nonce, sealed = self.seal(data)
+        return nonce + sealed
+
+    def send_frame(self, connection, data):
+        """dataを暗号化し、データサイズ（４バイト）とフレームを送信する関数（暗号化から送信までロックする）"""
+        with self.send_lock:
+            frame = self.encrypt(data)
+            connection.sendall(len(frame).to_bytes(4, 'big') + frame)
+
+    def decrypt(self, frame) -> bytes:
+        """nonce＋暗号文＋タグのフレームを復号する関数（frameはbytesまたはmemoryview）"""
+        nonce = bytes(frame[:NONCE_SIZE])
+        expected_nonce = self.receive_prefix + self.receive_counter.to_bytes(8, 'big')
+
+        if self.counter_nonces and nonce != expected_nonce:
+            raise NonceError(f'{self.receive_counter}番目のフレームのnonceが一致しません（リプレイまたは順序の入れ替え）')
+
+        # memoryviewのまま渡し、暗号文をスライスでコピーしない
+        plaintext = self.aead.decrypt(nonce, memoryview(frame)[NONCE_SIZE:], None)
+        self.receive_counter += 1
+        return plaintext
+
+def parse_key_message(key_message) -> tuple:
+    """RSAで復号した鍵交換のメッセージから、（AES鍵, カウンターのnonceを使うか）を返す関数
+
+    メッセージはAES鍵（３２バイト）＋nonceのモード（１バイト）で、モードがない場合はランダムなnonceを使う従来のクライアントとみなす
+    """
+    aes_key = key_message[:AES_KEY_SIZE]
+    nonce_mode = key_message[AES_KEY_SIZE:]
+    if len(aes_key) != AES_KEY_SIZE or nonce_mode not in (b'', NONCE_MODE_RANDOM, NONCE_MODE_COUNTER):
+        raise ValueError('鍵交換のメッセージが不正です')
+    return aes_key, nonce_mode == NONCE_MODE_COUNTER
+
+def parse_nonce_mode(nonce_mode) -> bool:
+    """セッションの再開時にクライアントが通知したnonceのモード（１バイト）から、カウンターのnonceを使うかを返す関数"""
+    if nonce_mode not in (NONCE_MODE_RANDOM, NONCE_MODE_COUNTER):
+        raise ValueError('nonceのモードが不正です')
+    return nonce_mode == NONCE_MODE_COUNTER
@@ -0,0 +1,89 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+# セッション再開用の秘密値と、クライアント・サーバーの乱数のサイズ
+RESUMPTION_SECRET_SIZE = 32
+SESSION_RANDOM_SIZE = 32
+# 受け付けるチケットの最大サイズ（このサーバーが発行するチケットは７２バイト）
+MAX_TICKET_SIZE = 1024
+# 再開したセッションのAES鍵を導出する際のinfo
+RESUMED_KEY_INFO = b'videoCompressor session resumption'
+
+def derive_resumed_key(resumption_secret, client_random, server_random) -> bytes:
+    """チケットの秘密値と両者の乱数から、再開したセッションで使うAES鍵（３２バイト）を導出する関数"""
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=client_random + server_random,
+        info=RESUMED_KEY_INFO
+    ).derive(resumption_secret)
+
+class SessionTicketManager:
+    """セッションチケットの発行と検証を行うクラス
+
+    チケットは「鍵ID（４バイト）＋nonce（１２バイト）＋暗号文（秘密値、有効期限）＋タグ」で、サーバーのチケット鍵で暗号化する
+    チケット鍵はrotation_secondsごとに新しくし、古い鍵はその鍵で発行したチケットがすべて期限切れになるまで検証用に残す
+    チケット鍵はメモリ上にのみ保持するため、サーバーを再起動するとそれまでのチケットは使えなくなる（フルハンドシェイクになる）
+    """
+    def __init__(self, lifetime_seconds, rotation_seconds) -> None:
+        self.lifetime_seconds = lifetime_seconds
+        self.rotation_seconds = rotation_seconds
+        # 鍵ID -> (AESGCM, 作成時刻)（新しい鍵ほど後ろ）
+        self.ticket_keys = OrderedDict()
+        self.next_key_id = 0
+        self.lock = threading.Lock()
+
+    def current_key(self, now):
+        """現在のチケット鍵を返す関数（必要なら新しい鍵を作り、不要になった古い鍵を削除する）"""
+        with self.lock:
+            if not self.ticket_keys or now - next(reversed(self.ticket_keys.values()))[1] >= self.rotation_seconds:
+                self.ticket_keys[self.next_key_id] = (AESGCM(AESGCM.generate_key(bit_length=256)), now)
+                self.next_key_id = (self.next_key_id + 1) % (1 << 32)
+
+            while now - next(iter(self.ticket_keys.values()))[1] >= self.rotation_seconds + self.lifetime_seconds:
+                self.ticket_keys.popitem(last=False)
+
+            key_id = next(reversed(self.ticket_keys))
+            return key_id, self.ticket_keys[key_id][0]
+
+    def issue(self):
+        """新しいチケットを発行し、（秘密値、有効期限（UNIX時間）、チケット）を返す関数"""
+        now = time.time()
+        key_id, ticket_key = self.current_key(now)
+
+        resumption_secret = os.urandom(RESUMPTION_SECRET_SIZE)
+        expires_at = int(now + self.lifetime_seconds)
+
+        key_id_bytes = key_id.to_bytes(4, 'big')
+        nonce = os.urandom(12)
+        sealed = ticket_key.encrypt(nonce, resumption_secret + expires_at.to_bytes(8, 'big'), key_id_bytes)
+
+        return resumption_secret, expires_at, key_id_bytes + nonce + sealed
+
+    def open(self, ticket):
+        """チケットを検証して秘密値を返す関数（鍵が破棄済み、改ざん、期限切れの場合はNone）"""
+        if len(ticket) != 4 + 12 + RESUMPTION_SECRET_SIZE + 8 + 16:
+            return None
+
+        key_id_bytes = ticket[:4]
+        with self.lock:
+            entry = self.ticket_keys.get(int.from_bytes(key_id_bytes, 'big'))
+        if entry is None:
+            return None
+
+        try:
+            plaintext = entry[0].decrypt(ticket[4:16], ticket[16:], key_id_bytes)
+        except Exception:
+            return None
+
+        resumption_secret = plaintext[:RESUMPTION_SECRET_SIZE]
+        expires_at = int.from_bytes(plaintext[RESUMPTION_SECRET_SIZE:], 'big')
+        if time.time() >= expires_at:
+            return None
+
+        return resumption_secret
@@ -0,0 +1,201 @@
+import os
+import re
+import time
+import errno
+import shutil
+import threading
+
+# ジョブの作業用ファイル名（受信した入力のファイル名「uuid.拡張子」と、そこから作る「uuid_接尾辞.拡張子」）
+JOB_FILENAME_PATTERN = re.compile(r'^([0-9a-f]{32})[._]')
+
+class StorageError(Exception):
+    """保存領域の空きが足りず、ジョブを受け付けられないことを表す例外"""
+    pass
+
+class StorageManager:
+    """storage_dirの使用量をmax_storage以下に保ち、作業用のファイルをジョブごとに管理するクラス
+
+    ジョブのファイルはstorage_dir直下に入力のuuidで始まる名前で作られるため、uuidをジョブのキーとしてファイルを追跡する
+    受け付けの際に入力と出力の推定サイズを予約し、予約の合計と他のファイル（キャッシュ、再開待ちのアップロードなど）の使用量が
+    max_storageを超える場合と、ディスクの空きが足りない場合は拒否する
+    他のファイルの使用量は走査のたびに数え直し（ハードリンクは1回だけ数える）、その間はキャッシュなどに保存したファイルの分を加える
+    終了したジョブのファイルはまとめて削除し、どのジョブのものでもないファイル（異常終了の残りなど）は起動時と定期的に削除する
+    """
+    def __init__(self, storage_dir, max_bytes, orphan_seconds) -> None:
+        self.storage_dir = storage_dir
+        self.max_bytes = max_bytes
+        self.orphan_seconds = orphan_seconds
+        # ジョブのキー -> 予約したバイト数
+        self.reservations = {}
+        self.reserved_bytes = 0
+        # 予約中のジョブ以外のファイルの使用量と、それを数えたファイルのinode
+        self.used_bytes = 0
+        self.counted_inodes = set()
+        self.rejected = 0
+        self.collected_files = 0
+        self.collected_bytes = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(self.storage_dir, exist_ok=True)
+
+    @staticmethod
+    def job_key(filename):
+        match = JOB_FILENAME_PATTERN.match(filename)
+        return match.group(1) if match else None
+
+    @staticmethod
+    def count_files(files, counted_inodes) -> int:
+        """まだ数えていないinodeのファイルのサイズを合計する関数（数えたinodeはcounted_inodesに加える）"""
+        total_bytes = 0
+        for _, stat in files:
+            inode = (stat.st_dev, stat.st_ino)
+            if inode not in counted_inodes:
+                counted_inodes.add(inode)
+                total_bytes += stat.st_blocks * 512
+        return total_bytes
+
+    def scan(self):
+        """storage_dir以下を走査し、(ジョブ以外のファイルのリスト, ジョブのキー -> ファイルのリスト)を返す関数"""
+        other_files = []
+        job_files = {}
+
+        for root, _, filenames in os.walk(self.storage_dir):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+
+                key = self.job_key(filename) if root == self.storage_dir else None
+                if key is None:
+                    other_files.append((path, stat))
+                else:
+                    job_files.setdefault(key, []).append((path, stat))
+
+        return other_files, job_files
+
+    def refresh_usage(self):
+        """storage_dir以下を走査して、予約中のジョブ以外のファイルの使用量を数え直す関数"""
+        other_files, job_files = self.scan()
+
+        with self.lock:
+            # 予約のないジョブのファイル（異常終了の残りなど）も使用量に含める
+            unreserved_files = [file for key, files in job_files.items() if key not in self.reservations for file in files]
+            counted_inodes = set()
+            self.used_bytes = self.count_files(other_files, counted_inodes) + self.count_files(unreserved_files, counted_inodes)
+            self.counted_inodes = counted_inodes
+
+    def track(self, key):
+        """ジョブのファイルを作る前に呼び出し、ジョブのファイルを削除の対象から外す関数（予約は0バイトから始める）"""
+        with self.lock:
+            self.reservations.setdefault(key, 0)
+
+    def reserve(self, key, reserve_bytes):
+        """ジョブのために保存領域を予約する関数（空きが足りない場合はStorageError）"""
+        free_bytes = shutil.disk_usage(self.storage_dir).free
+
+        with self.lock:
+            available_bytes = min(self.max_bytes - self.used_bytes, free_bytes) - self.reserved_bytes
+            if reserve_bytes > available_bytes:
+                self.rejected += 1
+                raise StorageError(f'保存領域の空きが足りません（必要: {reserve_bytes}バイト、空き: {max(available_bytes, 0)}バイト）')
+
+            self.reservations[key] = self.reservations.get(key, 0) + reserve_bytes
+            self.reserved_bytes += reserve_bytes
+
+    def retain(self, path):
+        """ジョブのファイルをキャッシュなどに保存した後に呼び出し、ジョブの終了後も残るファイルとして使用量に加える関数"""
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return
+
+        with self.lock:
+            self.used_bytes += self.count_files([(path, stat)], self.counted_inodes)
+
+    def release(self, key):
+        """ジョブの終了時に、ジョブのファイルをすべて削除して予約を解放する関数"""
+        for filename in os.listdir(self.storage_dir):
+            if self.job_key(filename) == key:
+                remove_file(os.path.join(self.storage_dir, filename))
+
+        with self.lock:
+            self.reserved_bytes -= self.reservations.pop(key, 0)
+
+    def collect(self, startup=False):
+        """実行中のジョブのものでないジョブのファイルを削除する関数（起動時以外はorphan_seconds秒以上更新されていないもののみ）"""
+        _, job_files = self.scan()
+        now = time.time()
+
+        with self.lock:
+            active_keys = set(self.reservations)
+
+        for key, files in job_files.items():
+            if key in active_keys:
+                continue
+            for path, stat in files:
+                if not startup and now - stat.st_mtime < self.orphan_seconds:
+                    continue
+                if remove_file(path):
+                    print(f"どのジョブのものでもないファイルを削除しました: {path}")
+                    with self.lock:
+                        self.collected_files += 1
+                        self.collected_bytes += stat.st_blocks * 512
+
+    def start_collector(self, interval_seconds):
+        """起動時に残っているファイルを削除し、その後はinterval_secondsごとに削除して使用量を数え直すスレッドを開始する関数"""
+        self.collect(startup=True)
+        self.refresh_usage()
+
+        def collect_loop():
+            while True:
+                time.sleep(interval_seconds)
+                try:
+                    self.collect()
+                    self.refresh_usage()
+                except OSError as e:
+                    print(f"作業用ファイルの削除中にエラーが発生しました: {e}")
+
+        threading.Thread(target=collect_loop, daemon=True, name='storage-collector').start()
+
+    def usage(self) -> dict:
+        """予約中のジョブ以外のファイルの使用量（used）と、ディスクの空き（disk_free）をバイト数で返す関数"""
+        with self.lock:
+            used_bytes = self.used_bytes
+        return {
+            'used': used_bytes,
+            'disk_free': shutil.disk_usage(self.storage_dir).free
+        }
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'active_jobs': len(self.reservations),
+                'reserved_bytes': self.reserved_bytes,
+                'max_bytes': self.max_bytes,
+                'rejected': self.rejected,
+                'collected_files': self.collected_files,
+                'collected_bytes': self.collected_bytes
+            }
+
+def remove_file(path) -> bool:
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def preallocate_file(f, size):
+    """書き込む前にファイルの領域を確保する関数（空きが足りない場合は受信を始める前にOSError）
+
+    ファイルシステムやOS（macOS、Windowsなど）が対応していない場合は何もしない
+    """
+    if not hasattr(os, 'posix_fallocate'):
+        return
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except OSError as e:
+        if e.errno in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+            return
+        raise
@@ -0,0 +1,238 @@
+import os
+import re
+import hmac
+import uuid
+import socket
+import hashlib
+import argparse
+import ipaddress
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from content_cache import ContentCache
+from worker_pool import WorkerError, send_message, recv_message, send_file, recv_file
+from server import FfmpegProgress, apply_ffmpeg_threads, feed_ffmpeg, delete_tmp_files
+
+# コーディネーター（server.py）から受け取ったFFMPEGのコマンドを実行するワーカー
+# 実行例: poetry run python server/worker.py --port 9101 --storage /tmp/worker1 --capacity 2
+# 受信した入力はハッシュをキーに保存し、同じ入力のタスクでは転送を省く
+
+# 任意のファイルを読み書きさせないため、コマンドで受け付けない引数
+# （入力は{input}、出力は{output}のみ。concatのリストやフィルターのスクリプト、ファイルを読むフィルターも使わせない）
+FORBIDDEN_OPTIONS = ('-safe', '-filter_script', '-filter_complex_script', '-attach', '-dump_attachment')
+FORBIDDEN_FORMATS = ('concat',)
+FILE_FILTER_PATTERN = re.compile(r'\b(movie|amovie|subtitles|ass|sendcmd|asendcmd|zmq|azmq)\b')
+# プロトコル付きのURL（file:、http:など）
+URL_PATTERN = re.compile(r'^[A-Za-z][A-Za-z0-9+.-]*:')
+# フィルターの引数などに埋め込まれたパスを取り出すための区切り文字
+ARGUMENT_DELIMITER_PATTERN = re.compile(r"[=:,;\[\]'\"\\]")
+OUTPUT_EXTENSION_PATTERN = re.compile(r'(\.[0-9A-Za-z]{1,16})?')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='FFMPEGのタスクを実行するワーカー')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9101)
+    parser.add_argument('--storage', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'storage', 'worker'))
+    # 同時に実行するFFMPEGの数と、各FFMPEGのスレッド数（省略した場合はCPUの数を同時実行数で割った数）
+    parser.add_argument('--capacity', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=None)
+    # 受信した入力を保存する容量（バイト）
+    parser.add_argument('--max-storage', type=int, default=64 * 1024 * 1024 * 1024)
+    # コーディネーターのworker_tokenと同じ値（省略できるのは、--hostがループバックアドレスの場合のみ）
+    parser.add_argument('--token', default=os.environ.get('VIDEO_COMPRESSOR_WORKER_TOKEN'))
+    args = parser.parse_args()
+
+    # 他のホストから接続できる場合は、任意のコマンドを実行されないようトークンを必須にする
+    if not args.token and not is_loopback_host(args.host):
+        parser.error(f'--host {args.host} で起動する場合は、--token（または環境変数 VIDEO_COMPRESSOR_WORKER_TOKEN）を指定してください')
+    return args
+
+def is_loopback_host(host) -> bool:
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        # ホスト名は名前解決の結果によらず、ループバック以外として扱う
+        return False
+
+class Worker:
+    """1つのワーカーの入力の保存先と、FFMPEGの同時実行数の制限"""
+    def __init__(self, args) -> None:
+        self.token = args.token
+        self.capacity = args.capacity
+        self.threads = args.threads or max((os.cpu_count() or 1) // args.capacity, 1)
+        # 出力先をFFMPEGの作業ディレクトリにするため、保存先は絶対パスにしておく
+        storage_dir = os.path.abspath(args.storage)
+        self.output_dir = os.path.join(storage_dir, 'outputs')
+        self.input_cache = ContentCache(os.path.join(storage_dir, 'inputs'), args.max_storage)
+        self.slots = threading.Semaphore(args.capacity)
+        self.running = 0
+        # 受信中の入力のハッシュ -> ロック（同じ入力を同時に受信しないようにする）
+        self.receiving = {}
+        self.lock = threading.Lock()
+        os.makedirs(self.output_dir, exist_ok=True)
+
+    def is_authorized(self, message) -> bool:
+        if not self.token:
+            return True
+        # 比較にかかる時間からトークンを推測されないよう、バイト列として一定時間で比較する（ASCII以外の文字も比較できる）
+        return hmac.compare_digest(str(message.get('token', '')).encode('utf-8'), self.token.encode('utf-8'))
+
+    def handle_connection(self, connection):
+        try:
+            message = recv_message(connection)
+            if not self.is_authorized(message):
+                send_message(connection, {'status': 'error', 'error': 'トークンが一致しません'})
+                return
+
+            match message.get('type'):
+                case 'health':
+                    send_message(connection, {
+                        'status': 'ok',
+                        'capacity': self.capacity,
+                        'running': self.running,
+                        'inputs': self.input_cache.stats()['entries']
+                    })
+                case 'encode':
+                    self.handle_encode(connection, message)
+                case _:
+                    send_message(connection, {'status': 'error', 'error': f"未対応のメッセージです: {message.get('type')}"})
+
+        except (OSError, ValueError, WorkerError) as e:
+            print(f"コーディネーターとの通信に失敗しました: {e}")
+
+        finally:
+            connection.close()
+
+    def receive_input(self, connection, message):
+        """入力を保存していない場合はコーディネーターから受信し、保存した入力のパスを返す関数（input_cache.releaseが必要）"""
+        input_hash = message['input_hash']
+        with self.lock:
+            receive_lock = self.receiving.setdefault(input_hash, threading.Lock())
+
+        # 同じ入力を別の接続で受信している場合は、受信し終えてから保存済みの入力を使う
+        try:
+            with receive_lock:
+                input_path = self.input_cache.lookup(input_hash)
+                send_message(connection, {'need_input': input_path is None})
+                if input_path is not None:
+                    return input_path
+                return self.receive_input_file(connection, message)
+        finally:
+            with self.lock:
+                if not receive_lock.locked():
+                    self.receiving.pop(input_hash, None)
+
+    def receive_input_file(self, connection, message):
+        input_hash = message['input_hash']
+        tmp_path = os.path.join(self.output_dir, f"{uuid.uuid4()}{message['input_extension']}")
+        hasher = hashlib.sha256()
+        try:
+            recv_file(connection, tmp_path, message['input_size'], hasher.update)
+            if hasher.hexdigest() != input_hash:
+                raise ValueError('受信した入力のハッシュが一致しません')
+            print(f"入力を受信しました: {input_hash}（{message['input_size']}バイト）")
+            return self.input_cache.store(input_hash, tmp_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def build_command(self, ffmpeg_cmd, input_path, output_path):
+        # FFMPEG以外のコマンドは実行しない
+        if not ffmpeg_cmd or ffmpeg_cmd[0] != 'ffmpeg':
+            raise ValueError('FFMPEGのコマンドではありません')
+        validate_arguments(ffmpeg_cmd[1:])
+
+        replacements = {'{input}': input_path, '{output}': output_path}
+        ffmpeg_cmd = [replacements.get(arg, arg) for arg in ffmpeg_cmd]
+        ffmpeg_cmd = apply_ffmpeg_threads(ffmpeg_cmd, self.threads)
+        return [ffmpeg_cmd[0], '-progress', 'pipe:1', '-nostats'] + ffmpeg_cmd[1:]
+
+    def handle_encode(self, connection, message):
+        try:
+            input_path = self.receive_input(connection, message)
+        except ValueError as e:
+            send_message(connection, {'status': 'error', 'error': str(e)})
+            return
+
+        output_path = None
+        try:
+            if not isinstance(message.get('output_extension'), str) or not OUTPUT_EXTENSION_PATTERN.fullmatch(message['output_extension']):
+                raise ValueError(f"出力の拡張子が無効です: {message.get('output_extension')}")
+            output_path = os.path.join(self.output_dir, f"{uuid.uuid4()}{message['output_extension']}")
+            ffmpeg_cmd = self.build_command(message['ffmpeg_cmd'], input_path, output_path)
+            progress = FfmpegProgress(None, lambda latest: send_message(connection, {'type': 'progress', 'progress': latest}))
+
+            with self.slots:
+                with self.lock:
+                    self.running += 1
+                print(f"FFMPEG実行中: {' '.join(ffmpeg_cmd)}")
+                try:
+                    result = feed_ffmpeg(ffmpeg_cmd, None, progress.feed)
+                finally:
+                    with self.lock:
+                        self.running -= 1
+
+            if result.returncode != 0:
+                send_message(connection, {'status': 'error', 'error': f"FFMPEG エラー: {result.stderr.decode('utf-8', errors='replace')[-2000:]}"})
+                return
+
+            # 最終的な進捗（エンコード速度など）も結果と一緒に返す
+            send_message(connection, {'status': 'ok', 'output_size': os.path.getsize(output_path), 'progress': progress.latest})
+            send_file(connection, output_path)
+
+        except ValueError as e:
+            send_message(connection, {'status': 'error', 'error': str(e)})
+
+        finally:
+            self.input_cache.release(message['input_hash'])
+            if output_path is not None and os.path.exists(output_path):
+                delete_tmp_files([output_path])
+
+def validate_arguments(arguments):
+    """FFMPEGの引数（先頭のffmpegを除く）のうち、{input}・{output}以外でファイルを指定できるものがあればValueErrorにする関数
+
+    トークンを知っている接続（トークンなしで起動した場合は同じホストのすべてのプロセス）が、
+    ワーカーのユーザーの権限で任意のパスを読み書きできないようにする
+    """
+    for index, argument in enumerate(arguments):
+        if not isinstance(argument, str):
+            raise ValueError('コマンドの引数は文字列で指定してください')
+        if argument in ('{input}', '{output}'):
+            continue
+
+        previous = arguments[index - 1] if index > 0 else None
+        if previous == '-i':
+            raise ValueError('入力は{input}のみ指定できます')
+        if argument in FORBIDDEN_OPTIONS or (previous == '-f' and argument in FORBIDDEN_FORMATS):
+            raise ValueError(f'使用できない引数です: {argument}')
+        if URL_PATTERN.match(argument) or FILE_FILTER_PATTERN.search(argument):
+            raise ValueError(f'ファイルやURLを指定する引数は使用できません: {argument}')
+
+        # フィルターの引数などに埋め込まれたものも含め、絶対パスと親ディレクトリへのパスは受け付けない
+        for part in [argument] + ARGUMENT_DELIMITER_PATTERN.split(argument):
+            if os.path.isabs(part) or part.startswith('~') or '..' in part.split('/'):
+                raise ValueError(f'パスを指定する引数は使用できません: {argument}')
+
+def main():
+    args = parse_args()
+    worker = Worker(args)
+    # 相対パスの引数が残っていても、ワーカーの出力先の外には書き込ませない
+    os.chdir(worker.output_dir)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen()
+    print(f"ワーカーを起動しました: {args.host}:{args.port}（同時実行数: {worker.capacity}、スレッド数: {worker.threads}）")
+
+    # 実行待ちのタスクがあってもヘルスチェックに応答できるよう、同時実行数より多くの接続を受け付ける
+    with ThreadPoolExecutor(max_workers=args.capacity + 32, thread_name_prefix='worker') as connection_executor:
+        while True:
+            connection, _ = sock.accept()
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection_executor.submit(worker.handle_connection, connection)
+
+if __name__ == '__main__':
+    main()
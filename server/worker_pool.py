@@ -0,0 +1,285 @@
+import os
+import json
+import time
+import socket
+import threading
+
+# ワーカーとのメッセージ（４バイトの長さ＋JSON）の最大サイズ
+MAX_MESSAGE_SIZE = 1024 * 1024
+# ファイルを受信する際の読み込みサイズ
+TRANSFER_CHUNK_SIZE = 1024 * 1024
+# ワーカーへの接続とヘルスチェックのタイムアウト（秒）（FFMPEGの実行中の応答待ちにはタイムアウトを設けない）
+CONNECT_TIMEOUT = 5
+# 1つのタスクを実行する最大の回数（失敗した場合は別のワーカーで再実行する）
+MAX_TASK_ATTEMPTS = 3
+# 入力を持つワーカーの空きを待つ間、他のワーカーがタスクの取得を再試行する間隔（秒）
+TASK_POLL_SECONDS = 0.5
+
+class WorkerError(Exception):
+    """ワーカーに接続できない、または応答が不正なことを表す例外（そのワーカーは使わなくなる）"""
+    pass
+
+class WorkerTaskError(Exception):
+    """ワーカーでのFFMPEGの実行に失敗したことを表す例外（別のワーカーで再実行する）"""
+    pass
+
+# コーディネーターとワーカーの通信に関する関数はここから実装
+def send_message(sock, message:dict):
+    data = json.dumps(message, ensure_ascii=False).encode('utf-8')
+    sock.sendall(len(data).to_bytes(4, 'big') + data)
+
+def recv_exact(sock, size) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), TRANSFER_CHUNK_SIZE))
+        if not chunk:
+            raise WorkerError('接続が閉じられました')
+        data += chunk
+    return bytes(data)
+
+def recv_message(sock) -> dict:
+    size = int.from_bytes(recv_exact(sock, 4), 'big')
+    if size > MAX_MESSAGE_SIZE:
+        raise WorkerError(f'メッセージが大きすぎます: {size}バイト')
+    return json.loads(recv_exact(sock, size).decode('utf-8'))
+
+def send_file(sock, filepath):
+    # sendfileでカーネル内でファイルからソケットに直接送る
+    with open(filepath, 'rb') as f:
+        sock.sendfile(f)
+
+def recv_file(sock, filepath, file_size, on_chunk=None):
+    """file_sizeバイトを受信してファイルに書き込む関数（on_chunkを指定した場合は受信したデータごとに呼び出す）"""
+    view = memoryview(bytearray(TRANSFER_CHUNK_SIZE))
+    received = 0
+    with open(filepath, 'wb') as f:
+        while received < file_size:
+            received_size = sock.recv_into(view[:min(TRANSFER_CHUNK_SIZE, file_size - received)])
+            if received_size == 0:
+                raise WorkerError('ファイルの受信中に接続が閉じられました')
+            f.write(view[:received_size])
+            if on_chunk is not None:
+                on_chunk(view[:received_size])
+            received += received_size
+
+# コーディネーターに関する関数はここから実装
+class WorkerTask:
+    """ワーカーで実行するFFMPEGのコマンド1つ分（コマンドの入力は{input}、出力は{output}と書く）
+
+    on_progressを指定した場合は、ワーカーから届いたエンコードの進捗の辞書を渡して呼び出す
+    """
+    def __init__(self, ffmpeg_cmd, input_path, input_hash, output_path, on_progress=None) -> None:
+        self.ffmpeg_cmd = ffmpeg_cmd
+        self.input_path = input_path
+        self.input_hash = input_hash
+        self.output_path = output_path
+        self.on_progress = on_progress or (lambda progress: None)
+        self.attempts = 0
+        self.errors = []
+
+class WorkerNode:
+    """ワーカー1台の接続先と状態"""
+    def __init__(self, address) -> None:
+        host, _, port = address.rpartition(':')
+        self.address = address
+        self.host = host
+        self.port = int(port)
+        # ヘルスチェックに応答するまでは使わない
+        self.healthy = False
+        # ワーカーが同時に実行するFFMPEGの数と、このコーディネーターが実行させているタスクの数
+        self.capacity = 1
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=CONNECT_TIMEOUT)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+class WorkerPool:
+    """TCPで接続したワーカーにFFMPEGのタスクを実行させるクラス
+
+    各ワーカーの空き枠ごとに1スレッドが待ち行列からタスクを取り出して実行するため、速いワーカーほど多くのタスクを処理する（ワークスティーリング）
+    入力を既に保存しているワーカーがある場合は、そのワーカーに空きがある間は他のワーカーにそのタスクを渡さない（入力の転送を省く）
+    失敗したタスクは待ち行列に戻して別のワーカーで再実行し、接続できなくなったワーカーは次のヘルスチェックで応答するまで使わない
+    """
+    def __init__(self, addresses, token, health_interval) -> None:
+        self.nodes = [WorkerNode(address) for address in addresses]
+        self.token = token
+        self.health_interval = health_interval
+        # 入力のハッシュ -> その入力を保存しているワーカーのアドレス
+        self.locations = {}
+        self.lock = threading.Lock()
+
+    def start_health_checks(self):
+        """起動時と、その後はhealth_intervalごとにすべてのワーカーの状態を確認する関数"""
+        self.check_all()
+
+        def check_loop():
+            while True:
+                time.sleep(self.health_interval)
+                self.check_all()
+
+        threading.Thread(target=check_loop, daemon=True, name='worker-health').start()
+
+    def check_all(self):
+        for node in self.nodes:
+            self.check_health(node)
+
+    def check_health(self, node):
+        try:
+            with node.connect() as sock:
+                send_message(sock, {'type': 'health', 'token': self.token})
+                reply = recv_message(sock)
+            if reply.get('status') != 'ok':
+                raise WorkerError(reply.get('error', '不正な応答です'))
+        except (OSError, ValueError, WorkerError) as health_err:
+            if node.healthy:
+                print(f"ワーカー {node.address} が応答しません: {health_err}")
+            node.healthy = False
+            return
+
+        if not node.healthy:
+            print(f"ワーカー {node.address} を使用します（同時実行数: {reply['capacity']}）")
+        node.capacity = max(int(reply['capacity']), 1)
+        node.healthy = True
+
+    def healthy_nodes(self):
+        return [node for node in self.nodes if node.healthy]
+
+    def total_capacity(self) -> int:
+        return sum(node.capacity for node in self.healthy_nodes())
+
+    def is_local(self, node, task) -> bool:
+        return node.address in self.locations.get(task.input_hash, ())
+
+    def take_task(self, pending, node):
+        """nodeが次に実行するタスクを待ち行列から取り出す関数（lockを保持した状態で呼び出すこと）
+
+        入力を保存しているタスクを優先し、他のワーカーが入力を保存していて空きがあるタスクは取らない
+        """
+        for task in pending:
+            if self.is_local(node, task):
+                pending.remove(task)
+                return task
+
+        for task in pending:
+            local_nodes = [other for other in self.healthy_nodes() if self.is_local(other, task)]
+            if not any(other.running < other.capacity for other in local_nodes):
+                pending.remove(task)
+                return task
+
+        return None
+
+    def run_tasks(self, tasks:list):
+        """tasksをワーカーで実行し、すべての出力を受信するまで待機する関数（実行できないタスクがある場合はWorkerError）"""
+        nodes = self.healthy_nodes()
+        if not nodes:
+            raise WorkerError('利用できるワーカーがありません')
+
+        pending = list(tasks)
+        failed = []
+        # 実行中のタスクの数（すべてのスレッドが終わる前に、失敗したタスクが待ち行列に戻る場合がある）
+        in_flight = [0]
+        condition = threading.Condition(self.lock)
+
+        def worker_loop(node):
+            while True:
+                with condition:
+                    task = None
+                    while not failed and node.healthy and (pending or in_flight[0]):
+                        task = self.take_task(pending, node)
+                        if task is not None:
+                            break
+                        condition.wait(timeout=TASK_POLL_SECONDS)
+                    if task is None:
+                        return
+                    in_flight[0] += 1
+                    node.running += 1
+
+                try:
+                    self.execute(node, task)
+                    error = None
+                except (OSError, ValueError, WorkerError, WorkerTaskError) as task_err:
+                    error = task_err
+
+                with condition:
+                    in_flight[0] -= 1
+                    node.running -= 1
+                    if error is None:
+                        node.completed += 1
+                        self.locations.setdefault(task.input_hash, set()).add(node.address)
+                    else:
+                        node.failed += 1
+                        task.attempts += 1
+                        task.errors.append(f'{node.address}: {error}')
+                        print(f"ワーカー {node.address} でのタスクの実行に失敗しました（{task.attempts}回目）: {error}")
+                        if not isinstance(error, WorkerTaskError):
+                            # 接続や通信の失敗はワーカーの障害として、次のヘルスチェックまで使わない
+                            node.healthy = False
+                        if task.attempts >= MAX_TASK_ATTEMPTS:
+                            failed.append(task)
+                        else:
+                            pending.append(task)
+                    condition.notify_all()
+
+        threads = [
+            threading.Thread(target=worker_loop, args=(node,), daemon=True, name=f'worker-{node.address}')
+            for node in nodes for _ in range(node.capacity)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if failed:
+            raise WorkerError('タスクを実行できませんでした: ' + ' / '.join(failed[0].errors))
+        if pending:
+            raise WorkerError('タスクを実行できるワーカーがなくなりました')
+
+    def execute(self, node, task):
+        """1つのタスクをnodeで実行し、出力をtask.output_pathに受信する関数"""
+        with node.connect() as sock:
+            # FFMPEGの実行を待つため、接続後はタイムアウトしない
+            sock.settimeout(None)
+            send_message(sock, {
+                'type': 'encode',
+                'token': self.token,
+                'input_hash': task.input_hash,
+                'input_extension': os.path.splitext(task.input_path)[1],
+                'input_size': os.path.getsize(task.input_path),
+                'output_extension': os.path.splitext(task.output_path)[1],
+                'ffmpeg_cmd': task.ffmpeg_cmd
+            })
+
+            reply = recv_message(sock)
+            if reply.get('status') == 'error':
+                raise WorkerError(reply['error'])
+            if reply.get('need_input'):
+                send_file(sock, task.input_path)
+
+            # FFMPEGの実行中は進捗が届き、最後に結果が届く
+            reply = recv_message(sock)
+            while reply.get('type') == 'progress':
+                task.on_progress(reply['progress'])
+                reply = recv_message(sock)
+            if reply.get('status') != 'ok':
+                raise WorkerTaskError(reply.get('error', '不正な応答です'))
+            if reply.get('progress') is not None:
+                task.on_progress(reply['progress'])
+
+            recv_file(sock, task.output_path, reply['output_size'])
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                node.address: {
+                    'healthy': node.healthy,
+                    'capacity': node.capacity,
+                    'running': node.running,
+                    'completed': node.completed,
+                    'failed': node.failed
+                }
+                for node in self.nodes
+            }